@@ -0,0 +1,442 @@
+#!/usr/bin/env python
+#
+# Benchmarks and sanity checks for the processing code.
+#
+#   python benchmarks.py blocks [sizes...]
+#   python benchmarks.py check
+#   python benchmarks.py gamma [sizes...]
+#   python benchmarks.py imports [modules...]
+#   python benchmarks.py lzw [sizes...]
+#   python benchmarks.py packbits [sizes...]
+#
+# blocks: synthetic sums with a known 8x8 pattern, cleaned with both
+#   removeDctBlockArtifacts() and removeBlockPattern(). Prints the RMS error
+#   against the clean image, relative to the pattern's own RMS, and timings.
+#
+# gamma: quantize() of random RGB frames with the output gammas, through the
+#   lookup table and through pow(). Prints both timings, the largest
+#   difference between them in 16-bit LSBs, and gammaTableError().
+#
+# lzw: tifffile.decodelzw() of synthetic LZW strips of each size in bytes,
+#   made by encodeLzw(): random bytes, a smooth 16-bit gradient like a scan,
+#   and a constant. Prints the decoded MB/s and checks the round trip.
+#
+# packbits: tifffile.decodepackbits() against the byte-by-byte loop it
+#   replaced, on strips of each size made by encodePackbits(): random bytes
+#   (nearly all literal runs), a noisy gradient (short runs of both kinds),
+#   and a constant. Prints both timings and checks the round trip.
+#
+# imports: how long importing each module takes in a fresh interpreter, on
+#   top of numpy (which everything needs). Milliseconds depend on the machine
+#   and the disk cache, so each is also divided by how long 'import numpy'
+#   took in the same interpreter, and that ratio is checked against
+#   import_budgets. Each is the median of import_runs runs, after a first run
+#   that writes the .pyc files, and the slowest modules it pulled in are
+#   listed like python -X importtime would. Exits with status 1 if any is
+#   over budget, so it can run as a check. Heavy or rarely used dependencies
+#   (scipy, BaseHTTPServer, xml.etree, ...) should be imported where they're
+#   used.
+#
+# check: the bit-level decoders in tifffile against plain references.
+#   unpackints() for every item size from 1 to 32 bits, several run lengths
+#   and signed and unsigned types, against readBits(), which reads one bit
+#   at a time. decodelzw() round trips of encodeLzw() strips, including one
+#   long enough to clear the table, and the same strips truncated, which
+#   must warn and return a prefix of the data; strips with invalid codes
+#   must raise ValueError. Lists each failure and exits with status 1 if
+#   there are any.
+#
+
+import os
+import sys
+import json
+import time
+import subprocess
+import warnings
+import numpy
+import process_sum
+import tifffile
+
+def syntheticBlocks(n, band=64, seed=0):
+    # A smooth gradient plus noise, with one 8x8 pattern everywhere and a
+    # second one only in the central rows, like letterboxed images at a
+    # different grid offset. Single channel float32, to keep 16k feasible.
+    rng = numpy.random.RandomState(seed)
+    y = numpy.linspace(0, 1, n, dtype=numpy.float32)
+    clean = (y[:, None] * 1000 + y[None, :] * 500).astype(numpy.float32)
+    clean += rng.normal(0, 5, (n, n)).astype(numpy.float32)
+
+    pattern = numpy.tile(rng.normal(0, 20, (8, 8)).astype(numpy.float32), (n // 8, n // 8))
+    rows = slice(n // 2 - 2 * band, n // 2 + 2 * band)
+    pattern[rows] += numpy.tile(rng.normal(0, 20, (8, 8)).astype(numpy.float32), (4 * band // 8, n // 8))
+    pattern -= pattern.mean()
+
+    return clean[:, :, None], (clean + pattern)[:, :, None], numpy.sqrt(numpy.mean(pattern ** 2))
+
+def benchBlocks(sizes):
+    print "%6s  %12s  %12s  %10s  %10s" % ('size', 'fft error', 'spatial err', 'fft s', 'spatial s')
+    for n in sizes:
+        clean, noisy, pattern_rms = syntheticBlocks(n)
+        out = numpy.empty(noisy.shape, numpy.float32)
+
+        def run(func, *args):
+            start = time.time()
+            func(noisy, *args)
+            seconds = time.time() - start
+            return numpy.sqrt(numpy.mean((out - clean) ** 2)) / pattern_rms, seconds
+
+        fft_error, fft_seconds = run(process_sum.removeDctBlockArtifacts, out)
+        process_sum.dct_masks.clear()
+        process_sum.fft_buffers.clear()
+        spatial_error, spatial_seconds = run(process_sum.removeBlockPattern, 64, out)
+
+        print "%6d  %12.4f  %12.4f  %10.3f  %10.3f" % (
+            n, fft_error, spatial_error, fft_seconds, spatial_seconds)
+
+def benchGamma(sizes):
+    print "%6s  %7s  %10s  %10s  %10s  %10s" % ('size', 'gamma', 'lut s', 'pow s', 'max diff', 'bound')
+    for n in sizes:
+        rng = numpy.random.RandomState(0)
+        s = rng.uniform(0, 1, (n, n, 3))
+        lut = numpy.empty(s.shape, numpy.uint16)
+        exact = numpy.empty(s.shape, numpy.uint16)
+
+        for gamma in (2.2, 1 / 2.2):
+            process_sum.gammaTable(gamma)
+            start = time.time()
+            process_sum.quantize(s, gamma, lut)
+            lut_seconds = time.time() - start
+
+            process_sum.gamma_lut = False
+            start = time.time()
+            process_sum.quantize(s, gamma, exact)
+            pow_seconds = time.time() - start
+            process_sum.gamma_lut = True
+
+            print "%6d  %7.3f  %10.3f  %10.3f  %10d  %10.2f" % (n, gamma, lut_seconds, pow_seconds,
+                numpy.abs(lut.astype(int) - exact).max(), process_sum.gammaTableError(gamma))
+
+def lzwWidth(n):
+    # Code width after n codes since a CLEAR, with TIFF's early change
+    return 9 + (n >= 254) + (n >= 766) + (n >= 1790)
+
+def encodeLzw(data):
+    # TIFF LZW strip of a byte string, clearing the table when it's full
+    table = dict((chr(i), i) for i in range(256))
+    codes = [(256, 9)]
+    count = 0
+    next_code = 258
+    prefix = ''
+    for byte in data:
+        if prefix + byte in table:
+            prefix += byte
+            continue
+        codes.append((table[prefix], lzwWidth(count)))
+        count += 1
+        table[prefix + byte] = next_code
+        next_code += 1
+        prefix = byte
+        if next_code == 4094:
+            codes.append((table[prefix], lzwWidth(count)))
+            codes.append((256, lzwWidth(count + 1)))
+            table = dict((chr(i), i) for i in range(256))
+            count = 0
+            next_code = 258
+            prefix = ''
+    if prefix:
+        codes.append((table[prefix], lzwWidth(count)))
+        count += 1
+    codes.append((257, lzwWidth(count)))
+    return packCodes(codes)
+
+def packCodes(codes):
+    # Byte string of (code, width) pairs, most significant bit first
+    bits = ''.join(format(code, '0%db' % width) for code, width in codes)
+    bits += '0' * (-len(bits) % 8)
+    return numpy.packbits(numpy.frombuffer(bits, numpy.uint8) - ord('0')).tostring()
+
+def benchLzw(sizes):
+    print "%10s  %10s  %10s  %8s  %10s" % ('size', 'data', 'encoded', 'MB/s', 'round trip')
+    for n in sizes:
+        rng = numpy.random.RandomState(0)
+        side = int(numpy.sqrt(n // 2))
+        gradient = numpy.add.outer(numpy.arange(side), numpy.arange(side)) * 7
+        strips = [
+            ('noise', rng.randint(0, 256, n).astype(numpy.uint8).tostring()),
+            ('gradient', gradient.astype('<u2').tostring()),
+            ('flat', '\x80' * n),
+        ]
+        for name, data in strips:
+            encoded = encodeLzw(data)
+            start = time.time()
+            decoded = tifffile.decodelzw(encoded)
+            seconds = time.time() - start
+            print "%10d  %10s  %10d  %8.1f  %10s" % (len(data), name, len(encoded),
+                len(data) / seconds / 1e6, decoded == data)
+
+def encodePackbits(data):
+    # PackBits runs of 3-128 repeated bytes, and literal runs of the rest
+    out = []
+    literal = ''
+    i = 0
+    while i < len(data):
+        j = i + 1
+        while j < len(data) and j - i < 128 and data[j] == data[i]:
+            j += 1
+        if j - i >= 3:
+            if literal:
+                out.append(chr(len(literal) - 1) + literal)
+                literal = ''
+            out.append(chr(257 - (j - i)) + data[i])
+            i = j
+        else:
+            literal += data[i]
+            i += 1
+            if len(literal) == 128:
+                out.append(chr(127) + literal)
+                literal = ''
+    if literal:
+        out.append(chr(len(literal) - 1) + literal)
+    return ''.join(out)
+
+def decodePackbitsLoop(encoded):
+    # tifffile's decodepackbits() before it was vectorised
+    result = []
+    i = 0
+    try:
+        while True:
+            n = ord(encoded[i]) + 1
+            i += 1
+            if n < 129:
+                result.extend(encoded[i:i+n])
+                i += n
+            elif n > 129:
+                result.extend(encoded[i:i+1] * (258-n))
+                i += 1
+    except IndexError:
+        pass
+    return ''.join(result)
+
+def benchPackbits(sizes):
+    print "%10s  %10s  %10s  %10s  %10s  %10s" % ('size', 'data', 'encoded', 'numpy s', 'loop s', 'round trip')
+    for n in sizes:
+        rng = numpy.random.RandomState(0)
+        gradient = numpy.arange(n) // 5 % 256 + (rng.uniform(size=n) < 0.3)
+        strips = [
+            ('noise', rng.randint(0, 256, n).astype(numpy.uint8).tostring()),
+            ('gradient', gradient.astype(numpy.uint8).tostring()),
+            ('flat', '\x80' * n),
+        ]
+        for name, data in strips:
+            encoded = encodePackbits(data)
+            start = time.time()
+            decoded = tifffile.decodepackbits(encoded)
+            seconds = time.time() - start
+            start = time.time()
+            decodePackbitsLoop(encoded)
+            loop_seconds = time.time() - start
+            print "%10d  %10s  %10d  %10.4f  %10.4f  %10s" % (n, name, len(encoded), seconds,
+                loop_seconds, decoded == data)
+
+def readBits(data, itemsize, runlen, count):
+    # unpackints() one bit at a time: 'count' integers of 'itemsize' bits,
+    # most significant bit first, each run of 'runlen' starting on a byte
+    bits = numpy.unpackbits(numpy.frombuffer(data, numpy.uint8))
+    values = []
+    pos = 0
+    for i in range(count):
+        value = 0
+        for bit in bits[pos:pos + itemsize]:
+            value = value << 1 | int(bit)
+        values.append(value)
+        pos += itemsize
+        if (i + 1) % runlen == 0:
+            pos += -pos % 8
+    return numpy.array(values, numpy.int64)
+
+def checkUnpackints():
+    failures = []
+    rng = numpy.random.RandomState(0)
+    for length in (0, 1, 3, 200, 201):
+        data = rng.randint(0, 256, length).astype(numpy.uint8).tostring()
+        for itemsize in range(1, 33):
+            itembytes = next(i for i in (1, 2, 4) if 8 * i >= itemsize)
+            # whole bytes are read in the type's byte order, the rest most
+            # significant bit first
+            dtypes = ['>u%d' % itembytes, '>i%d' % itembytes] + (['?'] if itemsize == 1 else [])
+            for dtype in dtypes:
+                for runlen in (0, 1, 3, 7, 13, 64):
+                    if itemsize in (8, 16, 32):
+                        # whole bytes never need padding, so the run
+                        # length doesn't matter, but the data must be
+                        # whole items
+                        if length % itembytes:
+                            continue
+                        run = length // itembytes
+                    elif itemsize == 1:
+                        run = runlen or length * 8
+                    else:
+                        run = runlen or length // itembytes
+                    if not run:
+                        continue
+                    rowbits = -(-run * itemsize // 8) * 8
+                    if itemsize == 1 and length * 8 % rowbits:
+                        # bit arrays must be whole rows
+                        continue
+                    count = run * (length * 8 // rowbits)
+                    case = "unpackints(%d bytes, %s, %d, %d)" % (length, dtype, itemsize, runlen)
+                    try:
+                        result = tifffile.unpackints(data, dtype, itemsize, runlen)
+                    except Exception as e:
+                        failures.append("%s raised %r" % (case, e))
+                        continue
+                    expected = readBits(data, itemsize, run, count).astype(dtype)
+                    if result.shape != expected.shape or result.dtype != expected.dtype:
+                        failures.append("%s gave %s %s, not %s %s" % (case, result.dtype,
+                            result.shape, expected.dtype, expected.shape))
+                    elif not (result == expected).all():
+                        failures.append("%s differs from readBits()" % case)
+    return failures
+
+def checkLzw():
+    failures = []
+    rng = numpy.random.RandomState(0)
+    gradient = numpy.add.outer(numpy.arange(200), numpy.arange(200)) * 7
+    strips = [
+        ('one byte', 'a'),
+        ('noise', rng.randint(0, 256, 5000).astype(numpy.uint8).tostring()),
+        ('noise past a full table', rng.randint(0, 256, 50000).astype(numpy.uint8).tostring()),
+        ('gradient', gradient.astype('<u2').tostring()),
+        ('repeats', 'ab' * 5000),
+        ('flat', '\x80' * 20000),
+    ]
+    for name, data in strips:
+        encoded = encodeLzw(data)
+        try:
+            if tifffile.decodelzw(encoded) != data:
+                failures.append("decodelzw(%s) differs" % name)
+        except Exception as e:
+            failures.append("decodelzw(%s) raised %r" % (name, e))
+
+        for cut in sorted(set([4, 5, len(encoded) // 2, len(encoded) - 1])):
+            if not 4 <= cut < len(encoded):
+                continue
+            case = "decodelzw(%s cut to %d of %d bytes)" % (name, cut, len(encoded))
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter('always')
+                try:
+                    decoded = tifffile.decodelzw(encoded[:cut])
+                except Exception as e:
+                    failures.append("%s raised %r" % (case, e))
+                    continue
+            if not data.startswith(decoded):
+                failures.append("%s isn't a prefix of the data" % case)
+            if not any('unexpected end' in str(w.message) for w in caught):
+                failures.append("%s didn't warn" % case)
+
+    invalid = [
+        ('too short', '\x80\x00\x00'),
+        ('no CLEAR', packCodes([(97, 9), (257, 9)] + [(0, 9)] * 2)),
+        ('code past the table', packCodes([(256, 9), (259, 9), (257, 9), (0, 9)])),
+        ('code past the table later', packCodes([(256, 9), (97, 9), (98, 9), (300, 9), (257, 9)])),
+        ('code past the table after a CLEAR', packCodes([(256, 9), (97, 9), (98, 9), (258, 9),
+            (256, 9), (258, 9), (257, 9)])),
+    ]
+    for name, encoded in invalid:
+        try:
+            tifffile.decodelzw(encoded)
+            failures.append("decodelzw(%s) didn't raise ValueError" % name)
+        except ValueError:
+            pass
+        except Exception as e:
+            failures.append("decodelzw(%s) raised %r" % (name, e))
+    return failures
+
+def check():
+    failed = False
+    for name, func in (('unpackints', checkUnpackints), ('lzw', checkLzw)):
+        failures = func()
+        print "%-12s %s" % (name, "%d failures" % len(failures) if failures else 'ok')
+        for failure in failures:
+            print "  " + failure
+        failed = failed or bool(failures)
+    if failed:
+        sys.exit(1)
+
+# Import time per module, on top of numpy, as a fraction of numpy's own.
+# numpy takes ~40 ms here, and these are about 2-3x what each measures.
+import_budgets = {
+    'tifffile': 0.1,
+    'process_sum': 0.25,
+    'preview_server': 0.6,
+    'render_video': 0.25,
+    'compare_sums': 0.25,
+}
+import_runs = 7
+
+# Run in the child: times importing numpy, then the module and every module
+# it pulls in that wasn't loaded yet, through __import__
+import_timer = r"""
+import sys, time, json, __builtin__
+start = time.time()
+import numpy
+baseline = time.time() - start
+real_import = __builtin__.__import__
+times = {}
+def timedImport(name, *args, **kwargs):
+    new = name not in sys.modules
+    start = time.time()
+    try:
+        return real_import(name, *args, **kwargs)
+    finally:
+        if new and name in sys.modules:
+            times[name] = time.time() - start
+__builtin__.__import__ = timedImport
+start = time.time()
+import %s
+total = time.time() - start
+__builtin__.__import__ = real_import
+print json.dumps([total / baseline, total, baseline, times])
+"""
+
+def timeImport(module, env):
+    out = subprocess.check_output([sys.executable, '-c', import_timer % module], env=env)
+    return json.loads(out.splitlines()[-1])
+
+def benchImports(modules):
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    over = []
+    print "%-16s  %8s  %8s  %8s  %8s  %s" % ('module', 'ms', 'numpy ms', 'ratio', 'budget',
+        'slowest imports (ms, cumulative)')
+    for module in modules or sorted(import_budgets):
+        timeImport(module, env)
+        runs = sorted([timeImport(module, env) for i in range(import_runs)])
+        ratio, total, baseline, times = runs[len(runs) // 2]
+        slowest = sorted(times.items(), key=lambda (name, t): -t)
+        slowest = [(name, t) for name, t in slowest if name != module][:4]
+        budget = import_budgets.get(module)
+        print "%-16s  %8.1f  %8.1f  %8.3f  %8s  %s" % (module, total * 1000, baseline * 1000,
+            ratio, budget or '-', ', '.join('%s %.1f' % (name, t * 1000) for name, t in slowest))
+        if budget is not None and ratio > budget:
+            over.append(module)
+    if over:
+        print "Over budget: %s" % ', '.join(over)
+        sys.exit(1)
+
+def main():
+    name = sys.argv[1] if len(sys.argv) > 1 else 'blocks'
+    if name == 'imports':
+        benchImports(sys.argv[2:])
+        return
+    if name == 'check':
+        check()
+        return
+    default_sizes = {'lzw': [1 << 16, 1 << 20], 'packbits': [1 << 16, 1 << 20]}.get(name, [1024, 2048, 4096, 8192, 16384])
+    sizes = [int(a) for a in sys.argv[2:]] or default_sizes
+    {'blocks': benchBlocks, 'gamma': benchGamma, 'lzw': benchLzw,
+        'packbits': benchPackbits}[name](sizes)
+
+
+if __name__ == '__main__':
+    main()
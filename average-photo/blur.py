@@ -0,0 +1,215 @@
+#
+# Gaussian blur for the post-processing scripts, with a cost that doesn't
+# grow with sigma.
+#
+# We pick one of three separable implementations based on image size and sigma:
+#
+#   'spatial' - scipy's direct convolution. Exact, but the kernel is about
+#               8 sigma wide, so it's only the best choice for small sigma.
+#
+#   'fft'     - Multiply by the transfer function of that same kernel (scipy's
+#               sampled Gaussian, truncated at pad_sigmas and normalised), one
+#               axis at a time. The reflected border is at least as wide as
+#               the kernel, so the result matches 'spatial' to rounding error
+#               (about 1e-15 of the range at float64, 1e-6 at float32).
+#               O(log n) per pixel; transfer functions are cached per length,
+#               sigma and type so repeated blurs of the same shape reuse them.
+#               The default above spatial_max_sigma.
+#
+#   'iir'     - Young / van Vliet recursive Gaussian, run forward and backward
+#               along each axis with scipy.signal.lfilter. A fixed handful of
+#               multiply-adds per pixel regardless of sigma, and about twice
+#               as fast as 'fft', but approximate: its error against 'spatial'
+#               is about 1e-3 of the range over the whole frame, not just near
+#               the borders. That moves a 16-bit lowpass output by up to ~80
+#               LSB, and the high-pass outputs, which stretch the difference
+#               from the lowpass, by thousands. Only used for frames of at
+#               least iir_min_pixels, which is off by default.
+#
+# Every method blurs all channels of an (h, w, c) image in one call. Each pass
+# works on strips across the axis it isn't filtering, of about strip_bytes of
+# output each, spread over a thread pool, so its temporaries are a few strips'
+# worth whatever the frame size. They're kept in the output's type, except
+# in 'iir' (see recursiveBlur1d).
+#
+
+import math
+import numpy
+import multiprocessing
+import multiprocessing.pool
+
+# Above this sigma direct convolution loses to the FFT
+spatial_max_sigma = 8.0
+
+# Frames with at least this many pixels use the approximate recursive filter
+# (see above) instead of the FFT, or None to always use the exact methods
+iir_min_pixels = None
+
+# The kernel, and the reflected border added before the recursive and FFT
+# filters, extend this many sigmas either side (scipy's 'truncate')
+pad_sigmas = 4.0
+
+# Output bytes per strip
+strip_bytes = 16 << 20
+
+threads = multiprocessing.cpu_count()
+
+transfer_functions = {}
+thread_pool = None
+
+def chooseMethod(shape, sigma):
+    if sigma <= spatial_max_sigma:
+        return 'spatial'
+    elif iir_min_pixels is not None and shape[0] * shape[1] >= iir_min_pixels:
+        return 'iir'
+    else:
+        return 'fft'
+
+def gaussianBlur(s, sigma, out=None, method=None):
+    # Blur the first two axes of 's', into 'out' if given
+    method = method or chooseMethod(s.shape, sigma)
+    print "Blurring with sigma %.1f (%s)" % (sigma, method)
+
+    # Filter down the columns, then along the rows
+    out = gaussianBlur1d(s, sigma, 0, out, method)
+    return gaussianBlur1d(out, sigma, 1, out, method)
+
+def gaussianBlur1d(s, sigma, axis, out=None, method=None):
+    # Blur 's' along one of its first two axes. The work is split into strips
+    # across the other axis, so strips are independent.
+    method = method or chooseMethod(s.shape, sigma)
+    if out is None:
+        out = numpy.empty(s.shape, s.dtype if s.dtype.kind == 'f' else float)
+    filter1d = {'spatial': spatialBlur1d, 'iir': recursiveBlur1d, 'fft': fftBlur1d}[method]
+    inBands(lambda a, o: filter1d(a, sigma, axis, o), s, out, 1 - axis)
+    return out
+
+def inBands(func, a, out, axis):
+    # Run func(a_band, out_band) over equal bands along 'axis', at least one
+    # per thread and small enough that each has about strip_bytes of 'out'
+    global thread_pool
+    n = max(threads, -(-out.nbytes // strip_bytes))
+    n = max(1, min(n, a.shape[axis]))
+
+    edges = numpy.linspace(0, a.shape[axis], n + 1).astype(int)
+    bands = []
+    for i in range(n):
+        index = [slice(None)] * a.ndim
+        index[axis] = slice(edges[i], edges[i + 1])
+        bands.append(tuple(index))
+    if threads <= 1 or n == 1:
+        for index in bands:
+            func(a[index], out[index])
+        return
+
+    if thread_pool is None:
+        thread_pool = multiprocessing.pool.ThreadPool(threads)
+    thread_pool.map(lambda index: func(a[index], out[index]), bands)
+
+def kernelRadius(sigma):
+    # As scipy.ndimage.gaussian_filter1d with truncate=pad_sigmas
+    return int(pad_sigmas * sigma + 0.5)
+
+def padReflect(a, sigma, axis, fast=False, dtype=None):
+    # Mirror the ends of 'a' along 'axis' by at least kernelRadius(sigma), as
+    # type 'dtype', matching scipy's 'reflect' mode. With 'fast', the far end
+    # gets extra padding up to a quick FFT length.
+    n = a.shape[axis]
+    pad = int(math.ceil(pad_sigmas * sigma))
+    far = pad
+    if fast:
+        far = fastLength(n + 2 * pad) - n - pad
+    widths = [(0, 0)] * a.ndim
+    widths[axis] = (pad, far)
+    return numpy.pad(numpy.asarray(a, dtype), widths, 'symmetric'), pad
+
+def fastLength(n):
+    # Smallest 5-smooth length >= n, which the FFT handles quickly
+    best = 2 * n
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            p235 = p35
+            while p235 < n:
+                p235 *= 2
+            best = min(best, p235)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+def cropAxis(a, start, length, axis):
+    index = [slice(None)] * a.ndim
+    index[axis] = slice(start, start + length)
+    return a[tuple(index)]
+
+def spatialBlur1d(a, sigma, axis, out):
+    import scipy.ndimage.filters
+    scipy.ndimage.filters.gaussian_filter1d(a, sigma, axis=axis, output=out, mode='reflect',
+        truncate=pad_sigmas)
+
+def recursiveCoefficients(sigma):
+    # Young & van Vliet, "Recursive implementation of the Gaussian filter", 1995
+    if sigma >= 2.5:
+        q = 0.98711 * sigma - 0.96330
+    else:
+        q = 3.97156 - 4.14554 * math.sqrt(1 - 0.26891 * sigma)
+    b0 = 1.57825 + 2.44413 * q + 1.4281 * q**2 + 0.422205 * q**3
+    b1 = 2.44413 * q + 2.85619 * q**2 + 1.26661 * q**3
+    b2 = -(1.4281 * q**2 + 1.26661 * q**3)
+    b3 = 0.422205 * q**3
+    B = 1 - (b1 + b2 + b3) / b0
+    return [B], [1.0, -b1 / b0, -b2 / b0, -b3 / b0]
+
+def recursiveBlur1d(a, sigma, axis, out):
+    import scipy.signal
+    # The recursion runs in float64 whatever the input: at float32 its
+    # poles, close to 1 for large sigma, lose most of the accuracy
+    b, a_coeffs = recursiveCoefficients(sigma)
+    zi = scipy.signal.lfilter_zi(b, a_coeffs)
+    padded, pad = padReflect(numpy.moveaxis(a, axis, 0), sigma, 0, dtype=out.dtype)
+
+    # Start each direction in its steady state for the edge value, so the
+    # reflected border only has to absorb the remaining transient.
+    shape = (len(zi),) + (1,) * (padded.ndim - 1)
+    y, zf = scipy.signal.lfilter(b, a_coeffs, padded, axis=0, zi=zi.reshape(shape) * padded[:1])
+    del padded
+    y = y[::-1]
+    y, zf = scipy.signal.lfilter(b, a_coeffs, y, axis=0, zi=zi.reshape(shape) * y[:1])
+
+    numpy.moveaxis(out, axis, 0)[...] = y[::-1][pad:pad + a.shape[axis]]
+
+def transferFunction(length, sigma, dtype):
+    # Frequency response of scipy's Gaussian kernel over a scipy.fftpack.rfft
+    # of 'length' samples, in its packed order (the real and imaginary part
+    # of each frequency in turn), as 'dtype'
+    key = (length, sigma, numpy.dtype(dtype).str)
+    if key not in transfer_functions:
+        radius = kernelRadius(sigma)
+        x = numpy.arange(-radius, radius + 1)
+        kernel = numpy.exp(-0.5 / sigma ** 2 * x ** 2)
+        kernel /= kernel.sum()
+        # centred on sample 0, wrapping around; it's symmetric, so its
+        # spectrum is real
+        k = numpy.zeros(length)
+        k[:radius + 1] = kernel[radius:]
+        k[length - radius:] = kernel[:radius]
+        spectrum = numpy.fft.rfft(k).real
+        packed = numpy.empty(length, dtype)
+        packed[0] = spectrum[0]
+        packed[1:] = numpy.repeat(spectrum[1:], 2)[:length - 1]
+        transfer_functions[key] = packed
+    return transfer_functions[key]
+
+def fftBlur1d(a, sigma, axis, out):
+    import scipy.fftpack
+    padded, pad = padReflect(a, sigma, axis, True, dtype=out.dtype)
+    length = padded.shape[axis]
+
+    shape = [1] * a.ndim
+    shape[axis] = length
+    spectrum = scipy.fftpack.rfft(padded, axis=axis, overwrite_x=True)
+    del padded
+    spectrum *= transferFunction(length, sigma, out.dtype).reshape(shape)
+    spectrum = scipy.fftpack.irfft(spectrum, axis=axis, overwrite_x=True)
+    out[...] = cropAxis(spectrum, pad, a.shape[axis], axis)
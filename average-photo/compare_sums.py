@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+#
+# Compare sum buffers with each other, e.g. every decade against every other.
+#
+#   python compare_sums.py sums/
+#   python compare_sums.py "sums/18*.npy" "sums/19*.npy"
+#
+# Arguments name sums the way process_sum's batch mode takes them. Each sum
+# is normalised, by its image count (from the .json beside it, see
+# sum_images.saveCount) or with normalise = 'total' by its per-channel mean,
+# so that buffers of different sizes compare like for like. Every pair gets:
+#
+#   correlation  Pearson correlation over all pixels, averaged over channels
+#   ssim         structural similarity of 8x8 blocks, averaged over blocks
+#                and channels (the global form of SSIM, without the
+#                Gaussian window)
+#   diff-a-b.tiff  the difference a - b, as a 16-bit TIFF with no difference
+#                at mid-grey, in diff_dir
+#
+# and the matrices go to similarity.json. With many inputs, set diff_pairs to
+# the pairs you want images of, or to None for none.
+#
+# The inputs are memmapped and read a band of rows at a time, every input's
+# band together, with as many rows as fit in block_bytes, so N sums never
+# need more than that in RAM per worker. Within a band, the correlation sums
+# for all pairs come from one matrix product (the Gram matrix of the inputs),
+# the SSIM of all pairs comes from as many blocks at a time as keep its
+# per-pair arrays within block_bytes, and bands are spread over a process
+# pool and their sums added up. Difference images are written diff_group
+# pairs at a time, into 16-bit buffers in diff_dir, reading only the inputs
+# those pairs need, so the disk they take doesn't grow with N either.
+#
+
+import os
+import sys
+import json
+import time
+import itertools
+import multiprocessing
+import numpy
+import numpy.lib.format
+import stats
+import process_sum
+
+# 'count' or 'total', as above
+normalise = 'count'
+
+# Difference images of 'all' pairs, None, or a list of (name, name) pairs,
+# named by file without .npy
+diff_pairs = 'all'
+diff_prefix = 'diff-'
+diff_dir = 'diffs'
+diff_group = 16
+
+similarity_file = 'similarity.json'
+
+# Bytes of input rows (at float64, for all inputs together) per task
+block_bytes = 64 << 20
+
+ssim_block = 8
+processes = multiprocessing.cpu_count()
+
+# Set up by main() before the pool starts, so workers inherit them
+inputs = []
+factors = None
+ssim_constants = None
+arrays = {}
+
+def inputName(filename):
+    return os.path.splitext(os.path.basename(filename))[0]
+
+def normalisation(filenames, file_stats):
+    # Per-channel factor for each input, and SSIM's dynamic range: the
+    # largest normalised value of any of them
+    result = []
+    for f, st in zip(filenames, file_stats):
+        count = process_sum.imageCount(f)
+        if normalise == 'total' or not count:
+            if normalise != 'total':
+                print "No image count for %s, normalising by its total" % f
+            result.append(1 / numpy.maximum(numpy.array(st['mean']), 1e-300))
+        else:
+            result.append(numpy.full(len(st['mean']), 1.0 / count))
+    top = max((numpy.array(st['max']) * k).max() for st, k in zip(file_stats, result))
+    return numpy.array(result), top
+
+def openInput(i):
+    # Each worker memmaps every input once
+    if i not in arrays:
+        arrays[i] = numpy.load(inputs[i], mmap_mode='r')
+    return arrays[i]
+
+def readBand(y0, y1, which=None):
+    # Rows [y0, y1) of the inputs in 'which' (all by default), normalised, as
+    # one (len(which), rows, w, c) array
+    which = range(len(inputs)) if which is None else which
+    first = openInput(0)
+    band = numpy.empty((len(which), y1 - y0) + first.shape[1:])
+    for k, i in enumerate(which):
+        numpy.multiply(openInput(i)[y0:y1], factors[i], out=band[k])
+    return band
+
+def bandRows(shape, n=None):
+    # Rows per band of 'n' inputs (all by default), a multiple of the SSIM
+    # block size
+    row_bytes = (n or len(inputs)) * shape[1] * shape[2] * 8
+    rows = max(1, block_bytes // row_bytes) // ssim_block * ssim_block
+    return max(rows, ssim_block)
+
+def blockSsim(band):
+    # Sum over the band's whole 8x8 blocks of each pair's SSIM, per channel,
+    # and the number of blocks
+    n, h, w, channels = band.shape
+    b = ssim_block
+    h, w = h // b * b, w // b * b
+    c1, c2 = ssim_constants
+    total = numpy.zeros((n, n))
+    blocks = (h // b) * (w // b)
+    if not blocks:
+        return total, 0
+    # cov, num and den are (n, n, blocks), so take few enough blocks at a
+    # time to keep them within block_bytes
+    step = max(1, block_bytes // (4 * n * n * 8))
+    for c in range(channels):
+        x = band[:, :h, :w, c].reshape(n, h // b, b, w // b, b).transpose(0, 1, 3, 2, 4)
+        x = x.reshape(n, blocks, b * b)
+        for k in range(0, blocks, step):
+            xk = x[:, k:k+step]
+            mean = xk.mean(axis=2)
+            xk = xk - mean[:, :, None]
+            var = numpy.einsum('ibk,ibk->ib', xk, xk) / (b * b - 1)
+            cov = numpy.einsum('ibk,jbk->ijb', xk, xk) / (b * b - 1)
+            num = (2 * mean[:, None] * mean[None] + c1) * (2 * cov + c2)
+            den = (mean[:, None] ** 2 + mean[None] ** 2 + c1) * (var[:, None] + var[None] + c2)
+            total += (num / den).sum(axis=2)
+    return total / channels, blocks
+
+def bandStats(task):
+    # Partial sums for one band: per channel, each input's sum and the Gram
+    # matrix of all inputs; the SSIM block sums; and the largest absolute
+    # difference of each pair in diff_pairs
+    y0, y1, pairs = task
+    band = readBand(y0, y1)
+    n, channels = band.shape[0], band.shape[3]
+    sums = numpy.zeros((channels, n))
+    gram = numpy.zeros((channels, n, n))
+    for c in range(channels):
+        x = numpy.ascontiguousarray(band[..., c]).reshape(n, -1)
+        sums[c] = x.sum(axis=1)
+        gram[c] = numpy.dot(x, x.T)
+    ssim, blocks = blockSsim(band)
+    diff_max = [numpy.abs(band[i] - band[j]).max() for i, j in pairs]
+    return band[0].size // channels, sums, gram, ssim, blocks, diff_max
+
+def writeDiffBand(task):
+    # Difference images for one band, into memmapped .npy files
+    y0, y1, pairs, scales, paths = task
+    which = sorted(set(i for pair in pairs for i in pair))
+    band = readBand(y0, y1, which)
+    for (i, j), scale, path in zip(pairs, scales, paths):
+        d = band[which.index(i)] - band[which.index(j)]
+        d *= 0.5 / scale
+        d += 0.5
+        out = numpy.load(path, mmap_mode='r+')
+        process_sum.quantize(d, out=out[y0:y1])
+        out.flush()
+
+def correlation(pixels, sums, gram):
+    # Pearson correlation of each pair from the pooled sums, per channel,
+    # then averaged over channels
+    result = []
+    for s, g in zip(sums, gram):
+        mean = s / pixels
+        cov = g / pixels - numpy.outer(mean, mean)
+        sd = numpy.sqrt(numpy.maximum(numpy.diag(cov), 1e-300))
+        result.append(cov / numpy.outer(sd, sd))
+    return numpy.clip(numpy.mean(result, axis=0), -1, 1)
+
+def choosePairs(names):
+    if diff_pairs == 'all':
+        return list(itertools.combinations(range(len(names)), 2))
+    return [(names.index(a), names.index(b)) for a, b in diff_pairs or []]
+
+def printMatrix(title, names, m):
+    width = max(len(n) for n in names)
+    print title
+    print ' ' * width + ''.join(' %8s' % n[:8] for n in names)
+    for name, row in zip(names, m):
+        print name.rjust(width) + ''.join(' %8.4f' % v for v in row)
+
+def main():
+    global inputs, factors, ssim_constants
+    inputs = process_sum.batchInputs(sys.argv[1:] or ['.'])
+    if len(inputs) < 2:
+        print "Need at least two sum buffers to compare"
+        return
+    names = [inputName(f) for f in inputs]
+    shapes = set(numpy.load(f, mmap_mode='r').shape for f in inputs)
+    if len(shapes) > 1:
+        raise ValueError("sum buffers differ in shape: %s" % sorted(shapes))
+    shape = shapes.pop()
+
+    print "Comparing %d sum buffers" % len(inputs)
+    start = time.time()
+    factors, top = normalisation(inputs, [stats.fileStats(f) for f in inputs])
+    ssim_constants = (0.01 * top) ** 2, (0.03 * top) ** 2
+    pairs = choosePairs(names)
+
+    rows = bandRows(shape)
+    bands = [(y, min(y + rows, shape[0])) for y in range(0, shape[0], rows)]
+    pool = multiprocessing.Pool(processes)
+    try:
+        pixels = blocks = 0
+        sums = gram = ssim = 0
+        diff_max = numpy.zeros(len(pairs))
+        for part in pool.imap_unordered(bandStats, [(y0, y1, pairs) for y0, y1 in bands]):
+            pixels += part[0]
+            sums = sums + part[1]
+            gram = gram + part[2]
+            ssim = ssim + part[3]
+            blocks += part[4]
+            diff_max = numpy.maximum(diff_max, part[5])
+
+        if pairs and not os.path.isdir(diff_dir):
+            os.makedirs(diff_dir)
+        # Each pair scaled by its own largest difference, so 0 and 65535 are
+        # the biggest changes either way
+        scales = numpy.maximum(diff_max, 1e-300)
+        for g in range(0, len(pairs), diff_group):
+            group = pairs[g:g+diff_group]
+            paths = []
+            for i, j in group:
+                path = os.path.join(diff_dir, '%s%s-%s.npy.tmp' % (diff_prefix, names[i], names[j]))
+                numpy.lib.format.open_memmap(path, 'w+', numpy.uint16, shape)
+                paths.append(path)
+            try:
+                n = len(set(i for pair in group for i in pair))
+                rows = bandRows(shape, n)
+                pool.map(writeDiffBand, [(y, min(y + rows, shape[0]), group, scales[g:g+diff_group],
+                    paths) for y in range(0, shape[0], rows)])
+                for path in paths:
+                    filename = path[:-len('.npy.tmp')] + '.tiff'
+                    print "Writing %s" % filename
+                    process_sum.writeQuantized(filename, numpy.load(path, mmap_mode='r'))
+            finally:
+                for path in paths:
+                    os.remove(path)
+    finally:
+        pool.close()
+        pool.join()
+
+    corr = correlation(pixels, sums, gram)
+    ssim = ssim / max(blocks, 1)
+    printMatrix('Correlation', names, corr)
+    printMatrix('SSIM', names, ssim)
+    result = {
+        'inputs': inputs,
+        'normalise': normalise,
+        'correlation': corr.tolist(),
+        'ssim': ssim.tolist(),
+    }
+    json.dump(result, open(similarity_file, 'w'), indent=2)
+    print "Compared %d pairs in %.1fs" % (len(inputs) * (len(inputs) - 1) // 2, time.time() - start)
+
+
+if __name__ == '__main__':
+    main()
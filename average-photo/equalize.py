@@ -0,0 +1,158 @@
+#
+# Histogram equalisation of a sum, globally and adaptively (CLAHE).
+#
+# Both work on the same 16-bit bins as stats.tileHistogram(): each channel's
+# [min, max] cut into 65536 steps. Global equalisation maps every bin
+# through its channel's CDF. The adaptive version takes a histogram per cell
+# of a tiles[0] x tiles[1] grid, clips each one at clip_limit times its mean
+# bin count (spreading what's clipped off over all the bins, so no cell's
+# contrast is stretched more than that), and maps each pixel through the
+# CDFs of the four nearest cells, blended bilinearly by distance to their
+# centers, so there are no seams at cell edges. The cell histograms only
+# have clahe_bins bins, which keeps the 3 x 8 x 8 of them small; each CDF is
+# interpolated linearly within those bins (as if the values in a bin were
+# spread evenly over it) up to 16-bit tables for mapping the pixels.
+#
+# Either way it's two passes over the image whatever its size: one for the
+# histograms and one to apply the tables, both vectorised over rows of
+# pixels. The functions are pipeline tile functions, so they also run tiled.
+#
+
+import numpy
+import stats
+
+bins = stats.histogram_bins
+
+# Bins of each CLAHE cell histogram
+clahe_bins = 4096
+
+def binIndex(rows, lo, width, n):
+    # Histogram bin of each value of one channel
+    index = ((rows - lo) / width).astype(numpy.intp)
+    return numpy.clip(index, 0, n - 1, out=index)
+
+def equalizeLut(histogram):
+    # Each bin's position in its channel's CDF, counting half the bin itself,
+    # so the output is centred in [0, 1]
+    histogram = numpy.asarray(histogram, float)
+    cdf = numpy.cumsum(histogram, axis=-1)
+    cdf -= histogram / 2
+    cdf /= numpy.maximum(cdf[..., -1:] + histogram[..., -1:] / 2, 1)
+    return cdf
+
+def equalizeTile(s, image_stats, histogram, out=None):
+    # Map each pixel through its channel's CDF
+    if out is None:
+        out = numpy.empty(s.shape, float)
+    lut = equalizeLut(histogram)
+    lo, width = stats.binScale(image_stats, lut.shape[1])
+    step = stats.chunkRows(s)
+    for y in range(0, s.shape[0], step):
+        for c in range(s.shape[2]):
+            index = binIndex(s[y:y+step, :, c], lo[c], width[c], lut.shape[1])
+            out[y:y+step, :, c] = lut[c].take(index)
+    return out
+
+def cellIndex(coords, length, cells):
+    # The grid cell each pixel coordinate falls in
+    return numpy.minimum(coords * cells // length, cells - 1)
+
+def claheHistograms(s, image_stats, tiles=(8, 8), bins=clahe_bins, origin=(0, 0), frame=None,
+        halo=(0, 0)):
+    # Histograms of the grid cells this tile overlaps, as ((first cell row,
+    # first cell column), histograms), where histograms is (channels, cell
+    # rows, cell columns, bins). Rows of the tile that share a cell row are
+    # counted with one bincount per channel.
+    frame = frame or s.shape[:2]
+    gy, gx = tiles
+    lo, width = stats.binScale(image_stats, bins)
+    ys = cellIndex(numpy.arange(s.shape[0]) + origin[0] - halo[0], frame[0], gy)
+    xs = cellIndex(numpy.arange(s.shape[1]) + origin[1] - halo[1], frame[1], gx)
+    r0, c0 = ys[0], xs[0]
+    columns = xs[-1] - c0 + 1
+    hist = numpy.zeros((s.shape[2], ys[-1] - r0 + 1, columns, bins), numpy.int64)
+    offsets = ((xs - c0) * bins)[None, :]
+
+    # Every bincount allocates a count for each bin of each cell in the row,
+    # so take enough rows at a time to outweigh that
+    step = max(stats.chunkRows(s), 4 * columns * bins // s.shape[1])
+    for y in range(0, s.shape[0], step):
+        rows = ys[y:y+step]
+        for r in numpy.unique(rows):
+            band = s[y:y+step][rows == r]
+            for c in range(s.shape[2]):
+                index = binIndex(band[:, :, c], lo[c], width[c], bins)
+                index += offsets
+                hist[c, r - r0] += numpy.bincount(index.ravel(),
+                    minlength=columns * bins).reshape(columns, bins)
+    return (r0, c0), hist
+
+def combineClaheHistograms(parts):
+    shape = [max(origin[i] + part.shape[i + 1] for origin, part in parts) for i in range(2)]
+    hist = numpy.zeros((parts[0][1].shape[0],) + tuple(shape) + parts[0][1].shape[3:], numpy.int64)
+    for (r0, c0), part in parts:
+        hist[:, r0:r0 + part.shape[1], c0:c0 + part.shape[2]] += part
+    return hist
+
+def claheLuts(hist, clip_limit=3.0, size=bins):
+    # Clip each cell's histogram and turn it into a CDF table of 'size'
+    # entries, interpolated between the histogram's bin edges. The tables are
+    # stored as uint16, which is all the precision the output has. They're
+    # 25 MB for 3 x 8 x 8 cells, so tiled runs cache them and the tiles read
+    # them memmapped (see tiles.py).
+    n = hist.shape[-1]
+    hist = hist.astype(numpy.float32)
+    total = hist.sum(axis=-1, keepdims=True)
+    limit = numpy.maximum(clip_limit * total / n, 1)
+    numpy.minimum(hist, limit, out=hist)
+    hist += (total - hist.sum(axis=-1, keepdims=True)) / n
+    cdf = numpy.cumsum(hist, axis=-1, out=hist)
+
+    # Each entry's centre, in histogram bins, and the CDF at every bin edge
+    centres = (numpy.arange(size) + 0.5) * (float(n) / size)
+    edges = numpy.arange(n + 1)
+    lut = numpy.empty(hist.shape[:-1] + (size,), numpy.uint16)
+    for cell in numpy.ndindex(*hist.shape[:-1]):
+        top = max(float(cdf[cell][-1]), 1)
+        table = numpy.interp(centres, edges, numpy.concatenate(([0], cdf[cell])) * (0xFFFF / top))
+        lut[cell] = numpy.round(table)
+    return lut
+
+def cellWeights(coords, length, cells):
+    # The two nearest cell centres to each coordinate and the weight of the
+    # second, clamped at the outer cells' centres
+    f = (coords + 0.5) * cells / float(length) - 0.5
+    first = numpy.clip(numpy.floor(f).astype(numpy.intp), 0, cells - 1)
+    second = numpy.minimum(first + 1, cells - 1)
+    weight = numpy.clip(f - first, 0, 1).astype(numpy.float32)
+    return first, second, weight
+
+def claheTile(s, image_stats, luts, origin=(0, 0), frame=None, halo=(0, 0), out=None):
+    # Map each pixel through the tables of the four nearest cells
+    if out is None:
+        out = numpy.empty(s.shape, float)
+    frame = frame or s.shape[:2]
+    channels, gy, gx, n = luts.shape
+    flat = luts.ravel()
+    lo, width = stats.binScale(image_stats, n)
+    y0, y1, wy = cellWeights(numpy.arange(s.shape[0]) + origin[0] - halo[0], frame[0], gy)
+    x0, x1, wx = cellWeights(numpy.arange(s.shape[1]) + origin[1] - halo[1], frame[1], gx)
+    wx = wx[None, :]
+
+    step = stats.chunkRows(s)
+    for y in range(0, s.shape[0], step):
+        rows = slice(y, y + step)
+        wyr = wy[rows, None]
+        for c in range(channels):
+            index = binIndex(s[rows, :, c], lo[c], width[c], n)
+
+            def corner(cy, cx):
+                return flat.take(((c * gy + cy[rows, None]) * gx + cx[None, :]) * n + index)
+
+            top = corner(y0, x0) * (1 - wx) + corner(y0, x1) * wx
+            bottom = corner(y1, x0) * (1 - wx) + corner(y1, x1) * wx
+            top *= 1 - wyr
+            bottom *= wyr
+            top += bottom
+            out[rows, :, c] = top / 0xFFFF
+    return out
@@ -0,0 +1,14 @@
+#
+# Small file helpers shared by the long-running jobs and the pipeline.
+#
+
+import os
+
+def writeAtomic(filename, data):
+    # Write to a temporary file and rename over the target, so readers never
+    # see a partially written file. The pid keeps processes sharing a
+    # directory from writing the same temporary file.
+    tmp = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(data)
+    os.rename(tmp, filename)
@@ -0,0 +1,127 @@
+#
+# Live metrics for long-running summing jobs.
+#
+# Workers bump a couple of shared counters per image, and everything else
+# is reported once per batch, so the cost per image stays constant. The
+# runner periodically writes a snapshot atomically as a JSON status file
+# and/or a Prometheus textfile, and can serve the same thing over HTTP.
+#
+
+import json, time, threading, multiprocessing
+from fileio import writeAtomic
+
+class Metrics(object):
+    def __init__(self):
+        self.start_time = time.time()
+        self.last_checkpoint = None
+        self.queue_depth = 0
+        self.failures = {}
+        self.worker_rss = {}
+        self.lock = threading.Lock()
+
+        # Images and bytes read, shared with the worker processes
+        self.progress = multiprocessing.Array('d', 2)
+
+    def addBatch(self, stats_list, queue_depth):
+        # Fold in the per-batch stats returned by each worker
+        with self.lock:
+            self.queue_depth = queue_depth
+            for stats in stats_list:
+                self.worker_rss[stats['pid']] = stats['rss']
+                for name, n in stats['failures'].items():
+                    self.failures[name] = self.failures.get(name, 0) + n
+
+    def checkpoint(self):
+        with self.lock:
+            self.last_checkpoint = time.time()
+
+    def snapshot(self):
+        now = time.time()
+        elapsed = max(now - self.start_time, 1e-6)
+        images, nbytes = self.progress[:]
+
+        with self.lock:
+            attempted = images + sum(self.failures.values())
+            return {
+                'uptime_seconds': elapsed,
+                'images_total': int(images),
+                'bytes_total': int(nbytes),
+                'images_per_second': images / elapsed,
+                'bytes_per_second': nbytes / elapsed,
+                'failures_total': dict(self.failures),
+                'failure_rate': dict((name, n / max(attempted, 1.0))
+                    for name, n in self.failures.items()),
+                'queue_depth': self.queue_depth,
+                'checkpoint_age_seconds': self.last_checkpoint and now - self.last_checkpoint,
+                'worker_max_rss_bytes': dict(self.worker_rss),
+            }
+
+    def formatPrometheus(self, snap=None):
+        snap = snap or self.snapshot()
+        lines = []
+
+        def metric(name, kind, value, labels=''):
+            if not any(l.startswith('# TYPE %s ' % name) for l in lines):
+                lines.append('# TYPE %s %s' % (name, kind))
+            lines.append('%s%s %r' % (name, labels, float(value)))
+
+        metric('sum_images_uptime_seconds', 'gauge', snap['uptime_seconds'])
+        metric('sum_images_images_total', 'counter', snap['images_total'])
+        metric('sum_images_bytes_total', 'counter', snap['bytes_total'])
+        metric('sum_images_images_per_second', 'gauge', snap['images_per_second'])
+        metric('sum_images_bytes_per_second', 'gauge', snap['bytes_per_second'])
+        for name, n in sorted(snap['failures_total'].items()):
+            metric('sum_images_failures_total', 'counter', n, '{type="%s"}' % name)
+        for name, rate in sorted(snap['failure_rate'].items()):
+            metric('sum_images_failure_rate', 'gauge', rate, '{type="%s"}' % name)
+        metric('sum_images_queue_depth', 'gauge', snap['queue_depth'])
+        if snap['checkpoint_age_seconds'] is not None:
+            metric('sum_images_checkpoint_age_seconds', 'gauge', snap['checkpoint_age_seconds'])
+        for pid, rss in sorted(snap['worker_max_rss_bytes'].items()):
+            metric('sum_images_worker_max_rss_bytes', 'gauge', rss, '{pid="%d"}' % pid)
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, json_file=None, prometheus_file=None):
+        snap = self.snapshot()
+        if json_file:
+            writeAtomic(json_file, json.dumps(snap, indent=2, sort_keys=True))
+        if prometheus_file:
+            writeAtomic(prometheus_file, self.formatPrometheus(snap))
+
+    def startWriter(self, interval, json_file=None, prometheus_file=None):
+        # Rewrite the status files every few seconds from a background thread
+        def loop():
+            while True:
+                self.write(json_file, prometheus_file)
+                time.sleep(interval)
+
+        t = threading.Thread(target=loop)
+        t.daemon = True
+        t.start()
+
+    def startServer(self, port, host='127.0.0.1'):
+        # Serve /metrics in Prometheus format, anything else as JSON
+        import BaseHTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.startswith('/metrics'):
+                    body, kind = metrics.formatPrometheus(), 'text/plain; version=0.0.4'
+                else:
+                    body, kind = json.dumps(metrics.snapshot(), indent=2, sort_keys=True), 'application/json'
+                self.send_response(200)
+                self.send_header('Content-Type', kind)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = BaseHTTPServer.HTTPServer((host, port), Handler)
+        t = threading.Thread(target=server.serve_forever)
+        t.daemon = True
+        t.start()
+        return server
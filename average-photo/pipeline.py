@@ -0,0 +1,335 @@
+#
+# A small memoising DAG for post-processing.
+#
+# Each stage has a name, a function, the stages it reads, and parameters. A
+# stage's key is a hash of its name, its parameters and its inputs' keys, all
+# the way back to the source, so changing one parameter only invalidates that
+# stage and whatever is downstream of it.
+#
+# Stages marked for caching are saved as .npy files in cache_dir, and evicted
+# least-recently-used first to keep the directory under cache_limit bytes.
+# Outputs (the files we actually want) remember the key they were written
+# with, so running the pipeline again only recomputes outputs that were
+# requested and are stale, and only the stages those outputs need. An output
+# function can write in the background by returning something with a get()
+# method, like an AsyncResult; run() waits on it before recording the output.
+#
+# Map and reduce stages are written in terms of tiles (see tiles.py). Without
+# an executor each one runs on the whole frame as a single tile; with one,
+# they run tile by tile and map results live in memmapped files, so frames
+# much larger than RAM can go through the same graph.
+#
+
+import os
+import json
+import fcntl
+import hashlib
+import cPickle
+import tempfile
+import contextlib
+import numpy
+import fileio
+
+def hashArray(a, chunk_bytes=64 << 20):
+    # Content hash of an array, including its shape and type
+    h = hashlib.sha1(repr((a.shape, a.dtype.str)))
+    flat = a.reshape(-1)
+    step = max(1, chunk_bytes // max(a.itemsize, 1))
+    for i in range(0, flat.size, step):
+        h.update(numpy.ascontiguousarray(flat[i:i+step]).data)
+    return h.hexdigest()
+
+@contextlib.contextmanager
+def noContext(name):
+    yield
+
+class Node(object):
+    def __init__(self, name, func, inputs, params, cache=False, inplace=None, filename=None, kind='stage'):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.params = params
+        self.cache = cache
+        self.inplace = inplace
+        self.filename = filename
+        self.kind = kind
+        self.key = None
+
+        # Only used by map and reduce stages
+        self.allocate = None
+        self.dtype = None
+        self.halo = 0
+        self.region = None
+        self.combine = None
+        self.positional = False
+
+class Pipeline(object):
+    def __init__(self, cache_dir=None, cache_limit=4 << 30, stage_context=None, executor=None):
+        self.cache_dir = cache_dir
+        self.cache_limit = cache_limit
+        self.stage_context = stage_context or noContext
+        self.executor = executor
+        self.work_dir = None
+        self.work_files = {}
+        self.nodes = []
+        self.by_name = {}
+        self.values = {}
+
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def add(self, node):
+        if node.name in self.by_name:
+            raise ValueError("duplicate stage %r" % node.name)
+        h = hashlib.sha1(repr((node.name, node.filename, sorted(node.params.items()), node.kind,
+            node.dtype and numpy.dtype(node.dtype).str, node.halo, node.region)))
+        for name in node.inputs:
+            h.update(self.by_name[name].key)
+        node.key = node.key or h.hexdigest()
+        self.nodes.append(node)
+        self.by_name[node.name] = node
+        return node
+
+    def source(self, name, value, key=None):
+        # An input to the pipeline, keyed by its content unless a key is given
+        node = Node(name, None, (), {})
+        node.key = key or hashArray(value)
+        self.values[name] = value
+        return self.add(node)
+
+    def stage(self, name, func, inputs=(), cache=False, inplace=None, **params):
+        # func(*input_values, **params). If 'inplace' names an input and this
+        # stage is the last one to need it, func also gets out=<that input>.
+        return self.add(Node(name, func, inputs, params, cache, inplace))
+
+    def map(self, name, func, inputs=(), dtype=float, halo=0, cache=False, inplace=None,
+            positional=False, allocate=None, **params):
+        # func(*input_tiles, out=<tile of dtype>, **params), where each output
+        # pixel depends on input pixels at most 'halo' away (a radius, or a
+        # (rows, columns) pair). Inputs that aren't frame-sized arrays are
+        # passed whole. With 'positional', func also gets origin, frame and
+        # halo keywords saying where its tile is. Whole-frame outputs come
+        # from allocate(shape, dtype) if given.
+        node = Node(name, func, inputs, params, cache, inplace, kind='map')
+        node.allocate = allocate
+        node.dtype = dtype
+        node.halo = halo
+        node.positional = positional
+        return self.add(node)
+
+    def reduce(self, name, func, combine, inputs=(), halo=0, region=None, positional=False, **params):
+        # combine(list of func(*input_tiles, **params)) over the tiles of
+        # 'region' = (y0, y1, x0, x1), or of the whole frame
+        node = Node(name, func, inputs, params, kind='reduce')
+        node.combine = combine
+        node.halo = halo
+        node.region = region
+        node.positional = positional
+        return self.add(node)
+
+    def output(self, filename, func, inputs=(), inplace=None, **params):
+        # func(filename, *input_values, **params) writes 'filename'
+        return self.add(Node(filename, func, inputs, params, inplace=inplace, filename=filename))
+
+    def outputs(self):
+        return [n.name for n in self.nodes if n.filename]
+
+    def run(self, outputs=None):
+        # Write the requested outputs (all of them by default) that are stale.
+        # Stages that aren't outputs can be requested too; their values are
+        # returned, by name.
+        manifest = self.loadManifest()
+        wanted = set(outputs if outputs is not None else self.outputs())
+        for name in wanted:
+            if name not in self.by_name:
+                raise KeyError("unknown output %r" % name)
+
+        # Plan: which nodes to compute, which to load from cache, and how many
+        # pending consumers each value has, so we can free it after its last use.
+        consumers = {}
+        plan = {}
+
+        def need(name):
+            consumers[name] = consumers.get(name, 0) + 1
+            if name in plan:
+                return
+            node = self.by_name[name]
+            if name in self.values:
+                plan[name] = 'have'
+            elif node.cache and self.cache_dir and os.path.exists(self.cachePath(node)):
+                plan[name] = 'load'
+            else:
+                plan[name] = 'compute'
+                for i in set(node.inputs):
+                    need(i)
+
+        for node in self.nodes:
+            if node.name in wanted and not node.filename:
+                need(node.name)
+            elif node.name in wanted:
+                fresh = (manifest.get(node.filename) == node.key and os.path.exists(node.filename))
+                if fresh:
+                    print "Up to date: %s" % node.filename
+                else:
+                    plan[node.name] = 'compute'
+                    for i in set(node.inputs):
+                        need(i)
+
+        pending = []
+        for node in self.nodes:
+            action = plan.get(node.name)
+            if action == 'load':
+                print "Loading %s from cache" % node.name
+                self.values[node.name] = self.loadCache(node)
+            elif action == 'compute':
+                with self.stage_context(node.name):
+                    result = self.compute(node, consumers)
+                if node.filename and hasattr(result, 'get'):
+                    pending.append((node, result))
+                elif node.filename:
+                    self.recordOutput(manifest, node)
+
+                for name in set(node.inputs):
+                    consumers[name] -= 1
+                    if not consumers[name] and self.by_name[name].func:
+                        self.release(name)
+
+        for node, result in pending:
+            result.get()
+            self.recordOutput(manifest, node)
+
+        if self.executor:
+            self.executor.close()
+        return dict((name, self.values[name]) for name in wanted if not self.by_name[name].filename)
+
+    def release(self, name):
+        del self.values[name]
+        if name in self.work_files:
+            os.remove(self.work_files.pop(name))
+
+    def compute(self, node, consumers):
+        args = [self.values[name] for name in node.inputs]
+        params = dict(node.params)
+        if (node.inplace and consumers.get(node.inplace) == 1 and self.by_name[node.inplace].func
+                and not self.executor):
+            params['out'] = self.values[node.inplace]
+
+        if node.filename:
+            return node.func(node.filename, *args, **params)
+
+        if node.kind == 'map' and self.executor:
+            print "Computing %s in tiles" % node.name
+            path = self.cachePath(node) if node.cache and self.cache_dir else self.workPath(node)
+            value = self.executor.map(node.func, args, path, node.dtype, node.halo,
+                node.positional, **params)
+            self.values[node.name] = value
+            if node.cache and self.cache_dir:
+                self.evict()
+            else:
+                self.work_files[node.name] = path
+            return
+
+        if node.kind == 'map':
+            frame = [a for a in args if isinstance(a, numpy.ndarray)][0].shape
+            if 'out' not in params:
+                params['out'] = (node.allocate or numpy.empty)(frame, node.dtype)
+            if node.positional:
+                params.update(origin=(0, 0), frame=frame[:2], halo=(0, 0))
+            value = node.func(*args, **params)
+        elif node.kind == 'reduce' and self.executor:
+            value = self.executor.reduce(node.func, node.combine, args, node.halo, node.region,
+                node.positional, **params)
+        elif node.kind == 'reduce':
+            # The whole frame (or region) is one tile
+            frame = [a for a in args if isinstance(a, numpy.ndarray)][0].shape[:2]
+            y0, y1, x0, x1 = node.region or (0, frame[0], 0, frame[1])
+            args = [a[y0:y1, x0:x1] if isinstance(a, numpy.ndarray) and a.shape[:2] == frame else a
+                for a in args]
+            if node.positional:
+                params.update(origin=(y0, x0), frame=frame, halo=(0, 0))
+            value = node.combine([node.func(*args, **params)])
+        else:
+            value = node.func(*args, **params)
+
+        self.values[node.name] = value
+        if node.cache:
+            self.saveCache(node, value)
+            if self.executor and isinstance(value, numpy.ndarray) and self.cache_dir:
+                # Tiles read it from the cache file rather than each getting
+                # a pickled copy
+                self.values[node.name] = numpy.load(self.cachePath(node), mmap_mode='r')
+
+    def workPath(self, node):
+        # Uncached map results in tiled mode, removed once they're consumed
+        if self.work_dir is None:
+            self.work_dir = self.cache_dir or tempfile.mkdtemp(prefix='pipeline-')
+        return os.path.join(self.work_dir, '%s-%s.work' % (node.name, node.key))
+
+    def cachePath(self, node):
+        return os.path.join(self.cache_dir, '%s-%s.npy' % (node.name, node.key))
+
+    def loadCache(self, node):
+        # Touch the entry so eviction sees it as recently used
+        path = self.cachePath(node)
+        os.utime(path, None)
+        value = numpy.load(path, mmap_mode='r' if self.executor else None)
+        if value.ndim == 0 and value.dtype.kind == 'S':
+            return cPickle.loads(value.item())
+        return value
+
+    def saveCache(self, node, value):
+        if not self.cache_dir:
+            return
+        path = self.cachePath(node)
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            if isinstance(value, numpy.ndarray):
+                numpy.save(f, value)
+            else:
+                # Anything that isn't an array is pickled into a 0-d string array
+                numpy.save(f, numpy.array(cPickle.dumps(value, 2)))
+        os.rename(tmp, path)
+        self.evict()
+
+    def evict(self):
+        # Drop least recently used entries until we're under the size cap,
+        # except those we're still using (tiled stages reopen them by name)
+        live = set(os.path.basename(self.cachePath(self.by_name[name])) for name in self.values)
+        entries = []
+        total = 0
+        for f in os.listdir(self.cache_dir):
+            if f.endswith('.npy'):
+                st = os.stat(os.path.join(self.cache_dir, f))
+                total += st.st_size
+                if f not in live:
+                    entries.append((st.st_mtime, st.st_size, f))
+        entries.sort()
+        while entries and total > self.cache_limit:
+            mtime, size, f = entries.pop(0)
+            print "Evicting %s from cache" % f
+            os.remove(os.path.join(self.cache_dir, f))
+            total -= size
+
+    def manifestPath(self):
+        return os.path.join(self.cache_dir, 'outputs.json')
+
+    def loadManifest(self):
+        if self.cache_dir and os.path.exists(self.manifestPath()):
+            return json.load(open(self.manifestPath()))
+        return {}
+
+    def recordOutput(self, manifest, node):
+        # Several processes can share a cache_dir (see process_sum's batch
+        # mode), so merge into the manifest on disk under a lock rather than
+        # overwriting it with our copy
+        manifest[node.filename] = node.key
+        if self.cache_dir:
+            with open(self.manifestPath() + '.lock', 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                current = self.loadManifest()
+                current[node.filename] = node.key
+                self.saveManifest(current)
+
+    def saveManifest(self, manifest):
+        if self.cache_dir:
+            fileio.writeAtomic(self.manifestPath(), json.dumps(manifest, indent=2, sort_keys=True))
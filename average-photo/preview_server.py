@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+#
+# Interactive previews, for tuning the scaling, blur and gamma of
+# process_sum's outputs without rerunning it on the whole sum each time.
+#
+#   python preview_server.py [sum.npy] [port]
+#
+# The sum is opened once, memmapped, and box-filtered down to a mip pyramid
+# held in memory, from mip_max_size pixels on a side downwards. Its stats come
+# from the sidecar (see stats.fileStats). A view is sampled from the smallest
+# level with at least one pixel per output pixel, so screen-sized renders
+# take a few tens of milliseconds. The lowpass for high-pass views is blurred
+# on the coarsest level where sigma is still blur_min_sigma pixels, cached per
+# sigma, and interpolated back up.
+#
+#   GET /render?...                   the view as an image
+#   POST /export ...&filename=x.tiff  queue a full resolution 16-bit TIFF of
+#                                     the view, rendered in the background
+#   GET /exports                      JSON status of the queued exports
+#   GET /stats                        JSON stats of the sum
+#
+# Export parameters go in the form-encoded POST body (or the query string).
+# The filename must be a plain .tif/.tiff name; exports are only ever written
+# to export_dir. Requests from another origin are refused, so a web page
+# can't queue exports through the user's browser.
+#
+# View parameters, all optional:
+#
+#   mode      scaling, as in stats.statsRange() (default channel-minmax)
+#   low, high percentiles for mode=percentile (default process_sum's)
+#   sigma     lowpass sigma as a fraction of the sum's width, like the 0.03
+#             process_sum uses. If set, the view is the high-pass image,
+#             scaled to its center like the highpass-center output.
+#   square    1 to square the high-pass image, like highpass-sq-center
+#   gamma     output gamma (default none)
+#   region    x0,y0,x1,y1 in sum pixels (default the whole sum)
+#   width     output width in pixels (default 1024); height follows
+#   format    bmp (default), png or jpeg
+#
+# The high-pass range is measured once per setting on a small render of the
+# whole frame, so it doesn't change as you pan and zoom, and exports use the
+# same range as the previews.
+#
+
+import os
+import sys
+import json
+import time
+import Queue
+import urlparse
+import threading
+import BaseHTTPServer
+from cStringIO import StringIO
+import numpy
+import numpy.lib.format
+import Image
+import blur
+import stats
+import process_sum
+
+port = 8000
+
+# Largest level held in memory, on its longest side. Views that need more
+# detail than this are sampled straight from the memmapped sum.
+mip_max_size = 4096
+
+# Views from the memmapped sum read at most this many sum pixels per output
+# pixel; beyond that we use the largest in-memory level instead.
+max_read_ratio = 16
+
+# The lowpass is blurred on the coarsest level where sigma is at least this
+# many pixels
+blur_min_sigma = 4.0
+
+# Width of the whole-frame render the high-pass range is measured on
+range_width = 512
+
+default_width = 1024
+
+# Encoder options for each output format. BMP is the default: it's lossless
+# and takes a few milliseconds, where PNG takes over 100 ms at 1024x1024, and
+# the bytes only go over the loopback interface.
+image_formats = {
+    'BMP': {},
+    'PNG': {'compress_level': 1},
+    'JPEG': {'quality': 95},
+}
+
+# Exports are rendered this many rows at a time
+export_rows = 512
+
+# Exports are written here, relative to the directory the server starts in
+export_dir = 'exports'
+
+def boxDownsample(a, factor):
+    # Mean of each factor x factor block, a few block rows at a time so 'a'
+    # can be memmapped. Pixels past the last whole block are dropped.
+    h, w = a.shape[0] // factor, a.shape[1] // factor
+    out = numpy.empty((h, w) + a.shape[2:], numpy.float32)
+    step = max(1, stats.chunk_bytes * 16 // max(a[:factor].nbytes, 1))
+    for y in range(0, h, step):
+        rows = numpy.asarray(a[y*factor:min(y + step, h)*factor, :w*factor], numpy.float32)
+        n = rows.shape[0] // factor
+        out[y:y+n] = rows.reshape((n, factor, w, factor) + a.shape[2:]).mean(axis=(1, 3))
+    return out
+
+def parseView(query):
+    # View parameters from a query string, with defaults filled in
+    q = dict((k, v[-1]) for k, v in urlparse.parse_qs(query).items())
+    view = {
+        'mode': q.get('mode', 'channel-minmax'),
+        'low': float(q.get('low', process_sum.percentile_range[0])),
+        'high': float(q.get('high', process_sum.percentile_range[1])),
+        'sigma': float(q.get('sigma', 0)),
+        'square': q.get('square', '0') not in ('', '0'),
+        'gamma': float(q['gamma']) if q.get('gamma') else None,
+        'width': int(q.get('width', default_width)),
+        'region': None,
+        'format': q.get('format', 'bmp').upper(),
+        'filename': q.get('filename'),
+    }
+    if view['format'] not in image_formats:
+        raise ValueError("unknown format %r" % view['format'])
+    if view['width'] <= 0:
+        raise ValueError("width must be positive, not %d" % view['width'])
+    if view['sigma'] < 0:
+        raise ValueError("sigma must not be negative")
+    if q.get('region'):
+        view['region'] = tuple(int(v) for v in q['region'].split(','))
+        if len(view['region']) != 4:
+            raise ValueError("region must be x0,y0,x1,y1")
+        x0, y0, x1, y1 = view['region']
+        if x0 < 0 or y0 < 0 or x1 <= x0 or y1 <= y0:
+            raise ValueError("region %s is empty or negative" % q['region'])
+    return view
+
+def exportPath(filename):
+    # 'filename' inside export_dir, refusing anything but a plain TIFF name
+    if not filename:
+        raise ValueError("export needs a filename")
+    if ('/' in filename or '\\' in filename or '\0' in filename
+            or filename.startswith('.')
+            or os.path.splitext(filename)[1].lower() not in ('.tif', '.tiff')):
+        raise ValueError("export filename must be a plain .tif or .tiff name, not %r" % filename)
+    return os.path.join(os.path.abspath(export_dir), filename)
+
+def sampleGrid(region, shape, f):
+    # Coordinates in a level with 1/f scale of the output pixel centers over
+    # 'region' of the sum
+    x0, y0, x1, y1 = region
+    ys = (y0 + (numpy.arange(shape[0]) + 0.5) * float(y1 - y0) / shape[0]) / f
+    xs = (x0 + (numpy.arange(shape[1]) + 0.5) * float(x1 - x0) / shape[1]) / f
+    return ys, xs
+
+def interpolate(a, coords):
+    # 'a' linearly interpolated at fractional positions along axis 0, with
+    # the edge values repeated beyond either end
+    coords = numpy.clip(coords, 0, a.shape[0] - 1)
+    i = numpy.minimum(coords.astype(int), max(a.shape[0] - 2, 0))
+    w = (coords - i).astype(numpy.float32).reshape((-1,) + (1,) * (a.ndim - 1))
+    out = a[i] * (1 - w)
+    out += a[numpy.minimum(i + 1, a.shape[0] - 1)] * w
+    return out
+
+def scaleInPlace(v, value_range):
+    # process_sum.scaleRange() for a float32 view, without going through
+    # float64
+    lo, hi = (numpy.asarray(x, numpy.float32) for x in value_range)
+    v -= lo
+    v *= 1 / (hi - lo)
+    return v
+
+class Preview(object):
+    def __init__(self, filename):
+        print "Loading %s" % filename
+        self.sum = numpy.load(filename, mmap_mode='r')
+        self.stats = stats.fileStats(filename, self.sum)
+        self.histogram = numpy.array(self.stats['histogram'])
+        self.width = self.sum.shape[1]
+
+        # levels[k] is the sum at 1/2**k scale. Level 0 is the memmapped sum
+        # itself; the others start at the first one within mip_max_size.
+        start = time.time()
+        self.levels = {0: self.sum}
+        k = 0
+        while max(self.sum.shape[:2]) >> k > mip_max_size:
+            k += 1
+        if k:
+            self.levels[k] = boxDownsample(self.sum, 1 << k)
+        self.first_level = k
+        while min(self.levels[k].shape[:2]) > 1:
+            self.levels[k + 1] = boxDownsample(self.levels[k], 2)
+            k += 1
+        print "Built %d mip levels in %.1fs" % (len(self.levels) - 1, time.time() - start)
+
+        self.lowpass_cache = {}
+        self.range_cache = {}
+        self.lock = threading.Lock()
+        self.exports = []
+        self.queue = Queue.Queue()
+        t = threading.Thread(target=self.exportLoop)
+        t.daemon = True
+        t.start()
+
+    def region(self, view):
+        if view['region'] and (view['region'][2] > self.sum.shape[1]
+                or view['region'][3] > self.sum.shape[0]):
+            raise ValueError("region %s is outside the %dx%d sum" % (view['region'],
+                self.sum.shape[1], self.sum.shape[0]))
+        return view['region'] or (0, 0, self.sum.shape[1], self.sum.shape[0])
+
+    def outputShape(self, region, width):
+        x0, y0, x1, y1 = region
+        return max(1, int(round(width * float(y1 - y0) / (x1 - x0)))), width
+
+    def chooseLevel(self, region, shape):
+        # The coarsest level with a pixel per output pixel, or the memmapped
+        # sum if that's not too much to read
+        x0, y0, x1, y1 = region
+        scale = min(float(x1 - x0) / shape[1], float(y1 - y0) / shape[0])
+        k = 0
+        while k + 1 in self.levels and scale >= 2 ** (k + 1):
+            k += 1
+        if k < self.first_level:
+            if (x1 - x0) * (y1 - y0) <= max_read_ratio * shape[0] * shape[1]:
+                return 0
+            return self.first_level
+        return k
+
+    def sample(self, level, region, shape):
+        # Nearest level pixel to each output pixel, reading only the part of
+        # the level that the region covers
+        a = self.levels[level]
+        ys, xs = sampleGrid(region, shape, 1 << level)
+        ys = numpy.clip(ys.astype(int), 0, a.shape[0] - 1)
+        xs = numpy.clip(xs.astype(int), 0, a.shape[1] - 1)
+        crop = numpy.asarray(a[ys[0]:ys[-1] + 1, xs[0]:xs[-1] + 1], numpy.float32)
+        return crop[(ys - ys[0])[:, None], xs - xs[0]]
+
+    def lowpass(self, sigma):
+        # (level, blurred level) for a sigma given as a fraction of the width
+        with self.lock:
+            if sigma not in self.lowpass_cache:
+                pixels = sigma * self.width
+                k = self.first_level
+                while k + 1 in self.levels and pixels / 2 ** (k + 1) >= blur_min_sigma:
+                    k += 1
+                self.lowpass_cache[sigma] = k, blur.gaussianBlur(self.levels[k], pixels / 2 ** k)
+            return self.lowpass_cache[sigma]
+
+    def sampleLowpass(self, sigma, region, shape):
+        # The lowpass at each output pixel, interpolated bilinearly: the
+        # output grid is regular, so one axis at a time. Columns go first,
+        # while there are still only as many rows as the blurred level has.
+        level, blurred = self.lowpass(sigma)
+        ys, xs = sampleGrid(region, shape, 1 << level)
+        columns = interpolate(numpy.moveaxis(blurred, 1, 0), xs - 0.5)
+        return interpolate(numpy.ascontiguousarray(numpy.moveaxis(columns, 0, 1)), ys - 0.5)
+
+    def scaled(self, view, region, shape, level):
+        # The view before any high-pass range is applied. The lowpass is
+        # subtracted before scaling, which cancels the offset.
+        value_range = stats.statsRange(self.stats, view['mode'], self.histogram,
+            (view['low'], view['high']))
+        v = self.sample(level, region, shape)
+        if view['sigma']:
+            v -= self.sampleLowpass(view['sigma'], region, shape)
+            v = scaleInPlace(v, (0, numpy.subtract(*value_range[::-1])))
+            if view['square']:
+                v *= v
+            return v
+        return scaleInPlace(v, value_range)
+
+    def highpassRange(self, view):
+        # Center range of the high-pass image, from a small render of the
+        # whole frame
+        key = (view['mode'], view['low'], view['high'], view['sigma'], view['square'])
+        if key not in self.range_cache:
+            region = self.region(dict(view, region=None))
+            shape = self.outputShape(region, min(range_width, self.width))
+            v = self.scaled(view, region, shape, self.chooseLevel(region, shape))
+            hp_stats = stats.computeStats(v, histogram=False)
+            self.range_cache[key] = stats.statsRange(hp_stats, 'center-minmax')
+        return self.range_cache[key]
+
+    def render(self, view, region, shape, level=None):
+        # The view in [0, 1], at 'shape' over 'region' of the sum
+        if level is None:
+            level = self.chooseLevel(region, shape)
+        v = self.scaled(view, region, shape, level)
+        if view['sigma']:
+            v = scaleInPlace(v, self.highpassRange(view))
+        return v
+
+    def renderImage(self, view):
+        region = self.region(view)
+        shape = self.outputShape(region, view['width'])
+        q = process_sum.quantize(self.render(view, region, shape), view['gamma'], dtype=numpy.uint8)
+        f = StringIO()
+        Image.fromarray(q).save(f, view['format'], **image_formats[view['format']])
+        return f.getvalue(), 'image/' + view['format'].lower()
+
+    def export(self, view):
+        # Render at one output pixel per sum pixel, a strip at a time, into a
+        # memmapped 16-bit buffer, then write that out as the TIFF
+        x0, y0, x1, y1 = self.region(view)
+        filename = exportPath(view['filename'])
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        tmp = filename + '.npy.tmp'
+        q = numpy.lib.format.open_memmap(tmp, 'w+', numpy.uint16,
+            (y1 - y0, x1 - x0) + self.sum.shape[2:])
+        try:
+            for y in range(y0, y1, export_rows):
+                strip = (x0, y, x1, min(y + export_rows, y1))
+                v = self.render(view, strip, (strip[3] - y, x1 - x0), level=0)
+                process_sum.quantize(v, view['gamma'], out=q[y - y0:strip[3] - y0])
+            process_sum.writeQuantized(filename, q)
+        finally:
+            del q
+            os.remove(tmp)
+
+    def queueExport(self, view):
+        exportPath(view['filename'])
+        self.region(view)
+        job = {'id': len(self.exports), 'filename': view['filename'], 'state': 'queued'}
+        self.exports.append(job)
+        self.queue.put((job, view))
+        return job
+
+    def exportLoop(self):
+        while True:
+            job, view = self.queue.get()
+            job['state'] = 'running'
+            start = time.time()
+            try:
+                self.export(view)
+                job['state'] = 'done'
+            except Exception as e:
+                job['state'] = 'failed'
+                job['error'] = str(e)
+            job['seconds'] = round(time.time() - start, 1)
+            print "Export %s %s" % (job['filename'], job['state'])
+
+def startServer(preview, port, host='127.0.0.1'):
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        def crossOrigin(self):
+            # Browsers send Origin on cross-site requests; only our own pages
+            # (or clients that send none, like curl) get through
+            origin = self.headers.getheader('Origin')
+            if origin and urlparse.urlparse(origin).netloc != self.headers.getheader('Host'):
+                self.send_error(403, "cross-origin request")
+                return True
+            return False
+
+        def do_POST(self):
+            path, _, query = self.path.partition('?')
+            if self.crossOrigin():
+                return
+            if path != '/export':
+                self.send_error(404 if path not in ('/render', '/exports', '/stats') else 405)
+                return
+            length = int(self.headers.getheader('Content-Length') or 0)
+            form = self.rfile.read(length)
+            try:
+                view = parseView('&'.join(q for q in (query, form) if q))
+                body = json.dumps(preview.queueExport(view))
+            except (ValueError, KeyError) as e:
+                self.send_error(400, str(e))
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path, _, query = self.path.partition('?')
+            if self.crossOrigin():
+                return
+            try:
+                if path == '/render':
+                    start = time.time()
+                    body, kind = preview.renderImage(parseView(query))
+                    elapsed = time.time() - start
+                elif path == '/export':
+                    self.send_error(405, "export is a POST")
+                    return
+                elif path == '/exports':
+                    body, kind = json.dumps(preview.exports, indent=2), 'application/json'
+                elif path == '/stats':
+                    summary = dict((k, v) for k, v in preview.stats.items() if k != 'histogram')
+                    body, kind = json.dumps(summary, indent=2, sort_keys=True), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+            except (ValueError, KeyError) as e:
+                self.send_error(400, str(e))
+                return
+
+            self.send_response(200)
+            self.send_header('Content-Type', kind)
+            self.send_header('Content-Length', str(len(body)))
+            if path == '/render':
+                self.send_header('X-Render-Time', '%.1f ms' % (elapsed * 1000))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return BaseHTTPServer.HTTPServer((host, port), Handler)
+
+def main():
+    filename = sys.argv[1] if len(sys.argv) > 1 else 'sum.npy'
+    server = startServer(Preview(filename), int(sys.argv[2]) if len(sys.argv) > 2 else port)
+    print "Serving previews on http://127.0.0.1:%d/render" % server.server_port
+    print "Exports are written to %s" % os.path.abspath(export_dir)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
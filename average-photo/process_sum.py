@@ -6,112 +6,823 @@
 # We generate two outputs, one per-channel (false color) and one
 # true-color (global max/min).
 #
+# Intermediates are float64 by default. With dtype = numpy.float32 every
+# intermediate is half the size, which is what lets 8192x8192 sums fit in
+# worker RAM; outputs stay within 1 LSB of the float64 ones. Either way the
+# pipeline reuses buffers where it can, and reports peak memory per stage.
+#
+# The steps are stages in a small DAG (see pipeline.py). Expensive
+# intermediates are cached on disk, keyed by the sum's content and every
+# parameter that led to them, so rerunning after tweaking one parameter
+# only recomputes what that parameter affects.
+#
+# Sums too big for RAM are opened memmapped and processed out of core: every
+# stage is written per tile, with a halo wide enough for its filter, and runs
+# tile by tile on a process pool (see tiles.py). remove_dct needs the whole
+# frame at once, so for large sums use remove_block_pattern instead.
+#
+# Given arguments, e.g. 'process_sum.py sums/' or 'process_sum.py
+# "sums/19*.npy"', it processes every sum buffer they match instead of
+# sum.npy, on a process pool, with outputs named after each input. With
+# shared_scaling, the stats of all of them are merged so the outputs are
+# directly comparable.
+#
 
 import os
+import sys
+import glob
+import json
+import math
+import time
+import hashlib
 import numpy
+import resource
+import contextlib
+import multiprocessing
 import tifffile
-import scipy.ndimage.filters
+import blur
+import stats
+import tiles
+import pyramid
+import equalize
+import writer
+import pipeline
+
+dtype = numpy.float64
+
+# Cached intermediates, and which outputs to (re)generate. None means all
+# but optional_outputs, which cost more than the rest (CLAHE, for one, takes
+# its own pass and tables) and are only written when named in outputs.
+cache_dir = 'cache'
+cache_limit = 4 << 30
+outputs = None
+optional_outputs = ['channel-percentile.tiff', 'equalized.tiff', 'clahe.tiff']
+
+# Cancel the JPEG 8x8 grid pattern before scaling. With dct_spectrum the
+# spectrum before and after is also written out, which costs extra FFTs.
+remove_dct = False
+dct_spectrum = False
+
+# Cheaper alternative to remove_dct: estimate the 8x8 pattern directly in
+# the image, separately for each band of block_pattern_band pixels from the
+# center (see removeBlockPattern).
+remove_block_pattern = False
+block_pattern_band = 64
+
+# Also write a Laplacian pyramid of the channel-scaled image, one band per
+# octave for this many octaves, plus what's left below them (see pyramid.py).
+# The pyramid stages run in memory even when the rest is tiled.
+pyramid_levels = 0
+
+# The channel-percentile output clips each channel to these percentiles,
+# found from a 16-bit histogram of the sum (see stats.py)
+percentile_range = (0.1, 99.9)
+
+# The equalized output maps each channel through its CDF. The clahe output
+# does the same per cell of a clahe_tiles grid, with each cell's histogram
+# clipped at clahe_clip_limit times its mean (see equalize.py). Cell
+# histograms have clahe_bins bins.
+clahe_tiles = (8, 8)
+clahe_clip_limit = 3.0
+clahe_bins = equalize.clahe_bins
 
-def scaleImage(s, min_value, max_value):
+# Rows converted at a time when writing 16-bit output
+save_chunk_rows = 256
+
+# Gamma is applied with a lookup table of lut_size entries rather than pow();
+# see quantize() for the precision this costs
+gamma_lut = True
+lut_size = 1 << 16
+gamma_tables = {}
+
+# Output TIFFs are written by write_threads background threads, with at most
+# max_pending_writes waiting. tiff_compress is the zlib level, 0 for none;
+# compressed files are split into strips of tiff_rows_per_strip rows, and
+# with tiff_predictor they're stored as differences between neighbours.
+write_threads = 2
+max_pending_writes = 2
+tiff_compress = 0
+tiff_predictor = True
+tiff_rows_per_strip = 64
+
+# Tiled execution: None picks it for frames over tiled_min_pixels. Blur tiles
+# carry a halo of blur_halo_sigmas on the axis being blurred; at 3 sigma the
+# tile seams show up in the high-pass outputs, at 4 they're within 1 LSB.
+tiled = None
+tiled_min_pixels = 8192 * 8192
+tile_size = 2048
+tile_processes = multiprocessing.cpu_count()
+blur_halo_sigmas = 4.0
+
+# Batch mode (see batchMain): inputs are processed on batch_processes
+# workers, starting no more at once than fit in batch_memory_limit, at an
+# estimated batch_frame_buffers working frames each (or tiles, when tiled).
+# With shared_scaling every input is scaled with the same range, and so are
+# its high-pass and band outputs: a first pass over the batch finds the range
+# of each input's (see centerStatsNames()) and those are merged too.
+batch_processes = multiprocessing.cpu_count()
+batch_memory_limit = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2
+batch_frame_buffers = 4
+shared_scaling = False
+
+# Buffers sum_images.py writes beside the sum (its ema_file and stderr_file),
+# which a directory argument leaves out
+batch_skip_files = ['ema.npy', 'stderr.npy']
+
+def resetPeakMemory():
+    # Linux lets us reset the peak RSS counter, so each stage gets its own peak
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except IOError:
+        pass
+
+def peakMemory():
+    # Peak resident set size in MB, since the last reset where supported
+    try:
+        for line in open('/proc/self/status'):
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+@contextlib.contextmanager
+def memoryStage(name):
+    resetPeakMemory()
+    yield
+    print "  [%s] peak RSS %.1f MB" % (name, peakMemory())
+
+def scaleImage(s, min_value, max_value, out=None):
+    # Scale into 'out' if given, otherwise into a new float64 array
     print "Value range [%s, %s]" % (min_value, max_value)
-    return (s - min_value).astype(float) / (max_value - min_value)
+    return scaleRange(s, (min_value, max_value), out=out)
+
+def scaleRange(s, value_range, out=None):
+    # scaleImage() with a (min, max) computed beforehand, as a tile function
+    min_value, max_value = value_range
+    if out is None:
+        out = numpy.empty(s.shape, float)
+    numpy.subtract(s, min_value, out=out, casting='unsafe')
+    out /= (max_value - min_value)
+    return out
+
+def scaleStats(s, image_stats, histogram=None, mode='channel-minmax', percentiles=None, out=None):
+    # Scale with one of the ranges in stats.statsRange()
+    value_range = stats.statsRange(image_stats, mode, histogram, percentiles or percentile_range)
+    return scaleRange(s, value_range, out=out)
 
-def scaleImageSingleMax(s):
-    return scaleImage(s, 0, numpy.max(s))
+def scaleImageSingleMax(s, out=None):
+    return scaleImage(s, *stats.statsRange(stats.computeStats(s, histogram=False), 'single-max'), out=out)
 
-def scaleImageSingleMinMax(s):
-    return scaleImage(s, numpy.min(s), numpy.max(s))
+def scaleImageSingleMinMax(s, out=None):
+    return scaleImage(s, *stats.statsRange(stats.computeStats(s, histogram=False), 'single-minmax'), out=out)
 
-def scaleImageChannelMinMax(s):
-    return scaleImage(s,
-        numpy.min(s.reshape(-1, 3), axis=0),
-        numpy.max(s.reshape(-1, 3), axis=0))
+def scaleImageChannelMinMax(s, out=None):
+    return scaleImage(s, *stats.statsRange(stats.computeStats(s, histogram=False), 'channel-minmax'), out=out)
 
-def scaleImageCenterMinMax(s):
+def scaleImageCenterMinMax(s, out=None):
     # Like scaleImageChannelMinMax(), but we only look at the min/max values within
     # the middle 1/5 of the image, ignoring the edges. This allows the edges to oversaturate,
     # but it lets us see much more detail in the center.
+    return scaleImage(s, *stats.statsRange(stats.computeStats(s, histogram=False), 'center-minmax'), out=out)
 
-    dim = (s.shape[0]//5, s.shape[1]//5)
-    margin = ((s.shape[0] - dim[0]) // 2, (s.shape[1] - dim[1]) // 2)
-    center = s[ margin[0]:margin[0]+dim[0], margin[1]:margin[1]+dim[1], : ]
-
-    return scaleImage(s,
-        numpy.min(center.reshape(-1, 3), axis=0),
-        numpy.max(center.reshape(-1, 3), axis=0))
+def scaleImagePercentile(s, low=0.1, high=99.9, out=None):
+    # Clip each channel to the given percentiles, which can't be skewed by a
+    # few outlying pixels the way min/max can
+    image_stats = stats.computeStats(s)
+    return scaleImage(s, *stats.statsRange(image_stats, 'percentile', image_stats['histogram'],
+        (low, high)), out=out)
 
 def vRatio(a, b):
     # Ratio of two vector magnitudes
     return numpy.max(numpy.abs(a) / numpy.abs(b))
 
-def removeDctBlockArtifacts(s):
+dct_masks = {}
+fft_buffers = {}
+
+def dctNotchMask(shape):
+    # FFT energy for random tiled 8x8 data appears in a grid pattern, every
+    # 1/8th of the spectrum in each direction. We keep a boolean mask of those
+    # bins per image shape, mirrored so it stays conjugate-symmetric, skipping
+    # the DC component.
+    if shape not in dct_masks:
+        mask = numpy.zeros(shape, bool)
+        mask[::shape[0]//8, ::shape[1]//8] = True
+        mask |= mask[(-numpy.arange(shape[0])) % shape[0]][:, (-numpy.arange(shape[1])) % shape[1]]
+        mask[0, 0] = False
+        dct_masks[shape] = mask
+    return dct_masks[shape]
+
+def saveSpectrum(filename, s):
+    # Log magnitude spectrum of each channel, for diagnostics only
+    f = numpy.fft.rfft2(s, axes=(0,1))
+    saveTiff(filename, scaleImageChannelMinMax(numpy.log(numpy.abs(f) + 1)))
+
+def removeDctBlockArtifacts(s, out=None, spectrum_prefix=None):
     # The raw sum buffer ends up with a very noticeable repeating 8x8 pattern due to
     # systemic errors in the JPEG compression process. We try to cancel these out by
     # removing those components in the frequency domain.
+    #
+    # The notch mask is real and symmetric, so filtering is real-valued in the
+    # image domain: we can pack two channels into one single-precision complex
+    # FFT as the real and imaginary parts, and unpack them afterwards.
+
+    import scipy.fftpack
 
     print "Removing DCT block artifacts"
-    f = numpy.fft.rfft2(s, axes=(0,1))
-    saveTiff('result-dct-spectrum-before.tiff', scaleImageChannelMinMax(numpy.log(numpy.abs(f) + 1)))
+    if out is None:
+        out = numpy.empty(s.shape, float)
+    if spectrum_prefix:
+        saveSpectrum(spectrum_prefix + 'dct-spectrum-before.tiff', s)
+
+    shape = s.shape[:2]
+    mask = dctNotchMask(shape)
+    if shape not in fft_buffers:
+        fft_buffers[shape] = numpy.empty(shape, numpy.complex64)
+    work = fft_buffers[shape]
+
+    for c in range(0, s.shape[2], 2):
+        work.real = s[:,:,c]
+        work.imag = s[:,:,c+1] if c + 1 < s.shape[2] else 0
+        f = scipy.fftpack.fft2(work, overwrite_x=True)
+        f[mask] = 0
+        f = scipy.fftpack.ifft2(f, overwrite_x=True)
+        out[:,:,c] = f.real
+        if c + 1 < s.shape[2]:
+            out[:,:,c+1] = f.imag
+
+    if spectrum_prefix:
+        saveSpectrum(spectrum_prefix + 'dct-spectrum-after.tiff', out)
+    return out
+
+def letterboxClasses(shape, band=None):
+    # Images are letterboxed into the center of the buffer, so every pixel at
+    # the same vertical and horizontal distance from the center is covered by
+    # the same images, with the same mix of JPEG grid offsets. We group pixels
+    # into bands of that distance; each (row band, column band) is a class.
+    # Returns the class of each row and of each column.
+    if not band:
+        return numpy.zeros(shape[0], int), numpy.zeros(shape[1], int)
+    return [(numpy.abs(numpy.arange(n) - (n - 1) / 2.0) // band).astype(int) for n in shape[:2]]
 
-    # FFT energy for random tiled 8x8 data appears in this grid pattern
-    for i in range(0, f.shape[0], s.shape[0]/8):
-        for j in range(0, f.shape[1], s.shape[1]/8):
-            if i == 0 and j == 0:
-                # Skip the DC component
-                continue
-            f[i, j] = 0
+def blockPatternLabels(frame, band=None):
+    # Label of each pixel is class * 64 + phase, split into a row part and a
+    # column part that add up. Also returns the number of labels.
+    row_class, col_class = letterboxClasses(frame, band)
+    num_cols = col_class.max() + 1
+    num_labels = (row_class.max() + 1) * num_cols * 64
+    row_label = row_class * num_cols * 64 + (numpy.arange(frame[0]) % 8) * 8
+    col_label = col_class * 64 + numpy.arange(frame[1]) % 8
+    return row_label, col_label, num_labels
 
-    saveTiff('result-dct-spectrum-after.tiff', scaleImageChannelMinMax(numpy.log(numpy.abs(f) + 1)))
-    return numpy.fft.irfft2(f, axes=(0,1))
+def blockPatternSums(s, band=None, origin=(0, 0), frame=None, halo=(0, 0), chunk_rows=512):
+    # Per-label pixel counts and sums of the residual against an 8x8 box
+    # filter, over the part of 's' inside its halo. The box filter needs 4
+    # pixels either side, which we mirror past the edges of 's'.
+    import scipy.ndimage.filters
 
-def gaussianBlur(s, sigma=None):
-    print "Blurring"
+    frame = frame or s.shape[:2]
+    h, w = s.shape[0] - 2 * halo[0], s.shape[1] - 2 * halo[1]
+    row_label, col_label, num_labels = blockPatternLabels(frame, band)
+    row_label = row_label[origin[0]:origin[0] + h]
+    col_label = col_label[origin[1]:origin[1] + w]
+
+    counts = numpy.zeros(num_labels)
+    sums = numpy.zeros((num_labels, s.shape[2]))
+    for y in range(0, h, chunk_rows):
+        rows = min(chunk_rows, h - y)
+        chunk = tiles.readTile(s, (halo[0] + y, halo[0] + y + rows, halo[1], halo[1] + w), 4)
+        box = scipy.ndimage.filters.uniform_filter1d(chunk, 8, axis=0, output=float)
+        scipy.ndimage.filters.uniform_filter1d(box, 8, axis=1, output=box)
+
+        labels = (row_label[y:y+rows, None] + col_label).ravel()
+        counts += numpy.bincount(labels, minlength=num_labels)
+        for c in range(s.shape[2]):
+            residual = chunk[4:-4, 4:-4, c] - box[4:-4, 4:-4, c]
+            sums[:, c] += numpy.bincount(labels, residual.ravel(), num_labels)
+    return counts, sums
+
+def blockPattern(partial_sums):
+    # Combine blockPatternSums() into the pattern value for each label, with
+    # each class's mean removed so the overall brightness is unchanged
+    counts = sum(p[0] for p in partial_sums)
+    sums = sum(p[1] for p in partial_sums)
+    channels = sums.shape[1]
+    pattern = (sums / numpy.maximum(counts, 1)[:, None]).reshape(-1, 64, channels)
+    pattern -= pattern.mean(axis=1)[:, None, :]
+    return pattern.reshape(-1, channels)
+
+def subtractBlockPattern(s, pattern, band=None, origin=(0, 0), frame=None, halo=(0, 0),
+        out=None, chunk_rows=512):
+    frame = frame or s.shape[:2]
+    if out is None:
+        out = numpy.empty(s.shape, float)
+    row_label, col_label, num_labels = blockPatternLabels(frame, band)
+
+    # Halo pixels are mirrored, so their labels are too
+    rows = numpy.arange(origin[0] - halo[0], origin[0] - halo[0] + s.shape[0])
+    cols = numpy.arange(origin[1] - halo[1], origin[1] - halo[1] + s.shape[1])
+    row_label = row_label[mirrorIndex(rows, frame[0])]
+    col_label = col_label[mirrorIndex(cols, frame[1])]
+
+    for y in range(0, s.shape[0], chunk_rows):
+        labels = row_label[y:y+chunk_rows, None] + col_label
+        numpy.subtract(s[y:y+chunk_rows], pattern[labels], out=out[y:y+chunk_rows], casting='unsafe')
+    return out
+
+def mirrorIndex(i, n):
+    # Indices past either end of 0..n-1, reflected back in the way
+    # numpy.pad(..., 'symmetric') does
+    i = numpy.abs(i + 0.5) - 0.5
+    i = i.astype(int) % (2 * n)
+    return numpy.where(i < n, i, 2 * n - 1 - i)
+
+def removeBlockPattern(s, band=None, out=None, chunk_rows=512):
+    # O(pixels) alternative to removeDctBlockArtifacts(). Any exactly 8-periodic
+    # pattern averages to a constant over an 8x8 box, so the residual against an
+    # 8x8 box filter keeps the pattern. Averaging that residual over each of the
+    # 64 phases, within each letterbox class, estimates the pattern; we subtract
+    # it with its mean removed so the overall brightness is unchanged.
+    print "Removing 8x8 block pattern"
+    pattern = blockPattern([blockPatternSums(s, band, chunk_rows=chunk_rows)])
+    return subtractBlockPattern(s, pattern, band, out=out, chunk_rows=chunk_rows)
+
+def gaussianBlur(s, sigma=None, out=None, method=None):
+    # See blur.py for how the implementation is chosen
     sigma = sigma or s.shape[1] * 0.03
-    return numpy.dstack((
-        scipy.ndimage.filters.gaussian_filter(s[:,:,0], sigma),
-        scipy.ndimage.filters.gaussian_filter(s[:,:,1], sigma),
-        scipy.ndimage.filters.gaussian_filter(s[:,:,2], sigma)))
+    return blur.gaussianBlur(s, sigma, out, method)
+
+def gaussianBlur1d(s, sigma, axis, out=None, method=None):
+    return blur.gaussianBlur1d(s, sigma, axis, out, method)
 
-def gammaCorrect(s, exp):
-    return pow(numpy.clip(s, 0, 1), exp)
+def gammaCorrect(s, exp, out=None):
+    out = numpy.clip(s, 0, 1, out=out)
+    return numpy.power(out, exp, out=out)
 
-def saveTiff(filename, s):
-    # Convert floating point to 16-bit TIFF
+def gammaTableExponent(gamma):
+    # Below gamma 1 the curve is steepest at black, so those tables are
+    # indexed by sqrt(x) instead of x, and entry i holds the curve at
+    # (i / (size - 1)) ** 2
+    return 2 * gamma if gamma < 1 else gamma
+
+def gammaTable(gamma, dtype=numpy.uint16, size=None):
+    # Entry i is round((i / (size - 1)) ** gammaTableExponent(gamma)) in the
+    # full range of 'dtype', cached per gamma, type and size
+    size = size or lut_size
+    key = (gamma, numpy.dtype(dtype).str, size)
+    if key not in gamma_tables:
+        top = numpy.iinfo(dtype).max
+        table = numpy.linspace(0, 1, size) ** gammaTableExponent(gamma) * top + 0.5
+        gamma_tables[key] = numpy.minimum(table, top).astype(dtype)
+    return gamma_tables[key]
+
+def gammaTableError(gamma, dtype=numpy.uint16, size=None):
+    # Worst-case error of the table, in output LSBs, against the exact
+    # x ** gamma for every input that rounds to each entry. The curve is
+    # monotonic, so the worst input in each entry's range is at one end.
+    table = gammaTable(gamma, dtype, size).astype(float)
+    top = numpy.iinfo(dtype).max
+    exponent = gammaTableExponent(gamma)
+    i = numpy.arange(len(table))
+    lo = numpy.clip((i - 0.5) / (len(table) - 1), 0, 1) ** exponent * top
+    hi = numpy.clip((i + 0.5) / (len(table) - 1), 0, 1) ** exponent * top
+    return numpy.maximum(numpy.abs(table - lo), numpy.abs(table - hi)).max()
+
+def quantize(s, gamma=None, out=None, dtype=numpy.uint16, use_lut=None, table_size=None):
+    # Convert [0, 1] floating point to 16-bit (or 'dtype', e.g. uint8 for
+    # previews), with optional gamma. We go a few rows at a time so the only
+    # full-size temporary is the output.
+    #
+    # Gamma is a table lookup: each row is scaled to an index into
+    # gammaTable(), which gives the output type directly. That's far cheaper
+    # than pow(), at the cost of gammaTableError(): with the default 64K
+    # table, about 1.6 LSB at both gamma 2.2 and 1/2.2 (indexed by the
+    # square root, see gammaTableExponent()). Set gamma_lut = False for the
+    # exact pow() path.
+    #
+    # use_lut and table_size default to gamma_lut and lut_size; pipeline
+    # nodes pass them so that they're part of the node's key.
+    if use_lut is None:
+        use_lut = gamma_lut
+    if out is None:
+        out = numpy.empty(s.shape, dtype)
+    top = float(numpy.iinfo(out.dtype).max)
+    table = None
+    if gamma is not None and use_lut:
+        table = gammaTable(gamma, out.dtype, table_size)
+
+    for y in range(0, s.shape[0], save_chunk_rows):
+        if table is not None:
+            if gamma < 1:
+                index = numpy.maximum(s[y:y+save_chunk_rows], 0)
+                numpy.sqrt(index, out=index)
+                index *= float(len(table) - 1)
+            else:
+                index = s[y:y+save_chunk_rows] * float(len(table) - 1)
+            index += 0.5
+            numpy.take(table, index.astype(numpy.intp), out=out[y:y+save_chunk_rows], mode='clip')
+            continue
+        elif gamma is None:
+            rows = s[y:y+save_chunk_rows] * top
+        else:
+            rows = gammaCorrect(s[y:y+save_chunk_rows], gamma)
+            rows *= top
+        numpy.clip(rows, 0, top, out=rows)
+        out[y:y+save_chunk_rows] = rows
+    return out
+
+# 16-bit buffers go back here once they're written, for the next output
+tiff_buffers = writer.BufferPool()
+tiff_writer = None
+
+def saveTiff(filename, s, out=None):
+    # Convert floating point to 16-bit TIFF, and write it right away
     print 'Writing %s' % filename
-    s = s * float(0xFFFF)
-    numpy.clip(s, 0, 0xFFFF)    
-    tifffile.imsave(filename, s.astype(numpy.uint16))
+    if out is None:
+        out = tiff_buffers.take(s.shape, numpy.uint16)
+    writeQuantized(filename, quantize(s, out=out))
+
+def writeQuantized(filename, q, compress=None, predictor=None, rows_per_strip=None):
+    # Write via a temporary name, so a partly written file is never mistaken
+    # for a finished one, then hand the buffer back for reuse. The options
+    # default to tiff_compress, tiff_predictor and tiff_rows_per_strip.
+    if compress is None:
+        compress = tiff_compress
+    if predictor is None:
+        predictor = tiff_predictor
+    options = {}
+    if compress:
+        options = dict(compress=compress, rowsperstrip=rows_per_strip or tiff_rows_per_strip,
+            predictor=predictor)
+    tmp = filename + '.tmp'
+    tifffile.imsave(tmp, q, **options)
+    os.rename(tmp, filename)
+    tiff_buffers.give(q)
+
+def stageFunction(func):
+    # Adapt func(..., out=None) to a pipeline stage with a 'dtype' parameter,
+    # allocating the output unless the pipeline hands us a buffer to reuse.
+    def stage(s, *args, **params):
+        dtype = params.pop('dtype')
+        out = params.pop('out', None)
+        if out is None:
+            out = numpy.empty(s.shape, dtype)
+        return func(s, *args, out=out, **params)
+    return stage
+
+def writeTiff(filename, q, **options):
+    # Pipeline output: write an already quantized (maybe memmapped) image in
+    # the background, with writeQuantized()'s options. The pipeline waits on
+    # the result.
+    global tiff_writer
+    print 'Writing %s' % filename
+    if tiff_writer is None:
+        tiff_writer = writer.Writer(write_threads, max_pending_writes)
+    return tiff_writer.submit(writeQuantized, filename, q, **options)
+
+def writeSpectrum(filename, s):
+    saveSpectrum(filename, s)
+
+def buildPipeline(s, prefix, key=None, dtype=numpy.float64, remove_dct=False, dct_spectrum=False,
+        remove_block_pattern=False, block_pattern_band=None, cache_dir=None, cache_limit=cache_limit,
+        executor=None, sum_stats=None, pyramid_levels=0, shared_stats=None):
+    p = pipeline.Pipeline(cache_dir, cache_limit, memoryStage, executor)
+    p.source('sum', s, key)
+    source = 'sum'
+
+    def imageStats(name, source, region=None):
+        # Stats of 'source' in one pass, and its histogram in a second
+        # pass that only runs if something needs it. Stats shared across a
+        # batch replace the first.
+        if shared_stats and name in shared_stats:
+            value = shared_stats[name]
+            p.source(name, value, hashlib.sha1(json.dumps(value, sort_keys=True)).hexdigest())
+            return
+        p.reduce(name, stats.tileStats, stats.combineStats, [source], region=region, positional=True)
+        p.reduce(name + '-histogram', stats.tileHistogram, stats.combineHistogram, [source, name],
+            region=region)
+
+    def tiff(name, stage, gamma=None):
+        p.map(stage + '-16bit', quantize, [stage], dtype=numpy.uint16, allocate=tiff_buffers.take,
+            gamma=gamma, use_lut=gamma_lut, table_size=lut_size)
+        p.output(prefix + name, writeTiff, [stage + '-16bit'], compress=tiff_compress,
+            predictor=tiff_predictor, rows_per_strip=tiff_rows_per_strip)
+
+    if remove_dct:
+        if dct_spectrum:
+            p.output(prefix + 'dct-spectrum-before.tiff', writeSpectrum, [source])
+        p.stage('remove-dct', stageFunction(removeDctBlockArtifacts), [source], cache=True, dtype=dtype)
+        source = 'remove-dct'
+        if dct_spectrum:
+            p.output(prefix + 'dct-spectrum-after.tiff', writeSpectrum, [source])
+
+    if remove_block_pattern:
+        p.reduce('block-pattern', blockPatternSums, blockPattern, [source], halo=4,
+            positional=True, band=block_pattern_band)
+        p.map('remove-block-pattern', subtractBlockPattern, [source, 'block-pattern'],
+            dtype=dtype, cache=True, positional=True, band=block_pattern_band)
+        source = 'remove-block-pattern'
+
+    if sum_stats and (source == 'sum' or 'scaling' in sum_stats):
+        # Already known, e.g. from the stats sidecar (see stats.fileStats).
+        # Stats shared across a batch (see sharedStats()) are used even after
+        # the filters above, so that every input gets the same scaling.
+        sum_key = p.by_name['sum'].key + sum_stats.get('scaling', '')
+        summary = dict((k, v) for k, v in sum_stats.items() if k != 'histogram')
+        p.source('stats', summary, hashlib.sha1(sum_key + 'stats').hexdigest())
+        p.source('stats-histogram', numpy.array(sum_stats['histogram']),
+            hashlib.sha1(sum_key + 'histogram').hexdigest())
+    else:
+        imageStats('stats', source)
 
-def scaleAndFilterImage(s, prefix):
     # Most raw: just scale by the max
-    saveTiff(prefix + 'single-max.tiff', scaleImageSingleMax(s))
+    p.map('single-max', scaleStats, [source, 'stats'], dtype=dtype, mode='single-max')
+    tiff('single-max.tiff', 'single-max')
 
     # Next, show both min and max scaling
-    saveTiff(prefix + 'single-minmax.tiff', scaleImageSingleMinMax(s))
+    p.map('single-minmax', scaleStats, [source, 'stats'], dtype=dtype, mode='single-minmax')
+    tiff('single-minmax.tiff', 'single-minmax')
 
     # Now scale each channel separately
-    scaled = scaleImageChannelMinMax(s)
-    saveTiff(prefix + 'channel-minmax.tiff', scaled)
-   
-    # Gaussian filter, to extract only the low-frequency color gradient background
-    lowpass = gaussianBlur(scaled)
-    saveTiff(prefix + 'lowpass.tiff', lowpass)
+    p.map('channel-minmax', scaleStats, [source, 'stats'], dtype=dtype, cache=True,
+        mode='channel-minmax')
+    tiff('channel-minmax.tiff', 'channel-minmax')
+
+    # Same, but clipping the extremes of each channel
+    p.map('channel-percentile', scaleStats, [source, 'stats', 'stats-histogram'], dtype=dtype,
+        mode='percentile', percentiles=tuple(percentile_range))
+    tiff('channel-percentile.tiff', 'channel-percentile')
+
+    # Histogram equalisation, over the whole image and then adaptively, which
+    # brings out local contrast everywhere instead of letting the edges set
+    # the range
+    p.map('equalized', equalize.equalizeTile, [source, 'stats', 'stats-histogram'], dtype=dtype)
+    tiff('equalized.tiff', 'equalized')
+    p.reduce('clahe-histograms', equalize.claheHistograms, equalize.combineClaheHistograms,
+        [source, 'stats'], positional=True, tiles=tuple(clahe_tiles), bins=clahe_bins)
+    p.stage('clahe-luts', equalize.claheLuts, ['clahe-histograms'], cache=True,
+        clip_limit=clahe_clip_limit)
+    p.map('clahe', equalize.claheTile, [source, 'stats', 'clahe-luts'], dtype=dtype, positional=True)
+    tiff('clahe.tiff', 'clahe')
+
+    # Gaussian filter, to extract only the low-frequency color gradient
+    # background. One axis at a time, so each tile's halo is only on one axis.
+    sigma = s.shape[1] * 0.03
+    method = blur.chooseMethod(s.shape, sigma)
+    halo = int(math.ceil(blur_halo_sigmas * sigma))
+    p.map('lowpass-rows', gaussianBlur1d, ['channel-minmax'], dtype=dtype, halo=(halo, 0),
+        sigma=sigma, axis=0, method=method)
+    p.map('lowpass', gaussianBlur1d, ['lowpass-rows'], dtype=dtype, halo=(0, halo), cache=True,
+        inplace='lowpass-rows', sigma=sigma, axis=1, method=method)
+    tiff('lowpass.tiff', 'lowpass')
+
+    # Band-pass images an octave apart, each scaled like the high-pass output.
+    # These come before the high-pass stages so that they can still reuse the
+    # channel-minmax buffer.
+    fine = 'channel-minmax'
+    for level in range(pyramid_levels):
+        coarse = 'pyramid-%d' % (level + 1)
+        band = 'band-%d' % level
+        p.stage(coarse, pyramid.downsample, [fine])
+        p.stage(band, pyramid.laplacianBand, [fine, coarse])
+        imageStats(band + '-stats', band, stats.centerRegion(pyramid.levelShape(s.shape, level)))
+        p.map(band + '-center', scaleStats, [band, band + '-stats'], dtype=dtype,
+            mode='center-minmax', inplace=band)
+        tiff(band + '.tiff', band + '-center', gamma=2.2)
+        fine = coarse
+    if pyramid_levels:
+        tiff('band-residual.tiff', fine)
 
-    # Subtract the blurred image, for a high-pass filter
-    highpass = scaled - lowpass
-    saveTiff(prefix + 'highpass.tiff', gammaCorrect(scaleImageCenterMinMax(highpass), 2.2))
+    # Subtract the blurred image, for a high-pass filter. The scaling only
+    # looks at the center (see scaleImageCenterMinMax()), so that's all we
+    # need stats for.
+    center = stats.centerRegion(s.shape)
+    p.map('highpass', numpy.subtract, ['channel-minmax', 'lowpass'], dtype=dtype,
+        cache=True, inplace='channel-minmax')
+    imageStats('highpass-stats', 'highpass', center)
+    p.map('highpass-center', scaleStats, ['highpass', 'highpass-stats'], dtype=dtype,
+        mode='center-minmax')
+    tiff('highpass.tiff', 'highpass-center', gamma=2.2)
 
     # Emphasize differences by squaring the error
-    sq = highpass * highpass
-    saveTiff(prefix + 'highpass-sq.tiff', gammaCorrect(scaleImageCenterMinMax(sq), 1/2.2))
+    p.map('highpass-sq', numpy.multiply, ['highpass', 'highpass'], dtype=dtype, inplace='highpass')
+    imageStats('highpass-sq-stats', 'highpass-sq', center)
+    p.map('highpass-sq-center', scaleStats, ['highpass-sq', 'highpass-sq-stats'],
+        dtype=dtype, mode='center-minmax', inplace='highpass-sq')
+    tiff('highpass-sq.tiff', 'highpass-sq-center', gamma=1/2.2)
 
+    return p
+
+def initTileWorker():
+    # Tile workers already run one per CPU, so they don't need blur threads
+    blur.threads = 1
+
+def tileExecutor(s, tiled=None):
+    # An executor for tiled processing of 's', or None to do it in memory.
+    # Large sums are processed in tiles unless 'tiled' says otherwise.
+    if tiled is None:
+        tiled = s.shape[0] * s.shape[1] > tiled_min_pixels
+    if tiled:
+        return tiles.Executor(tile_size, tile_processes, initTileWorker)
+
+def centerStatsNames(pyramid_levels=0):
+    # Stats stages the high-pass and band outputs are scaled by
+    return ['highpass-stats', 'highpass-sq-stats'] + ['band-%d-stats' % level
+        for level in range(pyramid_levels)]
+
+def scaleAndFilterImage(s, prefix, dtype=numpy.float64, remove_dct=False, dct_spectrum=False,
+        remove_block_pattern=False, block_pattern_band=None, outputs=None, cache_dir=None, key=None,
+        tiled=None, sum_stats=None, pyramid_levels=0, shared_stats=None, stats_only=False):
+    # Write the requested outputs (by name without the prefix, by default all
+    # but optional_outputs), skipping any that are already up to date in
+    # cache_dir. sum_stats are the stats of 's' with histogram, if we have
+    # them already, and shared_stats any of centerStatsNames() to use instead
+    # of computing them. With stats_only, nothing is written; we return the
+    # centerStatsNames() stats instead.
+    p = buildPipeline(s, prefix, key, dtype, remove_dct, dct_spectrum,
+        remove_block_pattern, block_pattern_band, cache_dir, executor=tileExecutor(s, tiled),
+        sum_stats=sum_stats, pyramid_levels=pyramid_levels, shared_stats=shared_stats)
+    if stats_only:
+        return p.run(centerStatsNames(pyramid_levels))
+    if outputs:
+        p.run([prefix + name for name in outputs])
+    else:
+        p.run([name for name in p.outputs() if name[len(prefix):] not in optional_outputs])
+
+
+def batchInputs(patterns):
+    # Sum buffers named by each argument: a directory means every .npy in it
+    # except batch_skip_files
+    filenames = []
+    for pattern in patterns:
+        skip = []
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, '*.npy')
+            skip = batch_skip_files
+        for filename in sorted(glob.glob(pattern)):
+            if filename not in filenames and os.path.basename(filename) not in skip:
+                filenames.append(filename)
+    return filenames
+
+def imageCount(filename):
+    # How many images went into a sum, from the count file sum_images.py
+    # writes beside it (sum.npy -> sum.json), or None if there isn't one
+    path = os.path.splitext(filename)[0] + '.json'
+    if os.path.exists(path):
+        return json.load(open(path)).get('count')
+
+def batchStats(filename):
+    # Runs in a batch worker. Stats of a memmapped sum are computed a few
+    # rows at a time, so they don't need tiling.
+    return stats.fileStats(filename)
+
+def sharedStats(filenames, file_stats):
+    # One set of stats for the whole batch, rescaled for each input. Sums are
+    # divided by their image counts first, so that a decade of 100 images
+    # comes out as bright as one of 10000.
+    counts = [imageCount(f) or 1 for f in filenames]
+    merged = stats.mergeStats([stats.rescaleStats(st, 1.0 / n) for st, n in zip(file_stats, counts)])
+    scaling = hashlib.sha1(repr([(st['key'], n) for st, n in zip(file_stats, counts)])).hexdigest()
+    result = []
+    for st, n in zip(file_stats, counts):
+        shared = stats.rescaleStats(merged, n)
+        shared.update(key=st['key'], scaling=scaling)
+        result.append(shared)
+    return result
+
+def batchMemory(filename):
+    # Rough peak memory of processing one input, from its shape alone
+    s = numpy.load(filename, mmap_mode='r')
+    pixels = s.shape[0] * s.shape[1]
+    if tiled or (tiled is None and pixels > tiled_min_pixels):
+        pixels = tile_size * tile_size
+    return pixels * s.shape[2] * numpy.dtype(dtype).itemsize * batch_frame_buffers
+
+def initBatchWorker():
+    # Batch workers already run one per CPU, and as pool workers they can't
+    # start pools of their own, so tiled inputs run their tiles inline
+    global tile_processes
+    tile_processes = 1
+    blur.threads = 1
+
+def processBatchInput(filename, sum_stats, shared_stats=None, stats_only=False):
+    # Outputs go beside the input, named after it: sums/1900s.npy gives
+    # sums/1900s-single-max.tiff and so on
+    s = numpy.load(filename, mmap_mode='r')
+    prefix = os.path.splitext(filename)[0] + '-'
+    return scaleAndFilterImage(s, prefix, dtype, remove_dct, dct_spectrum,
+        remove_block_pattern, block_pattern_band, outputs, cache_dir, sum_stats['key'],
+        tiled, sum_stats, pyramid_levels, shared_stats, stats_only)
+
+def sharedCenterStats(center_stats):
+    # Each of centerStatsNames() merged over the batch. The high-pass and band
+    # images are already in the shared scaling's units, so unlike sharedStats()
+    # there's nothing to rescale.
+    return dict((name, stats.mergeStats([st[name] for st in center_stats]))
+        for name in centerStatsNames(pyramid_levels))
+
+def runBounded(pool, jobs, limit):
+    # Run (func, args, memory) jobs on the pool in order, each starting once
+    # the jobs already running leave 'memory' to spare under 'limit' (or
+    # nothing else is running). Returns each job's result (None if it
+    # failed), and the (job, error) of any that failed.
+    running = []
+    failures = []
+    jobs = list(jobs)
+    results = [None] * len(jobs)
+    jobs = list(enumerate(jobs))
+    while jobs or running:
+        for (i, job), result in [r for r in running if r[1].ready()]:
+            running.remove(((i, job), result))
+            try:
+                results[i] = result.get()
+            except Exception as e:
+                failures.append((job, e))
+        if jobs and (not running or (len(running) < batch_processes and
+                sum(job[2] for (i, job), result in running) + jobs[0][1][2] <= limit)):
+            i, job = jobs.pop(0)
+            running.append(((i, job), pool.apply_async(job[0], job[1])))
+        elif running:
+            running[0][1].wait(0.1)
+    return results, failures
+
+def runJobs(pool, jobs):
+    # runBounded() on the pool if there is one, or one job at a time
+    if pool:
+        return runBounded(pool, jobs, batch_memory_limit)
+    results = []
+    failures = []
+    for job in jobs:
+        try:
+            results.append(job[0](*job[1]))
+        except Exception as e:
+            results.append(None)
+            failures.append((job, e))
+    return results, failures
+
+def batchMain(patterns):
+    # Process every sum matched by 'patterns', e.g. per decade or department
+    filenames = batchInputs(patterns)
+    if not filenames:
+        print "No sum buffers match %s" % ' '.join(patterns)
+        return
+    print "Processing %d sum buffers" % len(filenames)
+    start = time.time()
+
+    pool = None
+    if batch_processes > 1:
+        pool = multiprocessing.Pool(min(batch_processes, len(filenames)), initBatchWorker)
+        file_stats = pool.map(batchStats, filenames)
+    else:
+        file_stats = map(batchStats, filenames)
+    shared = None
+    failures = []
+    if shared_scaling:
+        file_stats = sharedStats(filenames, file_stats)
+        # The high-pass and band ranges of every input, before any outputs
+        # are written with them
+        print "Finding shared high-pass ranges"
+        jobs = [(processBatchInput, (f, st, None, True), batchMemory(f))
+            for f, st in zip(filenames, file_stats)]
+        center_stats, failures = runJobs(pool, jobs)
+        if not failures:
+            shared = sharedCenterStats(center_stats)
+
+    if not failures:
+        jobs = [(processBatchInput, (f, st, shared), batchMemory(f))
+            for f, st in zip(filenames, file_stats)]
+        results, failures = runJobs(pool, jobs)
+    if pool:
+        pool.close()
+        pool.join()
+
+    print "Processed %d sum buffers in %.1fs" % (len(filenames) - len(failures), time.time() - start)
+    for job, e in failures:
+        print "Failed: %s: %s" % (job[1][0], e)
+    if failures:
+        sys.exit(1)
 
 def main():
+    # With arguments, process each sum buffer they name (see batchMain)
+    if len(sys.argv) > 1:
+        batchMain(sys.argv[1:])
+        return
+
+    # Memmapped, so only the parts a stage needs are read in
     print "Loading sum buffer"
-    s = numpy.load('sum.npy')
+    s = numpy.load('sum.npy', mmap_mode='r')
+
+    # Stats and content hash, from the sidecar if the sum hasn't changed
+    executor = tileExecutor(s, tiled)
+    sum_stats = stats.fileStats('sum.npy', s, executor)
+    if executor:
+        executor.close()
 
     # First round of filtering
-    scaleAndFilterImage(s, 'result-')
+    scaleAndFilterImage(s, 'result-', dtype, remove_dct, dct_spectrum,
+        remove_block_pattern, block_pattern_band, outputs, cache_dir, sum_stats['key'],
+        tiled, sum_stats, pyramid_levels)
 
 
 if __name__ == '__main__':
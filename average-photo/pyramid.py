@@ -0,0 +1,80 @@
+#
+# Laplacian pyramid, for looking at an image one octave at a time.
+#
+# Each level of the Gaussian pyramid is the one before blurred with the
+# 5-tap binomial kernel [1 4 6 4 1] / 16 and halved in both directions. Band
+# k of the Laplacian pyramid is Gaussian level k minus level k + 1 expanded
+# back up to its size, so it holds the detail between those two scales, and
+# the last band is the coarsest Gaussian level itself. Adding every band
+# back up (expanding as we go) gives the original image exactly.
+#
+# Only the samples we keep are ever filtered, and every level has a quarter
+# of the pixels of the one before, so the whole decomposition costs about
+# 4/3 of one pass over the image, however many octaves it covers.
+#
+
+import numpy
+
+kernel = numpy.array([1, 4, 6, 4, 1]) / 16.0
+
+def padAxis0(a, n):
+    # Mirror 'n' samples past each end of axis 0, not repeating the edge
+    widths = [(n, n)] + [(0, 0)] * (a.ndim - 1)
+    return numpy.pad(a, widths, 'reflect')
+
+def reduceAxis0(a):
+    # Filter and keep every other sample along axis 0
+    m = (a.shape[0] + 1) // 2
+    p = padAxis0(a, 2)
+    out = p[0:2*m:2] * kernel[0]
+    for j in range(1, 5):
+        out += p[j:j+2*m:2] * kernel[j]
+    return out
+
+def expandAxis0(a, n):
+    # Upsample 'a' to 'n' samples along axis 0, interpolating with the same
+    # kernel (doubled, since half the samples are new)
+    m = a.shape[0]
+    p = padAxis0(a, 1)
+    out = numpy.empty((n,) + a.shape[1:], a.dtype)
+    out[0::2] = (p[0:m] + 6 * p[1:m+1] + p[2:m+2])[:(n + 1) // 2] / 8
+    out[1::2] = ((p[1:m+1] + p[2:m+2]) / 2)[:n // 2]
+    return out
+
+def downsample(a):
+    # The next Gaussian pyramid level of an (h, w, ...) image
+    a = reduceAxis0(a)
+    return numpy.moveaxis(reduceAxis0(numpy.moveaxis(a, 1, 0)), 0, 1)
+
+def upsample(a, shape):
+    # Expand a level back up to 'shape', the size of the level above it
+    a = expandAxis0(a, shape[0])
+    return numpy.moveaxis(expandAxis0(numpy.moveaxis(a, 1, 0), shape[1]), 0, 1)
+
+def levelShape(shape, level):
+    # Shape of a Gaussian pyramid level, for an image of 'shape'
+    shape = list(shape)
+    for i in range(level):
+        shape[0] = (shape[0] + 1) // 2
+        shape[1] = (shape[1] + 1) // 2
+    return tuple(shape)
+
+def laplacianBand(fine, coarse, out=None):
+    # The detail in 'fine' that isn't in the next level down
+    return numpy.subtract(fine, upsample(coarse, fine.shape), out=out)
+
+def laplacianPyramid(s, levels):
+    # [band 0, ..., band levels - 1, coarsest Gaussian level]
+    bands = []
+    for i in range(levels):
+        coarse = downsample(s)
+        bands.append(laplacianBand(s, coarse))
+        s = coarse
+    return bands + [s]
+
+def collapse(bands):
+    # Inverse of laplacianPyramid()
+    s = bands[-1]
+    for band in reversed(bands[:-1]):
+        s = band + upsample(s, band.shape)
+    return s
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+#
+# Render a video from a sequence of window sums, one frame per window, with
+# a temporally stable version of process_sum's filter chain.
+#
+#   python render_video.py                  windows from snapshot_dir
+#   python render_video.py a.npy b.npy ...  each file is already a window
+#
+# sum_images.py can save a snapshot of the running sum at every checkpoint
+# (see its snapshot_dir). Those are cumulative, so the sum over a sliding
+# window of snapshots is just the difference of its ends, divided by the
+# difference of their image counts. Sums given on the command line (say, one
+# per decade from a batch run) are divided by the count in the .json beside
+# each, if there is one.
+#
+# Each frame is scaled per channel, blurred for the lowpass, and the chosen
+# output (video_output) is made from those as in process_sum. Scaling each
+# frame on its own makes the video flicker, so there are two passes: the
+# first measures every frame's ranges, which are then smoothed over
+# range_smoothing frames, and the second renders with the smoothed ranges.
+# The first pass also saves each frame's lowpass to a work directory so the
+# second doesn't have to blur again.
+#
+# The blur is a 2-D FFT with a plan built once per worker: padding, the
+# Gaussian transfer function and a single precision work buffer, with two
+# channels packed into each complex transform (as removeDctBlockArtifacts
+# does). scipy.fftpack keeps its own twiddle factors for each length, so
+# after the first frame a blur is just two FFTs and a multiply.
+#
+# Frames are rendered on a process pool. At most max_in_flight frames are
+# queued or held at once, and they're written out strictly in order as
+# 16-bit TIFFs (frame-00000.tiff, ...) in output_dir, or streamed to
+# video_file (- for stdout) as 8-bit 4:4:4 Y4M or raw 16-bit RGB that
+# ffmpeg reads with -f rawvideo -pix_fmt rgb48le -s WxH.
+#
+
+import os
+import re
+import sys
+import glob
+import math
+import time
+import shutil
+import tempfile
+import multiprocessing
+import numpy
+import stats
+import process_sum
+
+snapshot_dir = 'snapshots'
+
+# Snapshots per window, and how far the window moves between frames
+window = 4
+step = 1
+
+# One of channel-percentile, channel-minmax, lowpass, highpass, highpass-sq
+video_output = 'highpass'
+
+# Ranges are smoothed with a Gaussian of this many frames; 0 turns it off
+range_smoothing = 3.0
+
+# Lowpass sigma, as a fraction of the frame width like process_sum's
+lowpass_sigma = 0.03
+
+# tiff, y4m or rgb48
+video_format = 'tiff'
+output_dir = 'video'
+video_file = 'video.y4m'
+frame_rate = 24
+
+processes = multiprocessing.cpu_count()
+max_in_flight = 2 * processes
+
+# Gamma for each output, as process_sum applies it
+output_gamma = {'highpass': 2.2, 'highpass-sq': 1 / 2.2}
+
+blur_plans = {}
+
+class FftBlur(object):
+    # Gaussian blur of (h, w, c) frames of one shape, with scipy's 'reflect'
+    # edges like blur.gaussianBlur()
+    def __init__(self, shape, sigma):
+        import blur
+        self.shape = shape
+        self.pad = [min(n, int(math.ceil(blur.pad_sigmas * sigma))) for n in shape]
+        self.padded = [blur.fastLength(n + 2 * p) for n, p in zip(shape, self.pad)]
+        ty, tx = [numpy.exp(-2 * (math.pi * sigma * numpy.fft.fftfreq(n)) ** 2) for n in self.padded]
+        self.transfer = numpy.outer(ty, tx).astype(numpy.float32)
+        self.work = numpy.empty(self.padded, numpy.complex64)
+
+    def padChannel(self, a):
+        (py, px), (hy, hx) = self.pad, self.padded
+        return numpy.pad(a, [(py, hy - a.shape[0] - py), (px, hx - a.shape[1] - px)], 'symmetric')
+
+    def __call__(self, s, out=None):
+        import scipy.fftpack
+        if out is None:
+            out = numpy.empty(s.shape, numpy.float32)
+        (py, px), (h, w) = self.pad, self.shape
+        for c in range(0, s.shape[2], 2):
+            self.work.real = self.padChannel(s[:, :, c])
+            self.work.imag = self.padChannel(s[:, :, c + 1]) if c + 1 < s.shape[2] else 0
+            f = scipy.fftpack.fft2(self.work, overwrite_x=True)
+            f *= self.transfer
+            f = scipy.fftpack.ifft2(f, overwrite_x=True)
+            out[:, :, c] = f.real[py:py + h, px:px + w]
+            if c + 1 < s.shape[2]:
+                out[:, :, c + 1] = f.imag[py:py + h, px:px + w]
+        return out
+
+def blurPlan(shape, sigma):
+    key = (tuple(shape), sigma)
+    if key not in blur_plans:
+        blur_plans[key] = FftBlur(shape, sigma)
+    return blur_plans[key]
+
+def snapshotWindows(directory, window, step):
+    # (start, end, count) of each window over the snapshots in 'directory',
+    # where start is None for the first snapshot (an empty sum)
+    found = []
+    for path in glob.glob(os.path.join(directory, 'sum-*.npy')):
+        m = re.search(r'sum-(\d+)\.npy$', path)
+        if m:
+            found.append((int(m.group(1)), path))
+    found.sort()
+    snapshots = [(0, None)] + found
+    return [(snapshots[i][1], snapshots[i + window][1], snapshots[i + window][0] - snapshots[i][0])
+        for i in range(0, len(snapshots) - window, step)]
+
+def fileWindows(filenames):
+    return [(None, f, process_sum.imageCount(f) or 1) for f in filenames]
+
+def loadMean(frame):
+    # A window's mean image in single precision, reading the sums memmapped
+    start, end, count = frame
+    s = numpy.load(end, mmap_mode='r')
+    base = numpy.load(start, mmap_mode='r') if start else None
+    mean = numpy.empty(s.shape, numpy.float32)
+    n = process_sum.save_chunk_rows
+    for y in range(0, s.shape[0], n):
+        rows = s[y:y + n].astype(numpy.float64)
+        if base is not None:
+            rows -= base[y:y + n]
+        mean[y:y + n] = rows / max(count, 1)
+    return mean
+
+def lowpassPath(work_dir, index):
+    return os.path.join(work_dir, 'lowpass-%05d.npy' % index)
+
+def measureFrame(task):
+    # First pass: the frame's channel range, and the raw high-pass range
+    # over the center, saving its lowpass for the second pass
+    index, frame, work_dir, mode = task
+    mean = loadMean(frame)
+    frame_stats = stats.computeStats(mean, histogram=mode == 'percentile')
+    value_range = stats.statsRange(frame_stats, mode, frame_stats.get('histogram'),
+        process_sum.percentile_range)
+
+    lowpass = blurPlan(mean.shape[:2], mean.shape[1] * lowpass_sigma)(mean)
+    numpy.save(lowpassPath(work_dir, index), lowpass)
+    y0, y1, x0, x1 = stats.centerRegion(mean.shape)
+    center = mean[y0:y1, x0:x1] - lowpass[y0:y1, x0:x1]
+    channels = mean.shape[2]
+    return (numpy.broadcast_to(value_range[0], channels).astype(float),
+        numpy.broadcast_to(value_range[1], channels).astype(float),
+        center.min(axis=(0, 1)), center.max(axis=(0, 1)))
+
+def smoothRanges(measured):
+    # Per-frame ranges, smoothed over time. The high-pass range scales with
+    # the channel range, so it's smoothed in those units.
+    lo, hi, hp_lo, hp_hi = [numpy.array(a) for a in zip(*measured)]
+    hp_lo, hp_hi = hp_lo / (hi - lo), hp_hi / (hi - lo)
+    if range_smoothing and len(measured) > 1:
+        import scipy.ndimage
+        lo, hi, hp_lo, hp_hi = [scipy.ndimage.gaussian_filter1d(a, range_smoothing, axis=0,
+            mode='nearest') for a in (lo, hi, hp_lo, hp_hi)]
+    return zip(lo, hi, hp_lo, hp_hi)
+
+def renderFrame(task):
+    # Second pass: one frame of video_output with the smoothed ranges, ready
+    # to write out
+    index, frame, work_dir, ranges = task
+    lo, hi, hp_lo, hp_hi = ranges
+    mean = loadMean(frame)
+    path = lowpassPath(work_dir, index)
+    lowpass = numpy.load(path)
+    os.remove(path)
+
+    if video_output in ('channel-percentile', 'channel-minmax'):
+        image = process_sum.scaleRange(mean, (lo, hi), out=mean)
+    elif video_output == 'lowpass':
+        image = process_sum.scaleRange(lowpass, (lo, hi), out=lowpass)
+    else:
+        # Scaling cancels out of the difference, apart from the factor
+        image = numpy.subtract(mean, lowpass, out=mean)
+        image /= (hi - lo).astype(numpy.float32)
+        if video_output == 'highpass-sq':
+            image *= image
+            hp_lo, hp_hi = 0, numpy.maximum(hp_lo ** 2, hp_hi ** 2)
+        image = process_sum.scaleRange(image, (hp_lo, hp_hi), out=image)
+
+    q = process_sum.quantize(image, output_gamma.get(video_output))
+    if video_format == 'y4m':
+        return y4mFrame(q)
+    elif video_format == 'rgb48':
+        return q.astype('<u2').tostring()
+    return q
+
+def y4mFrame(q):
+    # 16-bit RGB to 8-bit limited range BT.601 Y, Cb, Cr planes
+    rgb = q.astype(numpy.float32) / 65535
+    r, g, b = rgb[:, :, 0], rgb[:, :, 1], rgb[:, :, 2]
+    planes = [
+        16 + 219 * (0.299 * r + 0.587 * g + 0.114 * b),
+        128 + 224 * (-0.168736 * r - 0.331264 * g + 0.5 * b),
+        128 + 224 * (0.5 * r - 0.418688 * g - 0.081312 * b),
+    ]
+    return 'FRAME\n' + ''.join(numpy.clip(p + 0.5, 0, 255).astype(numpy.uint8).tostring()
+        for p in planes)
+
+def inOrder(pool, func, tasks, limit):
+    # Results of func(task) in task order, running on the pool with at most
+    # 'limit' tasks queued, running or waiting to be consumed
+    pending = []
+    for task in tasks:
+        if len(pending) >= limit:
+            yield pending.pop(0).get()
+        pending.append(pool.apply_async(func, (task,)))
+    for result in pending:
+        yield result.get()
+
+def openStream(shape, stdout):
+    f = stdout if video_file == '-' else open(video_file, 'wb')
+    if video_format == 'y4m':
+        f.write('YUV4MPEG2 W%d H%d F%d:1 Ip A1:1 C444\n' % (shape[1], shape[0], frame_rate))
+    return f
+
+def main():
+    if len(sys.argv) > 1:
+        frames = fileWindows(sys.argv[1:])
+    else:
+        frames = snapshotWindows(snapshot_dir, window, step)
+    frames = [f for f in frames if f[2] > 0]
+    if not frames:
+        print >>sys.stderr, "No windows to render"
+        return
+    shape = numpy.load(frames[0][1], mmap_mode='r').shape
+    mode = 'percentile' if video_output == 'channel-percentile' else 'channel-minmax'
+
+    # Progress goes to stderr, in case the video is going to stdout
+    print >>sys.stderr, "Rendering %d frames of %s" % (len(frames), video_output)
+    start = time.time()
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    work_dir = tempfile.mkdtemp(prefix='render-video-')
+    pool = multiprocessing.Pool(processes)
+    try:
+        measured = pool.map(measureFrame, [(i, f, work_dir, mode) for i, f in enumerate(frames)], 1)
+        tasks = [(i, f, work_dir, r) for i, (f, r) in enumerate(zip(frames, smoothRanges(measured)))]
+
+        stream = None
+        if video_format != 'tiff':
+            stream = openStream(shape, stdout)
+        elif not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+        for i, result in enumerate(inOrder(pool, renderFrame, tasks, max_in_flight)):
+            if stream:
+                stream.write(result)
+            else:
+                process_sum.writeQuantized(os.path.join(output_dir, 'frame-%05d.tiff' % i), result)
+        if stream:
+            stream.flush()
+    finally:
+        pool.terminate()
+        shutil.rmtree(work_dir)
+        sys.stdout = stdout
+    print >>sys.stderr, "Rendered %d frames in %.1fs" % (len(frames), time.time() - start)
+
+
+if __name__ == '__main__':
+    main()
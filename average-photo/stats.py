@@ -0,0 +1,202 @@
+#
+# Summary statistics of a sum buffer, for scaling it to the output range.
+#
+# tileStats() gets the per-channel min, max and sum, plus the min and max
+# over the center region, in one pass over the data: it works through a few
+# rows at a time, so every reduction after the first reads from cache rather
+# than memory. Tiles are merged with combineStats(). A 16-bit histogram of
+# each channel has to know the range first, so it's a second pass
+# (tileHistogram / combineHistogram); it gives percentiles in O(bins)
+# without sorting anything.
+#
+# Stats for a .npy file are cached in a JSON sidecar next to it, keyed by
+# the content hash, and reused without rehashing while the file's size and
+# mtime are unchanged.
+#
+
+import os
+import json
+import numpy
+import fileio
+import pipeline
+
+histogram_bins = 65536
+
+# Rows per step are chosen to keep each step about this size
+chunk_bytes = 1 << 20
+
+def centerRegion(shape):
+    # The middle 1/5 of the image, as (y0, y1, x0, x1)
+    dim = (shape[0]//5, shape[1]//5)
+    margin = ((shape[0] - dim[0]) // 2, (shape[1] - dim[1]) // 2)
+    return margin[0], margin[0] + dim[0], margin[1], margin[1] + dim[1]
+
+def chunkRows(s):
+    return max(1, chunk_bytes // max(s[:1].nbytes, 1))
+
+def tileStats(s, origin=(0, 0), frame=None, halo=(0, 0)):
+    # Partial stats for one tile at 'origin' in a frame of shape 'frame'
+    frame = frame or s.shape[:2]
+    channels = s.shape[2]
+    cy0, cy1, cx0, cx1 = centerRegion(frame)
+    cy0, cy1 = cy0 - origin[0], cy1 - origin[0]
+    cx0, cx1 = max(cx0 - origin[1], 0), max(cx1 - origin[1], 0)
+
+    mins = numpy.full(channels, numpy.inf)
+    maxs = numpy.full(channels, -numpy.inf)
+    sums = numpy.zeros(channels)
+    center_mins = mins.copy()
+    center_maxs = maxs.copy()
+
+    step = chunkRows(s)
+    for y in range(0, s.shape[0], step):
+        rows = s[y:y+step]
+        numpy.minimum(mins, rows.min(axis=(0, 1)), out=mins)
+        numpy.maximum(maxs, rows.max(axis=(0, 1)), out=maxs)
+        sums += rows.sum(axis=(0, 1), dtype=float)
+
+        center = rows[max(cy0 - y, 0):max(cy1 - y, 0), cx0:cx1]
+        if center.size:
+            numpy.minimum(center_mins, center.min(axis=(0, 1)), out=center_mins)
+            numpy.maximum(center_maxs, center.max(axis=(0, 1)), out=center_maxs)
+
+    return {
+        'count': s.shape[0] * s.shape[1],
+        'min': mins, 'max': maxs, 'sum': sums,
+        'center_min': center_mins, 'center_max': center_maxs,
+    }
+
+def combineStats(parts):
+    # Merge tileStats() results into plain lists and numbers, ready for JSON
+    count = sum(p['count'] for p in parts)
+    sums = numpy.sum([p['sum'] for p in parts], axis=0)
+    result = {
+        'count': count,
+        'min': numpy.min([p['min'] for p in parts], axis=0).tolist(),
+        'max': numpy.max([p['max'] for p in parts], axis=0).tolist(),
+        'mean': (sums / max(count, 1)).tolist(),
+        'center_min': numpy.min([p['center_min'] for p in parts], axis=0).tolist(),
+        'center_max': numpy.max([p['center_max'] for p in parts], axis=0).tolist(),
+    }
+    print "Value range [%s, %s]" % (result['min'], result['max'])
+    return result
+
+def binScale(stats, bins):
+    # Histogram bin width per channel, over that channel's [min, max]
+    lo = numpy.array(stats['min'])
+    return lo, numpy.maximum(numpy.array(stats['max']) - lo, 1e-300) / bins
+
+def tileHistogram(s, stats, bins=histogram_bins):
+    lo, width = binScale(stats, bins)
+    hist = numpy.zeros((s.shape[2], bins), numpy.int64)
+    step = chunkRows(s)
+    for y in range(0, s.shape[0], step):
+        for c in range(s.shape[2]):
+            index = ((s[y:y+step, :, c] - lo[c]) / width[c]).astype(int)
+            numpy.clip(index, 0, bins - 1, out=index)
+            hist[c] += numpy.bincount(index.ravel(), minlength=bins)
+    return hist
+
+def combineHistogram(parts):
+    return sum(parts)
+
+def percentileRange(stats, histogram, low=0.1, high=99.9):
+    # Per-channel values below which 'low' and 'high' percent of pixels fall,
+    # to the nearest histogram bin
+    histogram = numpy.asarray(histogram)
+    lo, width = binScale(stats, histogram.shape[1])
+    cdf = numpy.cumsum(histogram, axis=1)
+    total = cdf[:, -1].astype(float)
+    first = [numpy.searchsorted(cdf[c], total[c] * low / 100.0, 'right') for c in range(len(cdf))]
+    last = [numpy.searchsorted(cdf[c], total[c] * high / 100.0, 'left') for c in range(len(cdf))]
+    return lo + numpy.array(first) * width, lo + (numpy.array(last) + 1) * width
+
+def statsRange(stats, mode, histogram=None, percentiles=(0.1, 99.9)):
+    # The (min, max) to scale to [0, 1] for each scaling mode
+    if mode == 'single-max':
+        return 0, max(stats['max'])
+    elif mode == 'single-minmax':
+        return min(stats['min']), max(stats['max'])
+    elif mode == 'channel-minmax':
+        return numpy.array(stats['min']), numpy.array(stats['max'])
+    elif mode == 'center-minmax':
+        return numpy.array(stats['center_min']), numpy.array(stats['center_max'])
+    elif mode == 'percentile':
+        return percentileRange(stats, histogram, *percentiles)
+    raise ValueError("unknown scaling mode %r" % mode)
+
+def computeStats(s, executor=None, histogram=True):
+    # Stats for a whole frame, tile by tile if there's an executor
+    if executor:
+        result = executor.reduce(tileStats, combineStats, [s], positional=True)
+        if histogram:
+            result['histogram'] = executor.reduce(tileHistogram, combineHistogram, [s, result])
+    else:
+        result = combineStats([tileStats(s)])
+        if histogram:
+            result['histogram'] = tileHistogram(s, result)
+    return result
+
+def rescaleStats(stats, factor):
+    # Stats of the same image multiplied by 'factor' (> 0). The histogram
+    # bins scale with the range, so its counts don't change.
+    result = dict(stats)
+    for k in ('min', 'max', 'mean', 'center_min', 'center_max'):
+        result[k] = (numpy.array(stats[k]) * factor).tolist()
+    return result
+
+def mergeStats(parts, bins=histogram_bins):
+    # Stats of several images taken together. Each histogram is rebinned
+    # onto the combined range by its bin centers, so percentiles are still
+    # good to a bin or so.
+    count = sum(p['count'] for p in parts)
+    result = {
+        'count': count,
+        'min': numpy.min([p['min'] for p in parts], axis=0).tolist(),
+        'max': numpy.max([p['max'] for p in parts], axis=0).tolist(),
+        'mean': (numpy.sum([numpy.array(p['mean']) * p['count'] for p in parts], axis=0)
+            / max(count, 1)).tolist(),
+        'center_min': numpy.min([p['center_min'] for p in parts], axis=0).tolist(),
+        'center_max': numpy.max([p['center_max'] for p in parts], axis=0).tolist(),
+    }
+    if all('histogram' in p for p in parts):
+        lo, width = binScale(result, bins)
+        hist = numpy.zeros((len(lo), bins), numpy.int64)
+        for p in parts:
+            part = numpy.asarray(p['histogram'])
+            part_lo, part_width = binScale(p, part.shape[1])
+            centers = numpy.arange(part.shape[1]) + 0.5
+            for c in range(len(lo)):
+                index = ((part_lo[c] + centers * part_width[c] - lo[c]) / width[c]).astype(int)
+                numpy.clip(index, 0, bins - 1, out=index)
+                hist[c] += numpy.bincount(index, part[c], bins).astype(numpy.int64)
+        result['histogram'] = hist
+    return result
+
+def sidecarPath(filename):
+    return os.path.splitext(filename)[0] + '.stats.json'
+
+def fileStats(filename, s=None, executor=None):
+    # Stats for the .npy 'filename', from its sidecar if that's still valid.
+    # The result's 'key' is the content hash, as pipeline.hashArray() gives.
+    path = sidecarPath(filename)
+    st = os.stat(filename)
+    cached = None
+    if os.path.exists(path):
+        cached = json.load(open(path))
+        if cached.get('size') == st.st_size and cached.get('mtime') == st.st_mtime:
+            return cached
+
+    if s is None:
+        s = numpy.load(filename, mmap_mode='r')
+    print "Hashing %s" % filename
+    key = pipeline.hashArray(s)
+    if not cached or cached.get('key') != key:
+        print "Computing stats for %s" % filename
+        cached = computeStats(s, executor)
+        cached['histogram'] = cached['histogram'].tolist()
+        cached['key'] = key
+
+    cached.update(size=st.st_size, mtime=st.st_mtime)
+    fileio.writeAtomic(path, json.dumps(cached))
+    return cached
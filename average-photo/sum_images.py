@@ -4,19 +4,78 @@
 # sum them into a big buffer and save that buffer to a numpy data file.
 #
 
-import os, numpy, Image, multiprocessing
+import os, re, json, math, time, struct, random, urllib2, hashlib, resource, numpy, Image, multiprocessing
+import metrics, tifffile
+from cStringIO import StringIO
+
+try:
+    import ImageCms
+except ImportError:
+    ImageCms = None
 
 input_dir = 'downloads'
 failed_dir = 'failed'
 completed_dir = 'completed'
 output_file = 'sum.npy'
+count_file = 'sum.json'
+
+# If set, a copy of the sum is also kept here at every checkpoint, named by
+# the image count so far (sum-000012000.npy), for render_video.py to take
+# differences of
+snapshot_dir = None
+
+# Catalog listings (as used by get_urls.py) let us bucket images by decade
+# when choosing a processing order. Without them we fall back to the day
+# each file was downloaded.
+catalog_files = []
+
+# Optionally also keep an exponential moving average of the images, for a
+# view of what the collection looks like lately. Each image's weight halves
+# every ema_half_life images processed after it, or with ema_units = 'years',
+# every ema_half_life catalog years it is older than the newest year in the
+# catalog (images without a year are left out). The average is a float32
+# buffer and its total weight, so it costs the same however long it runs.
+ema_file = 'ema.npy'
+ema_state_file = 'ema.json'
+ema_half_life = None
+ema_units = 'images'
+
+# Workers weight each image by the growth factor since the start of their
+# batch instead of decaying their buffer per image, dividing through only when
+# the weights pass this
+ema_rescale_limit = 2.0 ** 32
+
+# At every checkpoint we write a small preview of the mean image and an
+# estimate of its per-pixel standard error, both at preview resolution.
+preview_file = 'preview.png'
+stderr_file = 'stderr.npy'
+preview_size = 128
+
+# Optionally stop once the mean image has converged: the largest change in
+# the preview between checkpoints, relative to its brightest value.
+convergence_threshold = None
+
+# Live progress is written to a JSON status file every few seconds. It can
+# also go to a Prometheus textfile, or be served over HTTP on localhost.
+status_file = 'status.json'
+prometheus_file = None
+metrics_port = None
+metrics_interval = 10
 
 # Process concurrently in small batches and checkpoint periodically.
 # Batches should be fairly large to amortize the cost of checkpointing
-# the sum buffer.
+# the sum buffer, but small enough that a crash doesn't lose much work.
+#
+# batch_size_per_cpu is only the starting point. We time each batch and
+# each checkpoint as we go, and resize batches so that checkpointing takes
+# at most checkpoint_overhead of the total time, without letting a single
+# batch run longer than max_batch_seconds.
 
 num_cpus = multiprocessing.cpu_count()
 batch_size_per_cpu = 400
+min_batch_size_per_cpu = 10
+checkpoint_overhead = 0.02
+max_batch_seconds = 3600
 
 square_size = 1024
 
@@ -37,27 +96,408 @@ def saveBuffer(buffer):
     print "Writing results"
     numpy.save(output_file, buffer)
 
-def makeLUT():
+def emaDecay():
+    # Weight lost per image in 'images' mode
+    return 0.5 ** (1.0 / ema_half_life)
+
+def yearWeight(year, reference_year):
+    return 0.5 ** ((reference_year - year) / float(ema_half_life))
+
+def loadEma():
+    # The moving average buffer and its state, starting over if the settings
+    # it was made with have changed
+    settings = {'half_life': ema_half_life, 'units': ema_units}
+    if os.path.exists(ema_file) and os.path.exists(ema_state_file):
+        state = json.load(open(ema_state_file))
+        if all(state.get(k) == v for k, v in settings.items()):
+            return numpy.load(ema_file), state
+        print "EMA settings changed, starting a new average"
+    return numpy.zeros((square_size, square_size, 3), numpy.float32), dict(settings,
+        weight=0.0, count=0, reference_year=None)
+
+def saveEma(buffer, state):
+    numpy.save(ema_file, buffer)
+    json.dump(state, open(ema_state_file, 'w'))
+
+def accumulateEma(ema, state, results, reference_year):
+    # Fold the workers' weighted batch sums into the average. The decay for
+    # the whole checkpoint is applied to the buffer in one multiply: in
+    # 'images' mode each batch is treated as coming after the ones before it,
+    # so it's decayed by the images in the batches after it.
+    if ema_units == 'years':
+        previous = state['reference_year']
+        if previous is not None and reference_year > previous:
+            decay = yearWeight(previous, reference_year)
+            ema *= decay
+            state['weight'] *= decay
+        state['reference_year'] = reference_year
+        later = [0] * len(results)
+    else:
+        sizes = [len(file_list) for buf, file_list, stats, batch_ema in results]
+        later = [sum(sizes[i + 1:]) for i in range(len(sizes))]
+        decay = emaDecay() ** sum(sizes)
+        ema *= decay
+        state['weight'] *= decay
+
+    for (buf, file_list, stats, batch_ema), n in zip(results, later):
+        if batch_ema is None:
+            continue
+        batch_buf, batch_weight = batch_ema
+        decay = emaDecay() ** n if ema_units != 'years' else 1.0
+        batch_buf *= decay
+        ema += batch_buf
+        state['weight'] += batch_weight * decay
+        state['count'] += len(file_list)
+
+def saveSnapshot(buffer, count):
+    if not os.path.isdir(snapshot_dir):
+        os.makedirs(snapshot_dir)
+    numpy.save(os.path.join(snapshot_dir, 'sum-%09d.npy' % count), buffer)
+
+luts = {}
+
+def makeLUT(bits=8):
     # Make a lookup table for converting sRGB to linear RGB in 16-bit precision.
     # This does our whole mapping in one step, including conversion to uint64 type :)
-    return (pow(numpy.arange(256) / 255.0, 2.2) * 0xFFFF).astype(numpy.uint64)
-
-def prepareBatches():
+    # Tables are cached per bit depth; the 16-bit one has 65536 entries.
+    if bits not in luts:
+        top = float((1 << bits) - 1)
+        luts[bits] = (pow(numpy.arange(1 << bits) / top, 2.2) * 0xFFFF).astype(numpy.uint64)
+    return luts[bits]
+
+def openImage(path):
+    # Returns either a PIL image for the usual 8-bit path, or a
+    # (height, width, 3) uint16 array for sources with more than 8 bits
+    # per sample. PIL can't read 16-bit RGB TIFFs, so TIFFs go through tifffile.
+    # Also returns the embedded ICC profile, if any.
+    a = profile = None
+    bits = 16
+    if open(path, 'rb').read(4) in ('II*\0', 'MM\0*'):
+        with tifffile.TiffFile(path) as tif:
+            page = tif[0]
+            # A tuple if the samples differ in width
+            page_bits = page.bits_per_sample
+            if isinstance(page_bits, tuple):
+                page_bits = max(page_bits)
+            if page_bits > 8 and page.sample_format in ('uint', 'int'):
+                a = page.asarray()
+                if a.ndim == 3 and page.axes[0] in 'SC':
+                    # Planar configuration, or a palette: samples first
+                    a = numpy.rollaxis(a, 0, 3)
+                if not page.is_palette:
+                    bits = page_bits
+                if 'icc_profile' in page.tags:
+                    profile = page.tags['icc_profile'].value.tostring()
+
+    if a is None:
+        img = Image.open(path)
+        profile = img.info.get('icc_profile')
+        if img.mode not in ('I;16', 'I;16B', 'I;16L', 'I'):
+            return img, profile
+        a = numpy.asarray(img)
+
+    if a.ndim == 2:
+        a = a[:, :, numpy.newaxis]
+    if a.shape[2] < 3:
+        # Grey, maybe with alpha: drop the alpha and use the grey for all
+        # three channels. An ICC profile would be a grey one.
+        a = numpy.repeat(a[:, :, :1], 3, axis=2)
+        profile = None
+    a = numpy.clip(a[:, :, :3], 0, (1 << bits) - 1)
+    if bits != 16:
+        # 12- and 14-bit scans stored in 16 bits, or 32-bit samples, scaled
+        # to the full 16-bit range
+        a = (a.astype(numpy.uint64) * 0xFFFF + ((1 << bits) - 1) // 2) // ((1 << bits) - 1)
+    return a.astype(numpy.uint16), profile
+
+# Images with an embedded ICC profile are converted to sRGB through a 3D
+# lookup table with profile_lut_size points per axis, built once per distinct
+# profile in each worker and applied with trilinear interpolation. Images
+# without a profile, or with an sRGB one, use the plain 1D table.
+#
+# PIL's littleCMS transforms only do 8 bits per channel, which would round
+# every grid point to 8 bits and lose what 16-bit sources have. So the usual
+# matrix/TRC RGB profiles are evaluated here in floating point from their
+# colorants and tone curves, and only LUT-based profiles go through
+# littleCMS.
+profile_lut_size = 33
+profile_luts = {}
+node_tables = {}
+
+# sRGB's colorants, adapted to the D50 white of the profile connection space
+srgb_colorants = numpy.array([
+    [0.4360747, 0.2225045, 0.0139322],
+    [0.3850649, 0.7168786, 0.0971045],
+    [0.1430804, 0.0606169, 0.7141733],
+])
+
+def profileTags(profile):
+    # Tag signature -> data of an ICC profile
+    count = struct.unpack('>I', profile[128:132])[0]
+    tags = {}
+    for i in range(count):
+        sig, offset, size = struct.unpack('>4sII', profile[132 + 12 * i:144 + 12 * i])
+        tags[sig] = profile[offset:offset + size]
+    return tags
+
+def toneCurve(data, x):
+    # Evaluate a curv or para tag at x in [0, 1]
+    kind = data[:4]
+    if kind == 'curv':
+        count = struct.unpack('>I', data[8:12])[0]
+        if count == 0:
+            return x
+        if count == 1:
+            return x ** (struct.unpack('>H', data[12:14])[0] / 256.0)
+        table = numpy.frombuffer(data, '>u2', count, 12) / 65535.0
+        return numpy.interp(x, numpy.linspace(0, 1, count), table)
+    if kind == 'para':
+        function = struct.unpack('>H', data[8:10])[0]
+        n = {0: 1, 1: 3, 2: 4, 3: 5, 4: 7}[function]
+        params = [v / 65536.0 for v in struct.unpack('>%di' % n, data[12:12 + 4 * n])]
+        g, a, b, c, d, e, f = params + [1.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0][len(params):]
+        if function == 0:
+            return x ** g
+        if function == 1:
+            d = -b / a
+        elif function == 2:
+            d, e = -b / a, c
+        power = numpy.maximum(a * x + b, 0) ** g
+        if function in (1, 2):
+            return numpy.where(x >= d, power + e, e)
+        if function == 3:
+            return numpy.where(x >= d, power, c * x)
+        return numpy.where(x >= d, power + e, c * x + f)
+    raise ValueError("unknown tone curve type %r" % kind)
+
+def matrixProfileLUT(profile, nodes):
+    # The profile LUT of a matrix/TRC RGB profile in floating point, or None
+    # for other kinds of profile
+    if len(profile) < 132 or profile[16:20] != 'RGB ' or profile[20:24] != 'XYZ ':
+        return None
+    tags = profileTags(profile)
+    needed = ['rXYZ', 'gXYZ', 'bXYZ', 'rTRC', 'gTRC', 'bTRC']
+    if 'A2B0' in tags or not all(t in tags for t in needed):
+        return None
+    colorants = numpy.array([[v / 65536.0 for v in struct.unpack('>3i', tags[t][8:20])]
+        for t in needed[:3]])
+    x = nodes / 255.0
+    curves = [toneCurve(tags[t], x) for t in needed[3:]]
+
+    n = len(nodes)
+    rgb = numpy.empty((n, n, n, 3))
+    rgb[..., 0] = curves[0][:, None, None]
+    rgb[..., 1] = curves[1][None, :, None]
+    rgb[..., 2] = curves[2][None, None, :]
+    # Source RGB -> XYZ -> linear sRGB, clipped to its gamut, then encoded
+    # with the sRGB curve as littleCMS would output it
+    linear = numpy.clip(numpy.dot(rgb, numpy.dot(colorants, numpy.linalg.inv(srgb_colorants))), 0, 1)
+    srgb = numpy.where(linear > 0.0031308, 1.055 * linear ** (1 / 2.4) - 0.055, 12.92 * linear)
+    return (pow(srgb, 2.2) * 0xFFFF).astype(numpy.float32)
+
+def makeProfileLUT(profile):
+    # Push a grid of RGB values through the profile once, and linearise the
+    # sRGB results the same way makeLUT() does. Returns None if the profile
+    # is sRGB already or can't be used.
+    if ImageCms is None:
+        return None
+    try:
+        source = ImageCms.ImageCmsProfile(StringIO(profile))
+        if 'sRGB' in ImageCms.getProfileDescription(source):
+            return None
+        nodes = profileNodes()
+        try:
+            lut = matrixProfileLUT(profile, nodes)
+        except (struct.error, ValueError, KeyError, ZeroDivisionError, numpy.linalg.LinAlgError):
+            lut = None
+        if lut is not None:
+            return lut
+        transform = ImageCms.buildTransform(source, ImageCms.createProfile('sRGB'), 'RGB', 'RGB')
+    except (ImageCms.PyCMSError, IOError, TypeError):
+        return None
+
+    n = profile_lut_size
+    grid = numpy.empty((n, n, n, 3), numpy.uint8)
+    grid[..., 0] = nodes[:, None, None]
+    grid[..., 1] = nodes[None, :, None]
+    grid[..., 2] = nodes[None, None, :]
+
+    img = ImageCms.applyTransform(Image.fromarray(grid.reshape(n * n, n, 3), 'RGB'), transform)
+    srgb = numpy.asarray(img, numpy.float32).reshape(n, n, n, 3)
+    return (pow(srgb / 255.0, 2.2) * 0xFFFF).astype(numpy.float32)
+
+def profileNodes():
+    # 8-bit input values at each grid point of a profile LUT
+    return numpy.round(numpy.linspace(0, 255, profile_lut_size)).astype(numpy.uint8)
+
+def getProfileLUT(profile):
+    key = hashlib.sha1(profile).hexdigest()
+    if key not in profile_luts:
+        profile_luts[key] = makeProfileLUT(profile)
+    return profile_luts[key]
+
+def nodeTables(bits):
+    # For every possible input value, the grid cell it falls in and its
+    # fractional position inside that cell.
+    if bits not in node_tables:
+        nodes = profileNodes().astype(numpy.float32)
+        values = numpy.arange(1 << bits, dtype=numpy.float32) * (255.0 / ((1 << bits) - 1))
+        cell = numpy.clip(numpy.searchsorted(nodes, values, 'right') - 1, 0, len(nodes) - 2)
+        frac = (values - nodes[cell]) / (nodes[cell + 1] - nodes[cell])
+        node_tables[bits] = cell.astype(numpy.intp), frac.astype(numpy.float32)
+    return node_tables[bits]
+
+def applyProfileLUT(lut, f, bits):
+    # Vectorised trilinear interpolation of an (h, w, 3) image through a 3D
+    # LUT. Each of the eight cell corners is one gather over the whole image.
+    cell, frac = nodeTables(bits)
+    i = cell[f]
+    t = frac[f]
+    n = lut.shape[0]
+    flat = lut.reshape(-1, 3)
+    base = (i[..., 0] * n + i[..., 1]) * n + i[..., 2]
+    tr, tg, tb = [numpy.ascontiguousarray(t[..., c:c+1]) for c in range(3)]
+
+    def lerp(lo, hi, weight):
+        hi -= lo
+        hi *= weight
+        hi += lo
+        return hi
+
+    def lerpB(offset):
+        return lerp(numpy.take(flat, base + offset, axis=0),
+            numpy.take(flat, base + (offset + 1), axis=0), tb)
+
+    c0 = lerp(lerpB(0), lerpB(n), tg)
+    c1 = lerp(lerpB(n * n), lerpB(n * n + n), tg)
+    c = lerp(c0, c1, tr)
+    c += 0.5
+    return c.astype(numpy.uint64)
+
+def resizeHighBitDepth(a, size):
+    # PIL only resizes high-bit-depth data one float channel at a time
+    channels = []
+    for c in range(a.shape[2]):
+        plane = Image.fromarray(a[:, :, c].astype(numpy.float32), 'F').resize(size, Image.ANTIALIAS)
+        channels.append(numpy.asarray(plane, numpy.float32))
+    f = numpy.dstack(channels)
+    return numpy.clip(f + 0.5, 0, 0xFFFF).astype(numpy.uint16)
+
+def loadCount():
+    # Number of images already summed into the buffer
+    if os.path.exists(count_file):
+        return json.load(open(count_file))['count']
+    elif os.path.exists(output_file):
+        return len(os.listdir(completed_dir))
+    else:
+        return 0
+
+def saveCount(count):
+    json.dump({'count': count}, open(count_file, 'w'))
+
+def loadCatalogYears():
+    # Map download filenames back to the year in their catalog entry
+    years = {}
+    for path in catalog_files:
+        for item in json.load(open(path)):
+            m = re.search(r'\d{4}', item.get('date') or '')
+            if item.get('image') and m:
+                years[urllib2.quote(item['image'], '') + '.jpeg'] = int(m.group())
+    return years
+
+def strataKey(filename, years):
+    # Bucket by decade (or download day) and by order of magnitude of file size
+    st = os.stat(os.path.join(input_dir, filename))
+    year = years.get(filename)
+    if year is None:
+        date = 'day-%d' % (st.st_mtime // 86400)
+    else:
+        date = year // 10
+    return date, int(math.log(max(st.st_size, 1), 2))
+
+def stratifiedOrder(filenames, years):
+    # Shuffle within each stratum, then spread each stratum evenly across the
+    # whole order. Any prefix of the result samples every stratum in
+    # proportion to its size, so early checkpoints aren't biased toward
+    # whatever the filesystem happens to list first.
+    strata = {}
+    for f in filenames:
+        strata.setdefault(strataKey(f, years), []).append(f)
+
+    keyed = []
+    for members in strata.values():
+        random.shuffle(members)
+        for i, f in enumerate(members):
+            keyed.append(((i + random.random()) / len(members), f))
+
+    keyed.sort()
+    return [f for position, f in keyed]
+
+def prepareBatches(years, batch_size):
     # Divide up images into per-CPU batches
     batches = [[] for i in range(num_cpus)]
     count = 0
 
-    for f in os.listdir(input_dir):
-        if f.startswith('.'):
-            continue
+    filenames = [f for f in os.listdir(input_dir) if not f.startswith('.')]
+    for f in stratifiedOrder(filenames, years):
         batch = batches[count % num_cpus]
         batch.append(f)
         count += 1
-        if count >= batch_size_per_cpu * num_cpus:
+        if count >= batch_size * num_cpus:
             break
 
     print "Starting batch of %d images on %d CPUs" % (count, num_cpus)
-    return batches, count
+    return batches, count, len(filenames) - count
+
+def downsample(buffer):
+    # Box-filter a sum buffer down to preview resolution
+    k = square_size // preview_size
+    return buffer.reshape(preview_size, k, preview_size, k, 3).mean(axis=3).mean(axis=1)
+
+def savePreview(mean):
+    # Mean image as an 8-bit sRGB preview, scaled by its brightest value
+    peak = numpy.max(mean) or 1.0
+    srgb = pow(mean / peak, 1 / 2.2) * 255.0
+    Image.fromarray(numpy.clip(srgb + 0.5, 0, 255).astype(numpy.uint8)).save(preview_file)
+
+def standardError(results, count):
+    # Estimate the per-pixel standard error of the running mean from the
+    # spread between each worker's batch mean, using batch-means variance.
+    # This only touches preview-sized arrays, so it's cheap to do per checkpoint.
+    batches = [(downsample(buf) / len(file_list), len(file_list))
+        for buf, file_list, stats, batch_ema in results if file_list]
+    if len(batches) < 2:
+        return None
+
+    batch_total = sum(n for m, n in batches)
+    batch_mean = sum(m * n for m, n in batches) / batch_total
+    variance = sum(n * (m - batch_mean) ** 2 for m, n in batches) / (len(batches) - 1)
+    return numpy.sqrt(variance / count).astype(numpy.float32)
+
+def checkpointPreview(sum_buffer, count, results, previous):
+    # Write the preview and standard error, and return the preview mean along
+    # with the largest relative change since the previous checkpoint.
+    print "Writing preview"
+    mean = downsample(sum_buffer) / count
+    savePreview(mean)
+
+    se = standardError(results, count)
+    if se is not None:
+        numpy.save(stderr_file, se)
+
+    if previous is None:
+        return mean, None
+    change = numpy.max(numpy.abs(mean - previous)) / (numpy.max(mean) or 1.0)
+    print "Mean changed by %g since last checkpoint" % change
+    return mean, change
+
+def tuneBatchSize(image_seconds, checkpoint_seconds):
+    # Pick the per-CPU batch size that keeps checkpoint cost at our target
+    # fraction of the total, given the wall time per image across the pool.
+    batch_seconds = checkpoint_seconds * (1 - checkpoint_overhead) / checkpoint_overhead
+    batch_seconds = min(batch_seconds, max_batch_seconds)
+    batch_size = int(math.ceil(batch_seconds / max(image_seconds, 1e-6) / num_cpus))
+    return max(min_batch_size_per_cpu, batch_size)
 
 def moveCompletedFiles(fileList):
     print "Moving completed files"
@@ -69,69 +509,206 @@ def moveCompletedFiles(fileList):
 def moveFailedFile(filename):
     os.rename(os.path.join(input_dir, filename), os.path.join(failed_dir, filename))
 
+# Shared (images, bytes) counters, handed to each worker by the pool, and
+# catalog years with the newest of them, for EMA weights in 'years' mode
+progress = None
+worker_years = None
+worker_reference_year = None
+
+def initWorker(shared_progress, years=None, reference_year=None):
+    global progress, worker_years, worker_reference_year
+    progress = shared_progress
+    worker_years = years
+    worker_reference_year = reference_year
+
 def worker(batch):    
     file_list = []
+    failures = {}
     buf = newBuffer()
     lut = makeLUT()
+    lut16 = makeLUT(16)
+
+    # Image i of the batch is weighted growth**i, relative to the scale of
+    # ema_weight. Dividing by the last image's weight at the end gives each
+    # image decay**(images after it in the batch).
+    ema_buf = None
+    if ema_half_life:
+        ema_buf = numpy.zeros(buf.shape, numpy.float32)
+        ema_weight = 0.0
+        growth = 1 / emaDecay()
+        scale = 1.0
 
     for filename in batch:
         print filename
+        path = os.path.join(input_dir, filename)
 
         try:
-            img = Image.open(os.path.join(input_dir, filename))
-
-            if img.mode != 'RGB':
-                # Convert incurs an extra copy, only do this if the image isn't already RGB.
-                img = img.convert('RGB')
+            img, profile = openImage(path)
+            if isinstance(img, numpy.ndarray):
+                width, height = img.shape[1], img.shape[0]
+            else:
+                width, height = img.size
 
             # Resize so it fits in the sum buffer
-            ratio = float(square_size) / max(img.size[0], img.size[1])
-            scaled_width = int(img.size[0] * ratio)
-            scaled_height = int(img.size[1] * ratio)
+            ratio = float(square_size) / max(width, height)
+            scaled_width = int(width * ratio)
+            scaled_height = int(height * ratio)
             x_offset = int((square_size - scaled_width) / 2)
             y_offset = int((square_size - scaled_height) / 2)
 
-            img = img.resize((scaled_width, scaled_height), Image.ANTIALIAS)
+            if isinstance(img, numpy.ndarray):
+                # Keep all 16 bits through the resize and linearise with the 16-bit table
+                f = resizeHighBitDepth(img, (scaled_width, scaled_height))
+                bits, table = 16, lut16
+            else:
+                if img.mode != 'RGB':
+                    # Convert incurs an extra copy, only do this if the image isn't already RGB.
+                    img = img.convert('RGB')
+
+                img = img.resize((scaled_width, scaled_height), Image.ANTIALIAS)
 
-            # Copy to a numpy array
-            f = numpy.fromstring(img.tostring(), numpy.uint8).reshape(scaled_height, scaled_width, 3)
+                # Copy to a numpy array
+                f = numpy.fromstring(img.tostring(), numpy.uint8).reshape(scaled_height, scaled_width, 3)
+                bits, table = 8, lut
 
-        except (IOError, IndexError, SyntaxError), e:
+            profile_lut = None
+            if profile and f.shape[2] == 3:
+                profile_lut = getProfileLUT(profile)
+
+        except (IOError, IndexError, SyntaxError, ValueError), e:
             # Failed to read this image, immediately move it out of the way
             print "  failed (%r)" % e
             moveFailedFile(filename)
+            name = type(e).__name__
+            failures[name] = failures.get(name, 0) + 1
             continue
 
-        buf[y_offset:(y_offset+scaled_height), x_offset:(x_offset+scaled_width), :] += lut[f]
+        if profile_lut is not None:
+            linear = applyProfileLUT(profile_lut, f, bits)
+        else:
+            linear = table[f]
+        region = (slice(y_offset, y_offset+scaled_height), slice(x_offset, x_offset+scaled_width))
+        buf[region] += linear
         file_list.append(filename)
 
-    return buf, file_list
+        if ema_buf is not None:
+            if ema_units == 'years':
+                year = worker_years.get(filename)
+                weight = 0.0 if year is None else yearWeight(year, worker_reference_year)
+            else:
+                weight = scale
+                scale *= growth
+            if weight:
+                ema_buf[region] += numpy.multiply(linear, weight, dtype=numpy.float32)
+                ema_weight += weight
+            if scale > ema_rescale_limit:
+                ema_buf /= scale
+                ema_weight /= scale
+                scale = 1.0
+
+        if progress is not None:
+            with progress.get_lock():
+                progress[0] += 1
+                progress[1] += os.path.getsize(path)
+
+    stats = {
+        'pid': os.getpid(),
+        'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        'failures': failures,
+    }
+    batch_ema = None
+    if ema_buf is not None:
+        if ema_units != 'years' and file_list:
+            # The last image was weighted scale / growth
+            ema_buf *= growth / scale
+            ema_weight *= growth / scale
+        batch_ema = ema_buf, ema_weight
+    return buf, file_list, stats, batch_ema
 
 
 def main():
     sum_buffer = loadBuffer()
-    p = multiprocessing.Pool(num_cpus)
+    total = loadCount()
+    years = loadCatalogYears()
+    previous = None
+    if total:
+        previous = downsample(sum_buffer) / total
+
+    m = metrics.Metrics()
+    m.startWriter(metrics_interval, status_file, prometheus_file)
+    if metrics_port:
+        m.startServer(metrics_port)
+
+    ema = None
+    reference_year = None
+    if ema_half_life:
+        ema, ema_state = loadEma()
+        if ema_units == 'years':
+            if not years:
+                raise ValueError("ema_units = 'years' needs catalog_files")
+            reference_year = max(years.values())
+
+    p = multiprocessing.Pool(num_cpus, initWorker, (m.progress, reference_year and years, reference_year))
+
+    batch_size = batch_size_per_cpu
+    image_seconds = checkpoint_seconds = None
 
     while True:
         print "Loading image list"
+        checkpoint_start = time.time()
 
-        batches, count = prepareBatches()
+        batches, count, queued = prepareBatches(years, batch_size)
         if not count:
             break
 
         # Submit each batch as a separate task
+        batch_start = time.time()
         results = p.map(worker, batches, 1)
+        batch_end = time.time()
 
         print "Accumulating results"
         summed_files = []
-        for buf, file_list in results:
+        for buf, file_list, stats, batch_ema in results:
             sum_buffer += buf
             summed_files.extend(file_list)
+        m.addBatch([stats for buf, file_list, stats, batch_ema in results], queued)
+        if ema is not None:
+            accumulateEma(ema, ema_state, results, reference_year)
 
         moveCompletedFiles(summed_files)
         saveBuffer(sum_buffer)
+        total += len(summed_files)
+        saveCount(total)
+        if snapshot_dir:
+            saveSnapshot(sum_buffer, total)
+        if ema is not None:
+            saveEma(ema, ema_state)
+        m.checkpoint()
+
+        change = None
+        if total:
+            previous, change = checkpointPreview(sum_buffer, total, results, previous)
+
+        # Everything but the batch itself counts as checkpoint overhead. Smooth
+        # the measurements so one odd batch doesn't swing the batch size.
+        sample_image = (batch_end - batch_start) / count
+        sample_checkpoint = (batch_start - checkpoint_start) + (time.time() - batch_end)
+        if image_seconds is None:
+            image_seconds, checkpoint_seconds = sample_image, sample_checkpoint
+        else:
+            image_seconds = 0.5 * (image_seconds + sample_image)
+            checkpoint_seconds = 0.5 * (checkpoint_seconds + sample_checkpoint)
+
+        batch_size = tuneBatchSize(image_seconds, checkpoint_seconds)
+        print "%.3f s/image, %.1f s/checkpoint, next batch %d per CPU" % (
+            image_seconds, checkpoint_seconds, batch_size)
+
+        if convergence_threshold is not None and change is not None and change < convergence_threshold:
+            print "Converged"
+            break
 
     p.close()
+    m.write(status_file, prometheus_file)
     print "Done"
 
 
@@ -146,8 +146,6 @@ import struct
 import warnings
 import datetime
 import collections
-from fractions import Fraction
-from xml.etree import cElementTree as ElementTree
 
 import numpy
 
@@ -158,10 +156,12 @@ __all__ = ['imsave', 'imread', 'imshow', 'TiffFile', 'TiffSequence']
 
 def imsave(filename, data, photometric=None, planarconfig=None,
            resolution=None, description=None, software='tifffile.py',
-           byteorder=None, bigtiff=False, compress=0, extratags=()):
+           byteorder=None, bigtiff=False, compress=0, extratags=(),
+           rowsperstrip=None, predictor=False):
     """Write image data to TIFF file.
 
-    Image data are written in one stripe per plane.
+    Image data are written in one stripe per plane, unless rowsperstrip
+    is given.
     Dimensions larger than 2 or 3 (depending on photometric mode and
     planar configuration) are flattened and saved as separate pages.
     The 'sample_format' and 'bits_per_sample' TIFF tags are derived from
@@ -198,6 +198,12 @@ def imsave(filename, data, photometric=None, planarconfig=None,
     compress : int
         Values from 0 to 9 controlling the level of zlib compression.
         If 0, data are written uncompressed (default).
+    rowsperstrip : int
+        Number of rows per strip. By default each plane is one strip.
+        Smaller strips let readers decompress part of an image.
+    predictor : bool
+        If True, compressed integer data are written with horizontal
+        differencing, which usually compresses smooth images much better.
     extratags: sequence of tuples
         Additional tags as [(code, dtype, count, value, writeonce)].
         code : int
@@ -226,6 +232,7 @@ def imsave(filename, data, photometric=None, planarconfig=None,
     assert(planarconfig in (None, 'contig', 'planar'))
     assert(byteorder in (None, '<', '>'))
     assert(0 <= compress <= 9)
+    predictor = bool(predictor and compress)
 
     if byteorder is None:
         byteorder = '<' if sys.byteorder == 'little' else '>'
@@ -291,6 +298,13 @@ def imsave(filename, data, photometric=None, planarconfig=None,
 
     shape = data.shape  # (pages, planes, height, width, contig samples)
 
+    if predictor and data.dtype.kind not in 'iu':
+        raise ValueError("horizontal predictor needs integer data")
+    rowsperstrip = min(rowsperstrip or shape[-3], shape[-3])
+    strip_rows = [min(rowsperstrip, shape[-3] - y)
+                  for y in range(0, shape[-3], rowsperstrip)]
+    num_strips = len(strip_rows) * shape[1]
+
     bytestr = bytes if sys.version[0] == '2' else (
         lambda x: bytes(x, 'utf-8') if isinstance(x, str) else x)
     tifftypes = {'B': 1, 's': 2, 'H': 3, 'I': 4, '2I': 5, 'b': 6,
@@ -339,6 +353,7 @@ def imsave(filename, data, photometric=None, planarconfig=None,
 
     def rational(arg, max_denominator=1000000):
         # return nominator and denominator from float or two integers
+        from fractions import Fraction
         try:
             f = Fraction.from_float(arg)
         except TypeError:
@@ -383,12 +398,15 @@ def imsave(filename, data, photometric=None, planarconfig=None,
         addtag('x_resolution', '2I', 1, rational(resolution[0]))
         addtag('y_resolution', '2I', 1, rational(resolution[1]))
         addtag('resolution_unit', 'H', 1, 2)
-    addtag('rows_per_strip', 'I', 1, shape[-3])
+    addtag('rows_per_strip', 'I', 1, rowsperstrip)
+    if predictor:
+        addtag('predictor', 'H', 1, 2)
 
-    # use one strip per plane
-    strip_byte_counts = (data[0, 0].size * data.dtype.itemsize, ) * shape[1]
-    addtag('strip_byte_counts', offset_format, shape[1], strip_byte_counts)
-    addtag('strip_offsets', offset_format, shape[1], (0, ) * shape[1])
+    row_bytes = data[0, 0, 0].size * data.dtype.itemsize
+    strip_byte_counts = tuple(rows * row_bytes
+                              for rows in strip_rows) * shape[1]
+    addtag('strip_byte_counts', offset_format, num_strips, strip_byte_counts)
+    addtag('strip_offsets', offset_format, num_strips, (0, ) * num_strips)
 
     # add extra tags from users
     for t in extratags:
@@ -444,9 +462,16 @@ def imsave(filename, data, photometric=None, planarconfig=None,
             if compress:
                 strip_byte_counts = []
                 for plane in data[pageindex]:
-                    plane = zlib.compress(plane, compress)
-                    strip_byte_counts.append(len(plane))
-                    fh.write(plane)
+                    for y in range(0, shape[-3], rowsperstrip):
+                        strip = plane[y:y+rowsperstrip]
+                        if predictor:
+                            diff = strip.copy()
+                            numpy.subtract(strip[:, 1:], strip[:, :-1],
+                                           out=diff[:, 1:])
+                            strip = diff
+                        strip = zlib.compress(strip, compress)
+                        strip_byte_counts.append(len(strip))
+                        fh.write(strip)
             else:
                 # if this fails try update Python/numpy
                 data[pageindex].tofile(fh)
@@ -812,6 +837,7 @@ class TiffFile(object):
 
     def _omeseries(self):
         """Return image series in OME-TIFF file(s)."""
+        from xml.etree import cElementTree as ElementTree
         root = ElementTree.XML(self.pages[0].tags['image_description'].value)
         uuid = root.attrib.get('UUID', None)
         self._tiffs = {uuid: self}
@@ -2147,57 +2173,83 @@ def read_micromanager_metadata(fh):
 
 
 def _replace_by(module_function, package=None, warn=True):
-    """Try replace decorated function by module.function."""
-    try:
-        from importlib import import_module
-    except ImportError:
-        warnings.warn('Could not import module importlib')
-        return lambda func: func
+    """Try replace decorated function by module.function.
 
+    The module is imported on the first call, so an accelerated backend
+    that isn't installed doesn't slow down importing tifffile. Use
+    warn=False if the backend is optional.
+
+    """
     def decorate(func, module_function=module_function, warn=warn):
-        try:
-            module, function = module_function.split('.')
-            if not package:
-                module = import_module(module)
-            else:
-                module = import_module('.' + module, package=package)
-            func, oldfunc = getattr(module, function), func
-            globals()['__old_' + func.__name__] = oldfunc
-        except Exception:
-            if warn:
-                warnings.warn("failed to import %s" % module_function)
-        return func
+        replacement = []
+
+        def resolve():
+            try:
+                from importlib import import_module
+                module, function = module_function.split('.')
+                if not package:
+                    module = import_module(module)
+                else:
+                    module = import_module('.' + module, package=package)
+                newfunc = getattr(module, function)
+                globals()['__old_' + func.__name__] = func
+            except Exception:
+                if warn:
+                    warnings.warn("failed to import %s" % module_function)
+                newfunc = func
+            replacement.append(newfunc)
+            return newfunc
+
+        def replaced(*args, **kwargs):
+            newfunc = replacement[0] if replacement else resolve()
+            return newfunc(*args, **kwargs)
+
+        replaced.__name__ = func.__name__
+        replaced.__doc__ = func.__doc__
+        return replaced
 
     return decorate
 
 
-#@_replace_by('_tifffile.decodepackbits')
+@_replace_by('_tifffile.decodepackbits', warn=False)
 def decodepackbits(encoded):
     """Decompress PackBits encoded byte string.
 
     PackBits is a simple byte-oriented run-length compression scheme.
 
+    The run headers are scanned once, and the output is then made with one
+    numpy.repeat of the encoded bytes: headers repeated zero times, literal
+    bytes once, and the byte of each run as often as it is repeated.
+    `encoded` can be any buffer, e.g. a memoryview, and isn't copied.
+
     """
     func = ord if sys.version[0] == '2' else lambda x: x
-    result = []
-    result_extend = result.extend
+    view = memoryview(encoded)
+    len_encoded = len(view)
+    headers = []
+    headers_append = headers.append
     i = 0
-    try:
-        while True:
-            n = func(encoded[i]) + 1
+    while i < len_encoded:
+        n = func(view[i])
+        headers_append(i)
+        if n < 128:
+            i += n + 2
+        elif n > 128:
+            i += 2
+        else:
             i += 1
-            if n < 129:
-                result_extend(encoded[i:i+n])
-                i += n
-            elif n > 129:
-                result_extend(encoded[i:i+1] * (258-n))
-                i += 1
-    except IndexError:
-        pass
-    return b''.join(result) if sys.version[0] == '2' else bytes(result)
+
+    data = numpy.asarray(view, 'u1')
+    counts = numpy.ones(len_encoded, numpy.intp)
+    headers = numpy.array(headers, numpy.intp)
+    counts[headers] = 0
+    # runs, except one cut off before its byte
+    runs = headers[(data[headers] > 128) & (headers + 1 < len_encoded)]
+    counts[runs + 1] = 257 - data[runs].astype(numpy.intp)
+    return numpy.repeat(data, counts).tostring()
 
 
-#@_replace_by('_tifffile.decodelzw')
+@_replace_by('_tifffile.decodelzw', warn=False)
 def decodelzw(encoded):
     """Decompress LZW (Lempel-Ziv-Welch) encoded TIFF strip (byte string).
 
@@ -2206,76 +2258,75 @@ def decodelzw(encoded):
     This is an implementation of the LZW decoding algorithm described in (1).
     It is not compatible with old style LZW compressed files like quad-lzw.tif.
 
+    Between CLEAR codes the code width only depends on how many codes were
+    read since the CLEAR, so codes are read with numpy a run at a time.
+    Every table entry is a decoded string plus the first byte of the next
+    one, so the table is offsets and lengths into the output, and each
+    output byte is a literal or a copy of an earlier byte. The copies are
+    resolved by pointer jumping, a few array operations per run of codes.
+    Each run is expanded as soon as it is read, so the temporaries are a few
+    times the size of one run's output plus 4 bytes per encoded byte.
+
+    A code that refers past the end of the table raises ValueError. (The
+    byte-by-byte decoder this replaced warned and returned what it had
+    decoded so far.)
+
     """
     len_encoded = len(encoded)
     bitcount_max = len_encoded * 8
-    unpack = struct.unpack
-
-    if sys.version[0] == '2':
-        newtable = [chr(i) for i in range(256)]
-    else:
-        newtable = [bytes([i]) for i in range(256)]
-    newtable.extend((0, 0))
-
-    def next_code():
-        """Return integer of `bitw` bits at `bitcount` position in encoded."""
-        start = bitcount // 8
-        s = encoded[start:start+4]
-        try:
-            code = unpack('>I', s)[0]
-        except Exception:
-            code = unpack('>I', s + b'\x00'*(4-len(s)))[0]
-        code <<= bitcount % 8
-        code &= mask
-        return code >> shr
-
-    switchbitch = {  # code: bit-width, shr-bits, bit-mask
-        255: (9, 23, int(9*'1'+'0'*23, 2)),
-        511: (10, 22, int(10*'1'+'0'*22, 2)),
-        1023: (11, 21, int(11*'1'+'0'*21, 2)),
-        2047: (12, 20, int(12*'1'+'0'*20, 2)), }
-    bitw, shr, mask = switchbitch[255]
-    bitcount = 0
-
     if len_encoded < 4:
         raise ValueError("strip must be at least 4 characters long")
 
-    if next_code() != 256:
+    # every code is within the 24 bits from its first byte; the strip is
+    # padded, as codes past the end read as zero bits
+    data = numpy.zeros(len_encoded + 2, 'u1')
+    data[:len_encoded] = numpy.frombuffer(encoded, 'u1')
+    words = data[:-2].astype(numpy.uint32)
+    words <<= 8
+    words |= data[1:-1]
+    words <<= 8
+    words |= data[2:]
+    del data
+
+    # code widths after a CLEAR code, as the table grows
+    index = numpy.arange(4096)
+    widths = 9 + (index >= 254) + (index >= 766) + (index >= 1790)
+    full_widths = numpy.full(4096, 12, numpy.intp)
+
+    codes, end = _lzw_codes(words, 0, widths[:1])
+    if codes[0] != 256:
         raise ValueError("strip must begin with CLEAR code")
+    bitcount = int(end[0])
 
-    code = 0
-    oldcode = 0
     result = []
-    result_append = result.append
     while True:
-        code = next_code()  # ~5% faster when inlining this function
-        bitcount += bitw
-        if code == 257 or bitcount >= bitcount_max:  # EOI
-            break
-        if code == 256:  # CLEAR
-            table = newtable[:]
-            table_append = table.append
-            lentable = 258
-            bitw, shr, mask = switchbitch[255]
-            code = next_code()
-            bitcount += bitw
-            if code == 257:  # EOI
+        # codes after a CLEAR code, up to the next CLEAR or EOI code or the
+        # end of the strip, read at most 4096 at a time
+        run = []
+        first = 0
+        while True:
+            count = max(1, min(4096, (bitcount_max - bitcount) // 9 + 1))
+            width = full_widths if first else widths
+            codes, end = _lzw_codes(words, bitcount, width[:count])
+            stop = (codes == 256) | (codes == 257) | (end >= bitcount_max)
+            if first == 0:
+                stop[0] = codes[0] == 257
+            hits = numpy.flatnonzero(stop)
+            if hits.size:
                 break
-            result_append(table[code])
-        else:
-            if code < lentable:
-                decoded = table[code]
-                newcode = table[oldcode] + decoded[:1]
-            else:
-                newcode = table[oldcode]
-                newcode += newcode[:1]
-                decoded = newcode
-            result_append(decoded)
-            table_append(newcode)
-            lentable += 1
-        oldcode = code
-        if lentable in switchbitch:
-            bitw, shr, mask = switchbitch[lentable]
+            run.append(codes)
+            first += count
+            bitcount = int(end[-1])
+        i = hits[0]
+        run.append(codes[:i])
+        segment, parent, length = _lzw_lengths(numpy.concatenate(run))
+        out = numpy.empty(int(length.sum()), 'u1')
+        _lzw_expand(segment, parent, length, out)
+        result.append(out.tostring())
+        code = int(codes[i])
+        bitcount = int(end[i])
+        if code != 256 or bitcount >= bitcount_max:
+            break
 
     if code != 257:
         warnings.warn(
@@ -2284,6 +2335,64 @@ def decodelzw(encoded):
     return b''.join(result)
 
 
+def _lzw_codes(words, bitcount, width):
+    """Return LZW codes of the given widths from bit `bitcount`, and their ends.
+
+    `words` holds the 24 bits starting at each byte of the strip.
+
+    """
+    end = numpy.cumsum(width)
+    end += bitcount
+    start = end - width
+    byte = numpy.minimum(start >> 3, words.size - 1)
+    codes = words[byte] >> (24 - (start & 7) - width)
+    codes &= (1 << width) - 1
+    return codes, end
+
+
+def _lzw_lengths(codes):
+    """Return codes following a CLEAR code, their prefixes and lengths.
+
+    Each code's prefix is the code whose decoded string its table entry
+    starts with, or the code itself for literals.
+
+    """
+    index = numpy.arange(codes.size)
+    literal = codes < 256
+    parent = numpy.where(literal, index, codes - 258)
+    invalid = ~literal & ((parent < 0) | (parent >= index))
+    if invalid.any():
+        raise ValueError("invalid LZW code %i" % codes[invalid][0])
+    # decoded strings are one byte longer than their prefix's, so a length
+    # is the distance to a literal along the prefixes
+    distance = (~literal).astype(numpy.intp)
+    up = parent
+    while not literal[up].all():
+        distance += distance[up]
+        up = up[up]
+    return codes, parent, distance + 1
+
+
+def _lzw_expand(codes, parent, length, out):
+    """Write the decoded strings of codes following a CLEAR code to out."""
+    if not codes.size:
+        return
+    start = numpy.cumsum(length) - length
+    # byte i of a string is byte i of its prefix's string, or for the last
+    # byte, the first of the string after it
+    source = numpy.repeat(start[parent] - start, length)
+    source += numpy.arange(out.size)
+    while True:
+        jumped = source[source]
+        if (jumped == source).all():
+            break
+        source = jumped
+    literal = codes < 256
+    value = numpy.zeros(out.size, 'u1')
+    value[start[literal]] = codes[literal]
+    numpy.take(value, source, out=out)
+
+
 #@_replace_by('_tifffile.unpackints')
 def unpackints(data, dtype, itemsize, runlen=0):
     """Decompress byte string to array of integers of any bit size <= 32.
@@ -2324,28 +2433,42 @@ def unpackints(data, dtype, itemsize, runlen=0):
     skipbits = runlen*itemsize % 8
     if skipbits:
         skipbits = 8 - skipbits
-    shrbits = itembytes*8 - itemsize
-    bitmask = int(itemsize*'1'+'0'*shrbits, 2)
-    dtypestr = '>' + dtype.char  # dtype always big endian?
-
-    unpack = struct.unpack
     l = runlen * (len(data)*8 // (runlen*itemsize + skipbits))
-    result = numpy.empty((l, ), dtype)
-    bitcount = 0
-    for i in range(len(result)):
-        start = bitcount // 8
-        s = data[start:start+itembytes]
-        try:
-            code = unpack(dtypestr, s)[0]
-        except Exception:
-            code = unpack(dtypestr, s + b'\x00'*(itembytes-len(s)))[0]
-        code <<= bitcount % 8
+    rows = l // runlen
+    rowbytes = (runlen*itemsize + skipbits) // 8
+
+    # integers repeat their bit alignment every `group` integers, which
+    # take up `groupbytes` bytes, so each integer of a group is unpacked
+    # for all groups at once. That is 8 / gcd(itemsize, 8) integers: halve
+    # 8 while half the group still fills whole bytes.
+    group = 8
+    while group > 1 and itemsize * group // 2 % 8 == 0:
+        group //= 2
+    groupbytes = itemsize * group // 8
+    groups = -(-runlen // group)
+    data = numpy.frombuffer(data, '|B', rows*rowbytes).reshape(rows, rowbytes)
+    if groups*groupbytes != rowbytes:
+        padded = numpy.zeros((rows, groups*groupbytes), '|B')
+        padded[:, :rowbytes] = data
+        data = padded
+    data = data.reshape(rows, groups, groupbytes)
+
+    bitmask = (1 << itemsize) - 1
+    result = numpy.empty((rows, groups, group), dtype)
+    for i in range(group):
+        start, shift = divmod(i*itemsize, 8)
+        nbytes = (shift + itemsize + 7) // 8
+        code = data[:, :, start].astype(numpy.int64)
+        for j in range(start + 1, start + nbytes):
+            code <<= 8
+            code |= data[:, :, j]
+        code >>= nbytes*8 - shift - itemsize
         code &= bitmask
-        result[i] = code >> shrbits
-        bitcount += itemsize
-        if (i+1) % runlen == 0:
-            bitcount += skipbits
-    return result
+        result[:, :, i] = code
+    result = result.reshape(rows, groups*group)
+    if groups*group != runlen:
+        result = result[:, :runlen]
+    return result.reshape(-1)
 
 
 def unpackrgb(data, dtype='<B', bitspersample=(5, 6, 5), rescale=True):
@@ -0,0 +1,181 @@
+#
+# Tiled, out-of-core execution of image stages.
+#
+# A map stage computes each output pixel from the input pixels within 'halo'
+# of it: 0 for pointwise operations, a few sigma for a blur. We cut the frame
+# into tiles, read each one plus its halo from memmapped .npy inputs
+# (mirrored past the frame edges, like the whole-frame filters), run the
+# stage on a process pool, and write the middle of each result into a
+# memmapped .npy output. A reduce stage runs the same way but returns a
+# small value per tile, and the values are combined at the end.
+#
+# Workers only hold a few tiles at a time, so the frame size is bounded by
+# disk space rather than RAM.
+#
+
+import os
+import tempfile
+import multiprocessing
+import numpy
+import numpy.lib.format
+
+tile_size = 2048
+processes = multiprocessing.cpu_count()
+
+# Non-frame array inputs at least this big go to the workers as files
+whole_min_bytes = 1 << 20
+
+def haloPair(halo):
+    # A halo is one radius for both axes, or (rows, columns)
+    if isinstance(halo, (tuple, list)):
+        return tuple(halo)
+    return halo, halo
+
+def windows(shape, size, region=None):
+    # (y0, y1, x0, x1) of each tile covering 'region' of the frame
+    y0, y1, x0, x1 = region or (0, shape[0], 0, shape[1])
+    result = []
+    for y in range(y0, y1, size):
+        for x in range(x0, x1, size):
+            result.append((y, min(y + size, y1), x, min(x + size, x1)))
+    return result
+
+def readTile(a, window, halo=0):
+    # The window of 'a' with 'halo' extra pixels each side, mirrored past the
+    # edges to match scipy's 'reflect' mode
+    hy, hx = haloPair(halo)
+    y0, y1, x0, x1 = window
+    h, w = a.shape[:2]
+    sy0, sy1 = max(y0 - hy, 0), min(y1 + hy, h)
+    sx0, sx1 = max(x0 - hx, 0), min(x1 + hx, w)
+    tile = numpy.asarray(a[sy0:sy1, sx0:sx1])
+
+    pad = [(sy0 - (y0 - hy), y1 + hy - sy1), (sx0 - (x0 - hx), x1 + hx - sx1)]
+    if any(before or after for before, after in pad):
+        tile = numpy.pad(tile, pad + [(0, 0)] * (a.ndim - 2), 'symmetric')
+    return tile
+
+def isMapped(a):
+    # True if 'a' is a whole memmapped file, so workers can open it by name
+    return (isinstance(a, numpy.memmap) and a.filename and a.flags.c_contiguous
+        and os.path.getsize(a.filename) == a.offset + a.nbytes)
+
+def describe(a):
+    return ('array', a.filename, a.offset, a.dtype, a.shape)
+
+def openInput(spec):
+    if spec[0] in ('array', 'whole'):
+        kind, filename, offset, dtype, shape = spec
+        return numpy.memmap(filename, dtype, 'r', offset, shape)
+    return spec[1]
+
+def frameTiles(specs, window, halo):
+    # Read the tile of every frame-sized input; other inputs pass through whole
+    return [readTile(openInput(spec), window, halo) if spec[0] == 'array' else openInput(spec)
+        for spec in specs]
+
+def positionParams(params, window, frame, halo):
+    # Where the tile sits, for stages that depend on pixel coordinates
+    return dict(params, origin=(window[0], window[2]), frame=frame, halo=haloPair(halo))
+
+def mapTile(task):
+    func, specs, path, dtype, frame, window, halo, positional, params = task
+    hy, hx = haloPair(halo)
+    y0, y1, x0, x1 = window
+
+    args = frameTiles(specs, window, halo)
+    if positional:
+        params = positionParams(params, window, frame, halo)
+    tile_shape = [a for a in args if isinstance(a, numpy.ndarray)][0].shape
+    result = func(*args, out=numpy.empty(tile_shape, dtype), **params)
+
+    out = numpy.load(path, mmap_mode='r+')
+    out[y0:y1, x0:x1] = result[hy:hy + y1 - y0, hx:hx + x1 - x0]
+    out.flush()
+
+def reduceTile(task):
+    func, specs, frame, window, halo, positional, params = task
+    args = frameTiles(specs, window, halo)
+    if positional:
+        params = positionParams(params, window, frame, halo)
+    return func(*args, **params)
+
+class Executor(object):
+    def __init__(self, tile_size=tile_size, processes=processes, initializer=None, initargs=()):
+        self.tile_size = tile_size
+        self.processes = processes
+        self.initializer = initializer
+        self.initargs = initargs
+        self.pool = None
+
+    def run(self, worker, tasks):
+        # Results come back in tile order, so reductions are deterministic.
+        # With one process we skip the pool (and its initializer) entirely.
+        if self.processes <= 1:
+            return map(worker, tasks)
+        if self.pool is None:
+            self.pool = multiprocessing.Pool(self.processes, self.initializer, self.initargs)
+        return list(self.pool.imap(worker, tasks))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def prepare(self, inputs, spill_dir):
+        # Describe the inputs for the workers. Frame-sized arrays that only
+        # live in RAM are spilled to a temporary file first. Other arrays of
+        # at least whole_min_bytes are passed whole, by file name if they're
+        # memmapped and through a spill file if not, instead of being pickled
+        # into every task.
+        frame = None
+        specs = []
+        spilled = []
+
+        def mapped(a):
+            if not isMapped(a):
+                fd, path = tempfile.mkstemp('.npy', 'spill-', spill_dir)
+                os.close(fd)
+                numpy.save(path, a)
+                spilled.append(path)
+                a = numpy.load(path, mmap_mode='r')
+            return describe(a)
+
+        for a in inputs:
+            if isinstance(a, numpy.ndarray) and a.ndim >= 2 and frame in (None, a.shape[:2]):
+                frame = a.shape[:2]
+                specs.append(mapped(a))
+            elif isinstance(a, numpy.ndarray) and a.nbytes >= whole_min_bytes:
+                specs.append(('whole',) + mapped(a)[1:])
+            else:
+                specs.append(('value', a))
+        return frame, specs, spilled
+
+    def map(self, func, inputs, path, dtype, halo=0, positional=False, **params):
+        # func(*tiles, out=<tile buffer>, **params) over every tile, written to
+        # a new .npy at 'path'. Returns the result memmapped read-only.
+        spill_dir = os.path.dirname(path) or '.'
+        frame, specs, spilled = self.prepare(inputs, spill_dir)
+        shape = [s for s in specs if s[0] == 'array'][0][4]
+        try:
+            tmp = path + '.tmp'
+            out = numpy.lib.format.open_memmap(tmp, 'w+', dtype, shape)
+            del out
+            self.run(mapTile, [(func, specs, tmp, dtype, frame, window, halo, positional, params)
+                for window in windows(frame, self.tile_size)])
+            os.rename(tmp, path)
+        finally:
+            for f in spilled:
+                os.remove(f)
+        return numpy.load(path, mmap_mode='r')
+
+    def reduce(self, func, combine, inputs, halo=0, region=None, positional=False, **params):
+        # combine([func(*tiles, **params) for each tile of 'region'])
+        frame, specs, spilled = self.prepare(inputs, None)
+        try:
+            return combine(self.run(reduceTile, [(func, specs, frame, window, halo, positional, params)
+                for window in windows(frame, self.tile_size, region)]))
+        finally:
+            for f in spilled:
+                os.remove(f)
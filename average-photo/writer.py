@@ -0,0 +1,58 @@
+#
+# Output files written from a thread pool, so the next stage can start while
+# earlier results go to disk. File writes and zlib both release the GIL, so
+# the writes overlap with the numpy work on the main thread.
+#
+# The buffers handed to the writers come from a BufferPool and go back to it
+# once written, and the number of queued writes is capped, so the memory
+# held by pending outputs stays bounded.
+#
+
+import threading
+import multiprocessing.pool
+import numpy
+
+class Writer(object):
+    def __init__(self, threads=2, max_pending=2):
+        self.pool = multiprocessing.pool.ThreadPool(threads)
+        self.slots = threading.Semaphore(max_pending)
+
+    def submit(self, func, *args, **kwargs):
+        # Run func(*args, **kwargs) on the pool, returning its AsyncResult.
+        # Blocks while max_pending calls are already queued or running.
+        self.slots.acquire()
+
+        def run():
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.slots.release()
+
+        return self.pool.apply_async(run)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+class BufferPool(object):
+    # Spare arrays by shape and type, for reuse instead of reallocating
+    def __init__(self):
+        self.free = {}
+        self.owned = set()
+        self.lock = threading.Lock()
+
+    def take(self, shape, dtype):
+        key = (tuple(shape), numpy.dtype(dtype).str)
+        with self.lock:
+            if self.free.get(key):
+                return self.free[key].pop()
+        a = numpy.empty(shape, dtype)
+        with self.lock:
+            self.owned.add(id(a))
+        return a
+
+    def give(self, a):
+        # Return an array from take(); anything else is ignored
+        with self.lock:
+            if id(a) in self.owned:
+                self.free.setdefault((a.shape, a.dtype.str), []).append(a)